@@ -1,19 +1,52 @@
 import select
 import socket
 import os
-from collections import deque
 from datetime import datetime
 import QUIC_api as api
+import QUIC_congestion as congestion_control
+import QUIC_flow
+import QUIC_io
+import QUIC_streams
+import QUIC_trace
 import argparse
 
 parser = argparse.ArgumentParser(
     description="Enter the thresholds for time based recovery and packet number based recovery or leave them out to "
                 "use the default threshold. To turn off a specific recovery, set its threshold to 0. Note that you "
                 "need at least one active recovery algorithm")
-parser.add_argument("-t", "--time", type=float, default=0.1,
-                    help="Value of time_threshold (default: 0.1). Enter 0 to turn off time based recovery.")
+parser.add_argument("-t", "--time", type=float, default=None,
+                    help="Value of time_threshold in seconds (default: 9/8 of the measured RTT). Enter 0 to turn off "
+                         "time based recovery.")
 parser.add_argument("-n", "--number", type=int, default=7,
                     help="packet_reordering_threshold (default: 7). Enter 0 to turn off packet number based recovery.")
+parser.add_argument("-q", "--quic-version", type=int, default=api.QUIC_VERSION_BINARY, choices=api.SUPPORTED_VERSIONS,
+                    help="Wire format version to offer in the ClientHello: 1 for bit strings, 2 for binary "
+                         "(default: 2). The server may answer with an older version.")
+parser.add_argument("-p", "--pto", type=float, default=None,
+                    help="Probe timeout in seconds for the tail packets (default: derived from the measured RTT).")
+parser.add_argument("-c", "--congestion", default='newreno', choices=congestion_control.CONGESTION_CONTROLLERS,
+                    help="Congestion controller that gates the send loop (default: newreno). 'none' sends as fast as "
+                         "the socket allows.")
+parser.add_argument("-r", "--pacing-rate", type=float, default=None,
+                    help="Pacing rate in MB/s (default: 1.25 * congestion window / RTT). Enter 0 to turn off pacing.")
+parser.add_argument("-f", "--files", nargs='+', default=None,
+                    help="The files to send, each on its own stream (default: alphanumeric_file.txt).")
+parser.add_argument("-s", "--scheduler", default=QUIC_streams.ROUND_ROBIN, choices=QUIC_streams.SCHEDULERS,
+                    help="How the streams share the connection: take turns (default), or send the files in the given "
+                         "order.")
+parser.add_argument("--cid", type=int, default=1,
+                    help="This client's CID (default: 1). Concurrent clients of the same server need different CIDs.")
+parser.add_argument("--port", type=int, default=9997,
+                    help="The server's port (default: 9997). Point it at a QUIC_netem.py relay to impair the link.")
+parser.add_argument("--trace", default=None,
+                    help="Write a qlog trace of the connection's packets, ACKs, losses, RTT and congestion window to "
+                         "this file.")
+parser.add_argument("--trace-sample", type=int, default=1,
+                    help="Trace one in this many packets, by packet number (default: 1, every packet). Losses are "
+                         "always traced.")
+parser.add_argument("--trace-size", type=int, default=QUIC_trace.CAPACITY,
+                    help=f"The most events kept for the trace; older ones are overwritten (default: "
+                         f"{QUIC_trace.CAPACITY}).")
 args = parser.parse_args()
 
 if args.time == 0 and args.number == 0:
@@ -23,20 +56,20 @@ if args.time == 0 and args.number == 0:
 PACKET_NUMBER_BASED = args.number != 0
 TIME_BASED = args.time != 0
 
-# Thresholds for recovery algorithms
+# Thresholds for recovery algorithms. A threshold of None is derived from the RTT estimator.
 PACKET_REORDERING_THRESHOLD = args.number
 TIME_THRESHOLD = args.time
-PTO_TIMEOUT = 0.2
+PTO_TIMEOUT = args.pto
 THRESHOLDS = (PACKET_REORDERING_THRESHOLD, TIME_THRESHOLD, PTO_TIMEOUT)
 
 # Client setup
 SERVER_IP = '127.0.0.1'
-SERVER_PORT = 9997
+SERVER_PORT = args.port
 SERVER_ADDRESS = (SERVER_IP, SERVER_PORT)
-BUFFER_SIZE = 1827  # 2048 - 221: packet size minus header size
+MAX_DATAGRAM_SIZE = 2048
 
-# CIDs
-CLIENT_CID = 1
+# CIDs. The server gives every connection its own CID in the ServerHello.
+CLIENT_CID = args.cid
 SERVER_CID = 2
 
 # Retransmition counters
@@ -47,6 +80,9 @@ packet_number_retransmit_counter = 0
 # Current packet number
 current_packet_number = 0
 
+# RTT estimator, sampled at the handshake and from every ACK
+rtt = api.RttEstimator()
+
 # Record start time
 start_time = datetime.timestamp(datetime.now())
 
@@ -57,7 +93,8 @@ sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 # QUIC handshake
 
 api.send_hello_packet(socket=sock, streamID=0, dcid=SERVER_CID, scid=CLIENT_CID, side='Client',
-                      address=SERVER_ADDRESS)
+                      address=SERVER_ADDRESS, version=args.quic_version)
+hello_time = datetime.timestamp(datetime.now())
 print("Sent ClientHello.")
 
 # Set time out for server hello packet
@@ -67,12 +104,13 @@ sock.settimeout(HANDSHAKE_TIMEOUT)
 while True:
 
     try:
-        data_recv, addr = sock.recvfrom(BUFFER_SIZE)
+        data_recv, addr = sock.recvfrom(MAX_DATAGRAM_SIZE)
     except socket.timeout:  # On timeout, resend the handshake packet
         print("ServerHello timeout.")
         api.send_hello_packet(socket=sock, streamID=0, dcid=SERVER_CID, scid=CLIENT_CID, side='Client',
-                              address=SERVER_ADDRESS)
+                              address=SERVER_ADDRESS, version=args.quic_version)
         retransmit_counter += 1
+        hello_time = None  # The ServerHello can't be matched to a ClientHello anymore
         print("Sent ClientHello.")
         continue
     except BlockingIOError:
@@ -81,80 +119,179 @@ while True:
     # parse the received data
     parsed_packet = api.parse_quic_long_header(data_recv)
     parsed_frame = api.parse_quic_frame(parsed_packet['payload'])
-    if parsed_frame['data'].decode() == 'ServerHello':
+    hello, _, max_ack_delay = api.parse_hello_data(parsed_frame['data'])
+    if hello == 'ServerHello':
         print("Received ServerHello.\nHandshake Completed.")
+        if max_ack_delay is not None:
+            # The server may hold an ACK this long, so the PTO waits for it
+            rtt.max_ack_delay = max_ack_delay / 1000
+        if hello_time is not None:
+            rtt.update(datetime.timestamp(datetime.now()) - hello_time)
         break
 
+# The server answers with the wire format version it picked, and the CID of this connection
+QUIC_VERSION = parsed_packet['version']
+SERVER_CID = int(parsed_packet['scid'], 2)
+
 # Cancel socket timeout for normal UDP operation
 sock.settimeout(None)
 
 FILE_PATH = os.path.abspath(os.path.dirname(__file__))+"/alphanumeric_file.txt"
-# Open the text file in read mode
-with open(FILE_PATH, 'r') as file:
-    # Get the size of the file
-    file.seek(0, os.SEEK_END)
-    FILE_SIZE = file.tell()
-    file.seek(0)
-total_packets = (FILE_SIZE // BUFFER_SIZE) + (1 if FILE_SIZE % BUFFER_SIZE else 0)
-
-# Create a packet deque
-# Element format: [ packet_number , is_ACKed , send_time , packet ]
-packet_queue = deque()
+FILE_PATHS = args.files or [FILE_PATH]
 
-# Set socket to non-blocking mode
-sock.setblocking(False)
+# Flow control: the server limits how much every stream, and the whole connection, may send
+flow = QUIC_flow.SendFlowControl()
 
-# Open file and send in chunks
-curr_offest = 0
-with open(FILE_PATH, 'rb') as f:
-    for i in range(1, total_packets + 1):
-        # Read file chunk
-        bytes_read = f.read(BUFFER_SIZE)
+# Open a stream for every file. With the priority scheduler, the files are sent in the given order.
+# The files are memory mapped, and the packets are built from slices of them.
+streams = QUIC_streams.StreamScheduler(args.scheduler, flow)
+for priority, file_path in enumerate(FILE_PATHS):
+    streams.open_stream(file_path, priority)
+FILE_SIZE = streams.size
+# Packet size minus the longest header this connection can have
+BUFFER_SIZE = MAX_DATAGRAM_SIZE - api.packet_overhead(QUIC_VERSION, SERVER_CID, streams.next_stream_id, FILE_SIZE)
+total_packets = 0
 
-        # Create frame
-        frame = api.construct_quic_frame(8, 0, curr_offest, bytes_read)
-        curr_offest += len(bytes_read)
+# Packets in flight, keyed by packet number. Only the frame references are kept, not the packets.
+packet_queue = api.SentPacketMap(SERVER_CID)
 
-        # Create QUIC packet
-        packet = api.construct_quic_short_header_binary(SERVER_CID, current_packet_number, frame)
-        # print(f"packet number {packet_number} sent to server")
+# The time from sending to the ACK of every packet
+ack_latencies = []
 
-        packet_queue.append([current_packet_number, False, datetime.timestamp(datetime.now()), packet])
+# Every packet of a batch gets its own buffer, with the header already in it
+encoder = api.PacketEncoder(SERVER_CID, QUIC_VERSION, buffer_count=QUIC_io.BATCH_SIZE)
 
-        # Send packet
-        sock.sendto(packet.encode(), SERVER_ADDRESS)
+# Congestion controller, told about every sent, ACKed and lost packet
+congestion = congestion_control.create_congestion_controller(args.congestion, rtt, MAX_DATAGRAM_SIZE)
 
-        # Update the current packet number
-        current_packet_number += 1
+# Pacer that spaces out the packets the congestion window allows
+PACING = args.pacing_rate != 0
+pacer = congestion_control.Pacer(congestion, None if args.pacing_rate is None else args.pacing_rate * 1024 * 1024)
+
+# Connection trace, recorded in memory and written when the connection closes
+trace = None
+if args.trace is not None:
+    trace = QUIC_trace.Tracer(args.trace, args.trace_size, args.trace_sample, title=f"client {CLIENT_CID}")
 
-        retrans_count,  time_count, number_count, new_packet_number = api.receive_ACKs(sock,SERVER_ADDRESS,packet_queue, False,current_packet_number, *THRESHOLDS)
+# Set socket to non-blocking mode
+sock.setblocking(False)
+
+# Batched socket I/O: packets go out in batches, ACKs come in batches
+batch_io = QUIC_io.BatchSocketIO(sock)
+
+# Send the streams in chunks
+while not streams.finished:
+    # Wait for room in the congestion window and for flow control credit. If no ACK arrives before the time threshold
+    # or the PTO of the oldest packet in flight, recover the tail packets.
+    resend_blocked = False
+    while not congestion.can_send() or not streams.can_send:
+        # Tell the server which limits hold the streams back, again if no update arrived for a whole PTO
+        if not streams.can_send:
+            for frame_type, stream_id, limit in streams.blocked_frames(resend_blocked):
+                frame = api.encode_flow_control_frame(frame_type, limit, stream_id, QUIC_VERSION)
+                sock.sendto(api.encode_quic_short_packet(SERVER_CID, current_packet_number, frame, QUIC_VERSION),
+                            SERVER_ADDRESS)
+                current_packet_number += 1
+
+        ready = select.select([sock], [], [], api.loss_timeout(packet_queue, TIME_THRESHOLD, PTO_TIMEOUT, rtt))
+        resend_blocked = not ready[0]
+        retrans_count,  time_count, number_count, new_packet_number = api.receive_ACKs(sock,SERVER_ADDRESS,packet_queue, not ready[0],current_packet_number, *THRESHOLDS,
+                                                                                     version=QUIC_VERSION, rtt=rtt, congestion=congestion,
+                                                                                     io=batch_io, flow=flow,
+                                                                                     ack_latencies=ack_latencies,
+                                                                                     trace=trace)
         retransmit_counter += retrans_count
         time_retransmit_counter += time_count
         packet_number_retransmit_counter += number_count
         current_packet_number = new_packet_number
 
+    # Wait for the pacer, handling the ACKs that arrive in the meantime
+    if PACING:
+        now = datetime.timestamp(datetime.now())
+        send_time = pacer.next_send_time(now)
+        while send_time > now:
+            ready = select.select([sock], [], [], send_time - now)
+            if ready[0]:
+                retrans_count,  time_count, number_count, new_packet_number = api.receive_ACKs(sock,SERVER_ADDRESS,packet_queue, False,current_packet_number, *THRESHOLDS,
+                                                                                             version=QUIC_VERSION, rtt=rtt, congestion=congestion,
+                                                                                             io=batch_io, flow=flow,
+                                                                                             ack_latencies=ack_latencies,
+                                                                                             trace=trace)
+                retransmit_counter += retrans_count
+                time_retransmit_counter += time_count
+                packet_number_retransmit_counter += number_count
+                current_packet_number = new_packet_number
+            now = datetime.timestamp(datetime.now())
+            send_time = pacer.next_send_time(now)
+
+    # Build packets while the window and the pacer allow, and send them with a single system call
+    batch = []
+    send_time = datetime.timestamp(datetime.now())
+    while True:
+        # Take the next chunk of the scheduled stream
+        stream_frame = streams.read(BUFFER_SIZE)
+
+        # Create QUIC packet, with the FIN bit on the last frame of the stream
+        packet = encoder.encode(current_packet_number, stream_frame, packet_queue.largest_acked)
+
+        packet_queue.add(current_packet_number, send_time, packet, stream_frame)
+        congestion.on_packet_sent(len(packet), send_time)
+        pacer.on_packet_sent(len(packet), send_time)
+        if trace is not None:
+            trace.packet_sent(send_time, current_packet_number, len(packet), stream_frame)
+        batch.append(packet)
+
+        # Update the current packet number
+        current_packet_number += 1
+        total_packets += 1
+
+        if (len(batch) == QUIC_io.BATCH_SIZE or streams.finished or not congestion.can_send()
+                or not streams.can_send or (PACING and pacer.next_send_time(send_time) > send_time)):
+            break
+
+    # Send packets
+    batch_io.send(batch, SERVER_ADDRESS)
+
+    retrans_count,  time_count, number_count, new_packet_number = api.receive_ACKs(sock,SERVER_ADDRESS,packet_queue, False,current_packet_number, *THRESHOLDS,
+                                                                                 version=QUIC_VERSION, rtt=rtt, congestion=congestion,
+                                                                                 io=batch_io, flow=flow,
+                                                                                 ack_latencies=ack_latencies,
+                                                                                 trace=trace)
+    retransmit_counter += retrans_count
+    time_retransmit_counter += time_count
+    packet_number_retransmit_counter += number_count
+    current_packet_number = new_packet_number
+
 while len(packet_queue) > 0:
-    retrans_count,  time_count, number_count, new_packet_number = api.receive_ACKs(sock,SERVER_ADDRESS,packet_queue, True,current_packet_number, *THRESHOLDS)
+    retrans_count,  time_count, number_count, new_packet_number = api.receive_ACKs(sock,SERVER_ADDRESS,packet_queue, True,current_packet_number, *THRESHOLDS,
+                                                                                 version=QUIC_VERSION, rtt=rtt, congestion=congestion,
+                                                                                 io=batch_io, flow=flow,
+                                                                                 ack_latencies=ack_latencies,
+                                                                                 trace=trace)
     retransmit_counter += retrans_count
     time_retransmit_counter += time_count
     packet_number_retransmit_counter += number_count
     current_packet_number = new_packet_number
-print("File sent successfully.")
+print(f"{'File' if len(FILE_PATHS) == 1 else f'{len(FILE_PATHS)} files'} sent successfully.")
 
-api.send_connection_close_packet(socket=sock, streamID=0, dcid=SERVER_CID, packet_number=total_packets + 1,
-                                 address=SERVER_ADDRESS)
+api.send_connection_close_packet(socket=sock, streamID=0, dcid=SERVER_CID, packet_number=current_packet_number,
+                                 address=SERVER_ADDRESS, version=QUIC_VERSION)
 
 print("Sending CONNECTION_CLOSE frame to server.")
 
 try:
     while True:
-        ready = select.select([sock], [], [], TIME_THRESHOLD)
+        ready = select.select([sock], [], [], rtt.pto() if PTO_TIMEOUT is None else PTO_TIMEOUT)
         if ready[0]:
-            data_recv, addr = sock.recvfrom(BUFFER_SIZE)
+            data_recv, addr = sock.recvfrom(MAX_DATAGRAM_SIZE)
+
+            # Skip ACK packets that were still on their way
+            if not api.is_short_header(data_recv):
+                continue
 
             # parse the received data
-            parsed_packet = api.parse_quic_short_header_binary(data_recv)
-            parsed_frame = api.parse_quic_frame(parsed_packet['payload'])
+            parsed_packet = api.decode_quic_short_packet(data_recv, QUIC_VERSION)
+            parsed_frame = api.decode_quic_frame(parsed_packet['payload'], QUIC_VERSION)
             if parsed_frame['frame_type'] == 0x1c:
                 print("Received CONNECTION_CLOSE from the server.")
                 break
@@ -167,6 +304,7 @@ except BlockingIOError:
     pass
 
 sock.close()
+streams.close()
 
 print("Connection closed.\n")
 
@@ -179,10 +317,30 @@ total_time = end_time - start_time
 print(f"Total time is: {total_time:.6f} seconds")
 
 print("File Size:", FILE_SIZE, "bytes")
-bandwidth = FILE_SIZE / total_time / 8 / 1024 / 1024
+bandwidth = FILE_SIZE / total_time / 1024 / 1024
 print(f"Bandwidth: {bandwidth:.3f} MB/s\n")
 print(f"Unique packets: {total_packets}")
 print(f"Re-transmitted packets: {retransmit_counter}")
 print(f"Final packet number: {current_packet_number - 1}")
 print(f"Time retransmit counter: {time_retransmit_counter} ")
 print(f"Packet number retransmit counter: {packet_number_retransmit_counter}")
+# There is no minimum RTT without an RTT sample, and no ACK latency without an ACK
+min_rtt = "n/a" if rtt.min_rtt is None else f"{rtt.min_rtt * 1000:.3f}"
+print(f"Smoothed RTT: {rtt.smoothed_rtt * 1000:.3f} ms (min {min_rtt} ms, "
+      f"variance {rtt.rttvar * 1000:.3f} ms, {rtt.samples} samples)")
+ack_latencies.sort()
+p50, p99 = (api.percentile(ack_latencies, fraction) for fraction in (0.5, 0.99))
+print(f"ACK latency: p50 {'n/a' if p50 is None else f'{p50 * 1000:.3f}'} ms, "
+      f"p99 {'n/a' if p99 is None else f'{p99 * 1000:.3f}'} ms")
+print(f"Congestion controller: {congestion.name}, final window {congestion.congestion_window / 1024:.1f} KB, "
+      f"{congestion.congestion_events} congestion events")
+if PACING:
+    print(f"Pacing rate: {pacer.average_pacing_rate() / 1024 / 1024:.3f} MB/s average, "
+          f"{pacer.pacing_rate() / 1024 / 1024:.3f} MB/s final")
+else:
+    print("Pacing rate: off")
+print(f"Flow control: blocked {flow.data_blocked_sent} times on the connection and {flow.stream_data_blocked_sent} "
+      f"times on streams, {flow.updates_received} window updates received")
+if trace is not None:
+    trace.flush()
+    print(f"Trace: {trace.flushed} events traced to {args.trace}, {trace.dropped} overwritten")
@@ -1,171 +1,170 @@
+import select
 import socket
-from datetime import datetime, timedelta
+from datetime import datetime
 import QUIC_api as api
+import QUIC_connection
+import QUIC_flow
+import QUIC_io
+import QUIC_streams
 import argparse
+import os
 
 parser = argparse.ArgumentParser()
-parser.add_argument("-d", "--delay", type=int, default=20, help="The maximum time a receiver might delay sending an ACK")
+parser.add_argument("-d", "--delay", type=int, default=QUIC_connection.MAX_ACK_DELAY,
+                    help="The maximum time a receiver might delay sending an ACK")
+parser.add_argument("-a", "--ack-threshold", type=int, default=QUIC_connection.ACK_ELICITING_THRESHOLD,
+                    help="Send an ACK every this many ack-eliciting packets (default: 2).")
+parser.add_argument("-m", "--max-connections", type=int, default=1,
+                    help="Exit after this many connections were closed (default: 1). Enter 0 to serve forever.")
+parser.add_argument("-i", "--idle-timeout", type=float, default=QUIC_connection.IDLE_TIMEOUT,
+                    help="Close a connection that received nothing for this many seconds (default: 10).")
+parser.add_argument("-o", "--output-dir", default=None,
+                    help="Write every received stream to a file in this directory (default: discard the data).")
+parser.add_argument("--max-data", type=int, default=QUIC_flow.INITIAL_MAX_DATA,
+                    help="Connection flow control window in bytes (default: 4 MB).")
+parser.add_argument("--max-stream-data", type=int, default=QUIC_flow.INITIAL_MAX_STREAM_DATA,
+                    help="Stream flow control window in bytes (default: 1 MB).")
+parser.add_argument("--port", type=int, default=9997, help="The port to listen on (default: 9997).")
 args = parser.parse_args()
 
 # Server setup
 SERVER_IP = '127.0.0.1'
-SERVER_PORT = 9997
+SERVER_PORT = args.port
 BUFFER_SIZE = 2048
 
-# CIDs
-SERVER_CID = 2
-CLIENT_CID = None  # receive client_CID at handshake
-
-# Timeout for the server to wait for retransmission of clientHello before continuing
-RETRANSMISSION_TIMEOUT = 0.01
-
 # The maximum time a receiver might delay sending an ACK
 ACK_DELAY = args.delay  # in ms
 
+# Number of connections to serve before exiting (0: forever)
+MAX_CONNECTIONS = args.max_connections
+
 # Create UDP socket
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 sock.bind((SERVER_IP, SERVER_PORT))
+sock.setblocking(False)
 
 print(f"Server listening on {SERVER_IP}:{SERVER_PORT}")
 
-# QUIC handshake
-first_received = False
-
-while True:
-
-    try:
-        data_recv, addr = sock.recvfrom(BUFFER_SIZE)
-    except BlockingIOError:
-        continue
+if args.output_dir is not None:
+    os.makedirs(args.output_dir, exist_ok=True)
+
+# Connections keyed by the server CID they were given at the handshake
+connections = QUIC_connection.ConnectionTable(idle_timeout=args.idle_timeout, output_dir=args.output_dir,
+                                             max_data=args.max_data, max_stream_data=args.max_stream_data,
+                                             max_ack_delay=ACK_DELAY, ack_threshold=args.ack_threshold)
+closed_connections = 0
+total_ack_packets = 0
+
+# Datagrams of all the connections are received in batches
+batch_io = QUIC_io.BatchSocketIO(sock, buffer_size=BUFFER_SIZE)
+
+
+def close_connection(connection, reason):
+    global closed_connections, total_ack_packets
+    closed_connections += 1
+    total_ack_packets += connection.acks_sent
+    print(f"{reason}\nSent {connection.acks_sent} ack packets to client {connection.client_cid} "
+          f"({connection.ack.immediate_acks} without delay).")
+    print(f"Received {connection.frames_received} frames")
+    print(f"Flow control: sent {connection.flow.updates_sent} window updates, "
+          f"received {connection.flow.blocked_received} blocked frames")
+    for stream in sorted(connection.streams.values(), key=lambda stream: stream.stream_id):
+        if stream.complete:
+            print(f"Stream {stream.stream_id}: {stream.bytes_received} bytes (complete)")
+        else:
+            print(f"Stream {stream.stream_id}: {stream.bytes_received} bytes, missing {stream.missing_ranges()}")
+    print(f"Connection {connection.cid} closed\n")
 
-    # Checking if short header (not handshake packet) due to client hello packet loss
-    if data_recv[0] == ord(api.SHORT_HEADER_BIT):
-        if CLIENT_CID is None:
-            raise Exception("Client attempted to send packets before connection was established")
-        first_received = True
-        break
 
+def handle_hello(packet, addr, now):
     # Parse the received data
-    parsed_packet = api.parse_quic_long_header(data_recv)
-    CLIENT_CID = int(parsed_packet['scid'])
+    parsed_packet = api.parse_quic_long_header(bytes(packet))
     parsed_frame = api.parse_quic_frame(parsed_packet['payload'])
+    hello, shard, _ = api.parse_hello_data(parsed_frame['data'])
+    if hello != "ClientHello":
+        return
+
+    client_cid = int(parsed_packet['scid'], 2)
+    connection, new = connections.accept(client_cid, api.negotiate_version(parsed_packet['version']), addr, now,
+                                         shard)
+    if new:
+        print(f"Received ClientHello from CID: {client_cid}.")
+        if shard is not None:
+            print(f"Shard of transfer {shard[0]}: {shard[2]} bytes at offset {shard[1]} of {shard[3]}.")
+    else:
+        print(f"Received ClientHello retransmission from CID: {client_cid}.")
+
+    # A retransmitted ClientHello gets the same ServerHello again
+    api.send_hello_packet(socket=sock, streamID=0, dcid=client_cid, scid=connection.cid, side='Server', address=addr,
+                          version=connection.version, max_ack_delay=ACK_DELAY)
+    print(f"Sent ServerHello, connection {connection.cid}.\n")
+
+
+def handle_packet(packet, addr, now):
+    # Handshake packets
+    if not api.is_short_header(packet):
+        handle_hello(packet, addr, now)
+        return
+
+    # Find the connection from the DCID
+    connection = connections.get(api.short_header_dcid(packet))
+    if connection is None:
+        # The client attempted to send packets before the connection was established, or after it was closed
+        return
 
-    if parsed_frame['data'].decode() == "ClientHello":
-        print(f"Received ClientHello from CID: {CLIENT_CID}.")
-        api.send_hello_packet(socket=sock, streamID=0, dcid=CLIENT_CID, scid=SERVER_CID, side='Server', address=addr)
-        print("Sent ServerHello.\n")
-
-        # Set timeout for receiving ClientHello again
-        sock.settimeout(RETRANSMISSION_TIMEOUT)
-        try:
-            while True:
-                data_recv, addr = sock.recvfrom(BUFFER_SIZE)
-
-                # Checking if the received packet is ClientHello
-                if data_recv[0] == ord(api.SHORT_HEADER_BIT):
-                    first_received = True
-                    sock.settimeout(None)
-                    break
-
-        except socket.timeout:
-            print("ServerHello timeout. Waiting for retransmission of ClientHello...")
-            sock.settimeout(None)
-            continue
+    # parse the packet to receive the data
+    packet_parsed = api.decode_quic_short_packet(packet, connection.version, connection.largest_packet_number)
+    frame_parsed = api.decode_quic_frame(packet_parsed['payload'], connection.version)
 
-        break
+    if frame_parsed['frame_type'] == api.CONNECTION_CLOSE_FRAME:
+        print("File received successfully.")
+        print("Received CONNECTION_CLOSE frame from client.\nSending CONNECTION_CLOSE frame to client.")
+        api.send_connection_close_packet(socket=sock, streamID=0, dcid=connection.client_cid, packet_number=0,
+                                         address=connection.address, version=connection.version)
+        connections.remove(connection)
+        close_connection(connection, "Connection closed by the client.")
+        return
+
+    if QUIC_streams.is_stream_frame(frame_parsed['frame_type']):
+        # The ACK waits up to ACK_DELAY ms for more packets, unless enough arrived or one arrived out of order
+        if not connection.on_packet(packet_parsed['packet_number'], frame_parsed, now):
+            # The client sent past the limits it was given
+            api.send_connection_close_packet(socket=sock, streamID=0, dcid=connection.client_cid, packet_number=0,
+                                             address=connection.address, version=connection.version)
+            connections.remove(connection)
+            close_connection(connection, "Flow control error.")
+    elif frame_parsed['frame_type'] in (api.DATA_BLOCKED_FRAME, api.STREAM_DATA_BLOCKED_FRAME):
+        connection.on_blocked(packet_parsed['packet_number'], frame_parsed, now)
 
-print("Handshake completed.")
 
 # Main Loop
-ack_packet_number = 1
-TIMEOUT = 10
-timeout_flag = False
-# Set time out for the server socket. If no packet received in "timeout" seconds then we close the connection
-sock.settimeout(TIMEOUT)
-frames = []
-
-while True:
-    # Receive packet
-
-    try:
-        if first_received:  # if the first packet was already received while waiting
-            first_received = False
-            packet = data_recv
-        else:
-            packet, addr = sock.recvfrom(BUFFER_SIZE)
-
-    except socket.timeout:
-        timeout_flag = True
-        print("Timeout reached.")
-        break
-
-    # parse the packet to receive the data
-    packet_parsed = api.parse_quic_short_header_binary(packet)
-    packet_number = packet_parsed['packet_number']
-    packet_payload = packet_parsed['payload']
-    frame_parsed = api.parse_quic_frame(packet_payload)
-    frame_data = frame_parsed['data']
-    if frame_parsed['offset'] not in frames:
-        frames.append(frame_parsed['offset'])
-
-    if frame_parsed['frame_type'] == 0x1c:
-        print("File received successfully.")
-        print("Received CONNECTION_CLOSE frame from client.\nSending CONNECTION_CLOSE frame to client.")
-        break
-
-    if frame_parsed['frame_type'] == 0x08:
-        # Delay the ACK for ACK_DELAY ms in order to receive more packets and ACK them all at once
-        packets_received = [packet_number]  # initialize a list of received packet numbers
-        ack_delay_time = (datetime.now() + timedelta(milliseconds=ACK_DELAY)).timestamp()
-
-        while True:
-            curr_timeout = ack_delay_time - datetime.now().timestamp()  # Update the end of the delay
-            if curr_timeout < 0:
-                break
-            sock.settimeout(curr_timeout)
-            try:
-                packet, addr = sock.recvfrom(BUFFER_SIZE)
-
-                # Parse the packet to receive data
-                packet_parsed = api.parse_quic_short_header_binary(packet)
-                packet_number = packet_parsed['packet_number']
-                frame_parsed = api.parse_quic_frame(packet_parsed['payload'])
-                if frame_parsed['offset'] not in frames:
-                    frames.append(frame_parsed['offset'])
-
-                if packet_number not in packets_received:
-                    packets_received.append(packet_number)
-
-            except socket.timeout:
-                break
-            except BlockingIOError:
-                pass
-        sock.settimeout(TIMEOUT)
-
-        # Compress the list of received packet numbers into a list of ACK ranges
-        ack_ranges = []
-        i = 0
-        while i < len(packets_received):
-            left = packets_received[i]
-            while i < len(packets_received)-1 and packets_received[i]+1 == packets_received[i+1]:
-                i += 1
-            right = packets_received[i]
-            ack_ranges.append((left, right))
-            i += 1
-
-        # Create ACK packet and send to client
-        ack_packet = api.construct_quic_ack_packet(CLIENT_CID, ack_packet_number, ACK_DELAY, ack_ranges)
-        ack_packet_number += 1
-        sock.sendto(ack_packet.encode(), addr)
-
-
-if not timeout_flag:
-    api.send_connection_close_packet(socket=sock, streamID=0, dcid=CLIENT_CID, packet_number=0, address=addr)
+while not MAX_CONNECTIONS or closed_connections < MAX_CONNECTIONS:
+    # Sleep until a packet arrives, or until the next ACK or idle deadline
+    deadline = connections.next_deadline()
+    now = datetime.timestamp(datetime.now())
+    ready = select.select([sock], [], [], None if deadline is None else max(deadline - now, 0))
+
+    now = datetime.timestamp(datetime.now())
+    if ready[0]:
+        # Receive every waiting packet with a single system call
+        for packet, addr in batch_io.receive():
+            handle_packet(packet, addr, now)
+
+    # Create ACK packets and send them to the clients whose ACK is due, with the flow control updates
+    for connection in connections.due_acks(now):
+        ack_packet = connection.build_ack(now)
+        if ack_packet is not None:
+            sock.sendto(ack_packet, connection.address)
+        for update_packet in connection.build_window_updates():
+            sock.sendto(update_packet, connection.address)
+
+    # If no packet was received in the idle timeout then we close the connection
+    for connection in connections.evict_idle(now):
+        close_connection(connection, "Timeout reached.")
 
 # Generate statistics
-print(f"Sent {ack_packet_number - 1} ack packets to client.")
-print(f"Received {len(frames)} frames")
+print(f"Served {closed_connections} connections, sent {total_ack_packets} ack packets.")
 
 sock.close()
 
-print("Connection closed")
\ No newline at end of file
+print("Server closed")
@@ -1,11 +1,72 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from datetime import datetime
-import copy
+import itertools
+import math
 import select
+import struct
 
 
 SHORT_HEADER_BIT = '0'
 LONG_HEADER_BIT = '1'
 
+# Wire format versions, negotiated in the hello packets (which always use the bit-string format)
+QUIC_VERSION_BITSTRING = 1  # every header bit is sent as an ASCII '0'/'1' character
+QUIC_VERSION_BINARY = 2  # headers are packed into bytes with struct
+SUPPORTED_VERSIONS = (QUIC_VERSION_BITSTRING, QUIC_VERSION_BINARY)
+
+# Binary header layouts (network byte order). Apart from the version, every integer field is a variable-length
+# integer, and the packet number of a short header is truncated to 1-4 bytes.
+# Long header: first byte, version, DCID length, DCID, SCID length, SCID, payload length
+# Short header: first byte (with the packet number length in its two low bits), DCID, packet number
+# Frame header: frame type, stream ID, offset, data length
+# ACK packet: first byte, DCID, packet number, then the ACK frame
+VERSION_STRUCT = struct.Struct('!I')
+
+# Variable-length integers (RFC 9000, section 16): the two high bits of the first byte give the length
+VARINT_MAX = 2 ** 62 - 1
+VARINT_LENGTHS = ((2 ** 6, 1, 0x00), (2 ** 14, 2, 0x40), (2 ** 30, 4, 0x80), (2 ** 62, 8, 0xc0))
+
+# Truncated packet numbers (RFC 9000, section 17.1)
+MAX_PACKET_NUMBER_LENGTH = 4
+PACKET_NUMBER_LENGTH_MASK = 0x03
+
+# ACK packets are cut to this size so that they always fit in one datagram (RFC 9000, section 14)
+MAX_ACK_SIZE = 1200
+
+# First byte flags of the binary format. The bit-string format always starts with the ASCII character '0' or '1'.
+HEADER_FORM_FLAG = 0x80
+FIXED_BIT_FLAG = 0x40
+BITSTRING_FIRST_BYTES = (ord(SHORT_HEADER_BIT), ord(LONG_HEADER_BIT))
+
+# RTT estimation (RFC 9002), in seconds
+INITIAL_RTT = 0.333
+TIMER_GRANULARITY = 0.001
+TIME_THRESHOLD_FACTOR = 9 / 8
+
+# The recovery algorithms, as the trigger of a lost packet in a trace (the qlog packet_lost triggers)
+TIME_THRESHOLD_TRIGGER = 'time_threshold'
+PACKET_THRESHOLD_TRIGGER = 'reordering_threshold'
+PTO_TRIGGER = 'pto_expired'
+
+# Packets sent again when the PTO expires (RFC 9002, section 6.2.4)
+MAX_PROBE_PACKETS = 2
+
+# Frame types (RFC 9000, section 19). The flow control frames carry their limit in the offset field and no data.
+MAX_DATA_FRAME = 0x10
+MAX_STREAM_DATA_FRAME = 0x11
+DATA_BLOCKED_FRAME = 0x14
+STREAM_DATA_BLOCKED_FRAME = 0x15
+CONNECTION_CLOSE_FRAME = 0x1c
+FLOW_CONTROL_FRAMES = (MAX_DATA_FRAME, MAX_STREAM_DATA_FRAME, DATA_BLOCKED_FRAME, STREAM_DATA_BLOCKED_FRAME)
+
+# The most bytes the short header and the STREAM frame header of a data packet take, whatever the DCID, stream ID and
+# offset (see packet_overhead for the overhead of one connection)
+PACKET_OVERHEAD = {
+    QUIC_VERSION_BITSTRING: 252,  # 100 header bits + 152 frame bits
+    QUIC_VERSION_BINARY: 32,
+}
+
 def construct_quic_long_header(packet_type, version, dcid_num, scid_num, payload):
     """
     Constructs a simplified QUIC long header from string inputs.
@@ -72,7 +133,7 @@ def parse_quic_long_header(quic_long_header):
     }
 
 
-def construct_quic_short_header_binary(dcid, packet_number, payload):
+def construct_quic_short_header_binary(dcid, packet_number, payload, largest_acked=-1):
     """
     Constructs a representation of a QUIC short header using binary operations for the header fields.
 
@@ -80,6 +141,8 @@ def construct_quic_short_header_binary(dcid, packet_number, payload):
     - dcid: The Destination Connection ID as an integer.
     - packet_number: The packet number as an integer.
     - payload: The actual data payload as a string.
+    - largest_acked: The largest packet number the receiver ACKed (-1 if none), which sets how many bytes of the
+      packet number are sent.
 
     Returns:
     A binary string representing the packet with a short header, followed by the payload in text.
@@ -90,14 +153,14 @@ def construct_quic_short_header_binary(dcid, packet_number, payload):
     header_form = SHORT_HEADER_BIT  # 1 bit
     key_phase_bit = '0'  # 1 bit
 
-    # Convert dcid and packet_number to binary strings
-    # Here we assume dcid is represented with a fixed length for simplicity
-    dcid_bin = format(dcid, '064b')  # Assuming 8 bytes for DCID, represented in 64 bits
-    packet_number_bin = format(packet_number,
-                               '032b')  # Assuming up to 4 bytes for packet number, represented in 32 bits
+    # The DCID is a variable-length integer, and only the low bytes of the packet number are sent
+    length = packet_number_length(packet_number, largest_acked)
+    packet_number_length_bin = format(length - 1, '02b')  # 2 bits
+    dcid_bin = varint_bits(dcid)
+    packet_number_bin = format(truncate_packet_number(packet_number, length), f'0{8 * length}b')
 
     # Constructing the short header in binary
-    short_header_bin = header_form + key_phase_bit + dcid_bin + packet_number_bin
+    short_header_bin = header_form + key_phase_bit + packet_number_length_bin + dcid_bin + packet_number_bin
 
     # For simplicity, we concatenate the binary header and the string payload directly
     quic_packet_binary = short_header_bin + payload
@@ -105,12 +168,14 @@ def construct_quic_short_header_binary(dcid, packet_number, payload):
     return quic_packet_binary
 
 
-def parse_quic_short_header_binary(quic_packet_binary):
+def parse_quic_short_header_binary(quic_packet_binary, largest_packet_number=-1):
     """
     Parses a QUIC short header from a binary string representation, as constructed previously.
 
     Parameters:
     - quic_packet_binary: A binary string representing the packet with a short header, followed by a text payload.
+    - largest_packet_number: The largest packet number received so far (-1 if none), to recover the full packet
+      number from its truncated form.
 
     Returns:
     A dictionary with the parsed header components and payload.
@@ -119,17 +184,16 @@ def parse_quic_short_header_binary(quic_packet_binary):
     # Extracting the binary components from the header
     header_form = quic_packet_binary[0]  # 1 bit
     key_phase_bit = quic_packet_binary[1]  # 1 bit
+    length = int(quic_packet_binary[2:4], 2) + 1  # 2 bits for the packet number length
 
-    # Assuming fixed lengths for DCID and Packet Number as in construction
-    dcid_bin = quic_packet_binary[2:66]  # Next 64 bits for DCID
-    packet_number_bin = quic_packet_binary[66:98]  # Next 32 bits for Packet Number
-
-    # Convert binary components to their respective values
-    dcid = int(dcid_bin, 2)
-    packet_number = int(packet_number_bin, 2)
+    # The DCID is a variable-length integer, followed by the truncated packet number
+    dcid, position = parse_varint_bits(quic_packet_binary, 4)
+    packet_number_end = position + 8 * length
+    packet_number = decode_packet_number(int(quic_packet_binary[position:packet_number_end], 2), length,
+                                         largest_packet_number)
 
     # The remainder is the payload, still in string format
-    payload = quic_packet_binary[98:]
+    payload = quic_packet_binary[packet_number_end:]
 
     # Constructing and returning the parsed information
     parsed_header = {
@@ -157,11 +221,11 @@ def construct_quic_frame(frame_type, stream_id, offset, data):
     A binary string representing the frame.
     """
 
-    # Convert frame type, stream ID, and offset to binary strings
-    frame_type_bin = format(frame_type, '08b')  # Assuming 1 byte for frame type
-    stream_id_bin = format(stream_id, '032b')  # Assuming 4 bytes for stream ID
-    offset_bin = format(offset, '064b')  # Assuming 8 bytes for offset
-    data_length_bin = format(len(data), '016b')  # Assuming 2 bytes for data length
+    # Convert frame type, stream ID, offset and data length to variable-length integers in binary strings
+    frame_type_bin = varint_bits(frame_type)
+    stream_id_bin = varint_bits(stream_id)
+    offset_bin = varint_bits(offset)
+    data_length_bin = varint_bits(len(data))
 
     # Since we're keeping data as a string for simplicity, let's prepend it with its length in binary
     frame_binary = f"{frame_type_bin}{stream_id_bin}{offset_bin}{data_length_bin}{data}"
@@ -179,24 +243,15 @@ def parse_quic_frame(frame_binary):
     A dictionary with the parsed frame components.
     """
 
-    # Extract binary components
-    frame_type_bin = frame_binary[:8]  # 1 byte for frame type
-    stream_id_bin = frame_binary[8:40]  # 4 bytes for stream ID
-    offset_bin = frame_binary[40:104]  # 8 bytes for offset
-    data_length_bin = frame_binary[104:120]  # 2 bytes for data length
-    #print(frame_type_bin, stream_id_bin, offset_bin, data_length_bin)
-
-    # Convert binary components to integers
-    frame_type = int(frame_type_bin, 2)
-    stream_id = int(stream_id_bin, 2)
-    offset = int(offset_bin, 2)
-    data_length = int(data_length_bin, 2)
+    # Extract the variable-length integers, one after the other
+    frame_type, position = parse_varint_bits(frame_binary, 0)
+    stream_id, position = parse_varint_bits(frame_binary, position)
+    offset, position = parse_varint_bits(frame_binary, position)
+    data_length, position = parse_varint_bits(frame_binary, position)
 
-    # Extract the data payload as a string
+    # Extract the data payload as a string, one character per byte
     # Note: In a real implementation, this would be handled as binary data
-    data_start_index = 120  # Starting index of the data payload
-    data_end_index = data_start_index + data_length * 8  # Assuming 8 bits per character in the string for simplicity
-    data = frame_binary[data_start_index:data_end_index]
+    data = frame_binary[position:position + data_length]
 
     # Construct and return the parsed frame information
     parsed_frame = {
@@ -209,15 +264,187 @@ def parse_quic_frame(frame_binary):
 
     return parsed_frame
 
-def construct_quic_ack_packet(dcid, packet_number, ack_delay, ack_ranges):
+def varint_size(value):
+    """
+    :return: The number of bytes of the variable-length encoding of value
+    """
+    for limit, length, _ in VARINT_LENGTHS:
+        if value < limit:
+            return length
+    raise ValueError(f"{value} is too large for a variable-length integer")
+
+
+def encode_varint(value):
+    """
+    Encodes a variable-length integer (RFC 9000, section 16).
+
+    :return: 1, 2, 4 or 8 bytes
+    """
+    if value < 0x40:
+        return bytes((value,))
+    for limit, length, prefix in VARINT_LENGTHS:
+        if value < limit:
+            return (value | prefix << (8 * length - 8)).to_bytes(length, 'big')
+    raise ValueError(f"{value} is too large for a variable-length integer")
+
+
+def decode_varint(buffer, position=0):
+    """
+    Decodes a variable-length integer.
+
+    :param buffer: bytes, bytearray or memoryview
+    :param position: Where the integer starts in the buffer
+    :return: (value, the position right after the integer)
+    """
+    first = buffer[position]
+    if first < 0x40:
+        return first, position + 1
+    end = position + (1 << (first >> 6))
+    # The two prefix bits are the top bits of the integer
+    value = int.from_bytes(buffer[position:end], 'big')
+    return value & ((1 << (8 * (end - position) - 2)) - 1), end
+
+
+def varint_bits(value):
+    """
+    :return: The variable-length encoding of value as a bit string, 8 characters per byte
+    """
+    return ''.join(format(byte, '08b') for byte in encode_varint(value))
+
+
+def parse_varint_bits(bits, position=0):
+    """
+    Decodes a variable-length integer from a bit string.
+
+    :return: (value, the position right after the integer)
+    """
+    end = position + 8 * (1 << int(bits[position:position + 2], 2))
+    return int(bits[position + 2:end], 2), end
+
+
+def ack_frame_fields(ack_ranges):
+    """
+    Turns ACK ranges into the fields of an ACK frame (RFC 9000, section 19.3). The ranges are sent newest first: the
+    largest acknowledged packet number and the length of the first range, then a gap from the previous range and a
+    length for every older one. Ranges far from 0 take a few bytes instead of two absolute packet numbers.
+
+    :param ack_ranges: Disjoint inclusive (first, last) ranges, in any order, at least one
+    :return: (largest acknowledged, a tuple of fields per range, newest first)
+    """
+    if not ack_ranges:
+        raise ValueError("An ACK frame needs at least one range")
+    ack_ranges = sorted(ack_ranges, reverse=True)
+    largest, previous_first = ack_ranges[0][1], ack_ranges[0][0]
+    fields = [(largest - previous_first,)]
+    for first, last in ack_ranges[1:]:
+        fields.append((previous_first - last - 2, last - first))
+        previous_first = first
+    return largest, fields
+
+
+def fit_ack_ranges(range_sizes, room, unit=1):
+    """
+    Counts how many ranges, newest first, fit in an ACK packet. The first range is always sent.
+
+    :param range_sizes: The encoded size of every range, newest first
+    :param room: The space left after the fields before the range count
+    :param unit: The size of one byte of a variable-length integer (8 for bit strings)
+    :return: The number of ranges to send
+    """
+    used = range_sizes[0]
+    count = 1
+    for size in range_sizes[1:]:
+        # The range count field holds the number of ranges after the first
+        if used + size + varint_size(count) * unit > room:
+            break
+        used += size
+        count += 1
+    return count
+
+
+def ack_ranges_from_fields(largest, first_range, gaps_and_lengths):
+    """
+    Rebuilds the ACK ranges from the fields of an ACK frame.
+
+    :param gaps_and_lengths: An iterable of (gap, length) pairs
+    :return: An iterator over the inclusive (first, last) ranges, newest first
+    """
+    first = largest - first_range
+    yield first, largest
+    for gap, length in gaps_and_lengths:
+        last = first - gap - 2
+        first = last - length
+        yield first, last
+
+
+def packet_number_length(packet_number, largest_acked=-1):
+    """
+    Picks how many bytes of a packet number are sent: enough to cover twice the packets that may still be in flight
+    (RFC 9000, section 17.1).
+
+    :param largest_acked: The largest packet number the receiver ACKed, or -1 if none
+    :return: 1 to 4
+    """
+    unacked = packet_number - largest_acked
+    return min(max(((unacked.bit_length() + 1) + 7) // 8, 1), MAX_PACKET_NUMBER_LENGTH)
+
+
+def truncate_packet_number(packet_number, length):
+    """
+    :return: The low length bytes of the packet number
+    """
+    return packet_number & ((1 << (8 * length)) - 1)
+
+
+def decode_packet_number(truncated, length, largest_packet_number=-1):
+    """
+    Recovers a full packet number from its truncated form (RFC 9000, appendix A.3): the packet number closest to the
+    one after the largest received so far.
+
+    :param truncated: The packet number bytes that were sent
+    :param length: How many bytes were sent
+    :param largest_packet_number: The largest packet number received so far, or -1 if none
+    """
+    expected = largest_packet_number + 1
+    window = 1 << (8 * length)
+    half_window = window // 2
+    candidate = (expected & ~(window - 1)) | truncated
+    if candidate <= expected - half_window and candidate < (1 << 62) - window:
+        return candidate + window
+    if candidate > expected + half_window and candidate >= window:
+        return candidate - window
+    return candidate
+
+
+def packet_overhead(version, dcid, max_stream_id, max_offset):
+    """
+    The most bytes the short header and the STREAM frame header take in the data packets of one connection. The
+    variable-length fields take only the bytes their values need, so this is usually far below PACKET_OVERHEAD.
+
+    :param dcid: The DCID of the connection's packets
+    :param max_stream_id: The largest stream ID of the connection
+    :param max_offset: The largest offset of a STREAM frame, e.g. the size of the largest file
+    :return: The overhead in bytes (or in characters, for QUIC_VERSION_BITSTRING)
+    """
+    # The STREAM frame types are below 64, and the data of a packet is always shorter than 16384 bytes
+    header_bytes = varint_size(dcid) + MAX_PACKET_NUMBER_LENGTH
+    frame_bytes = 1 + varint_size(max_stream_id) + varint_size(max_offset) + 2
+    if version == QUIC_VERSION_BINARY:
+        return 1 + header_bytes + frame_bytes
+    # 4 bits before the DCID, and 8 characters per byte
+    return 4 + 8 * (header_bytes + frame_bytes)
+
+
+def construct_quic_ack_packet(dcid, packet_number, ack_delay, ack_ranges, max_size=MAX_ACK_SIZE):
     """
     Constructs a representation of a QUIC ack packets using binary operations for the header fields.
 
     Parameters:
     - dcid: The Destination Connection ID as an integer.
     - packet_number: The packet number as an integer.
-    - ack_delay: (in ms) The maximum time a receiver might delay sending an ACK.
+    - ack_delay: (in ms) How long the receiver held the ACK after the largest ACKed packet arrived.
     - ack_ranges: A list of pairs that represent the ACKed ranges.
+    - max_size: The most characters in the packet. The oldest ranges that don't fit are left out.
 
     Returns:
     A binary string representing the packet with an ACK packet.
@@ -228,21 +455,21 @@ def construct_quic_ack_packet(dcid, packet_number, ack_delay, ack_ranges):
     header_form = LONG_HEADER_BIT  # 1 bit
     key_phase_bit = '0'  # 1 bit
 
-    # Convert dcid and packet_number to binary strings
-    # Here we assume dcid is represented with a fixed length for simplicity
-    dcid_bin = format(dcid, '064b')  # Assuming 8 bytes for DCID, represented in 64 bits
-    packet_number_bin = format(packet_number, '032b')  # Assuming up to 4 bytes for packet number, represented in 32 bits
-    ack_delay_bin = format(ack_delay, '016b')  # Assuming up to 3 bytes for ACK delay in ms, represented in 16 bits
-    blocks_count = format(len(ack_ranges), '032b') # Assuming up to 4 bytes for number of ACK ranges, represented in 32 bits
+    # Convert dcid and packet_number to variable-length integers in binary strings
+    dcid_bin = varint_bits(dcid)
+    packet_number_bin = varint_bits(packet_number)
 
-    # Constructing the header in binary
-    quic_packet_binary = header_form + key_phase_bit + dcid_bin + packet_number_bin + ack_delay_bin + blocks_count
+    # The ACK frame fields are variable-length integers too
+    largest, fields = ack_frame_fields(ack_ranges)
+    ranges_bin = [''.join(varint_bits(field) for field in range_fields) for range_fields in fields]
 
-    # Constructing the ranges in binary
-    for ack_range in ack_ranges:  # Assuming up to 4 bytes for packet number, represented in 32 bits
-        quic_packet_binary += format(ack_range[0], '032b') + format(ack_range[1], '032b')
+    # Constructing the header in binary
+    quic_packet_binary = (header_form + key_phase_bit + dcid_bin + packet_number_bin + varint_bits(largest) +
+                          varint_bits(ack_delay))
 
-    return quic_packet_binary
+    # Only the newest ranges that fit in max_size are sent
+    count = fit_ack_ranges([len(range_bin) for range_bin in ranges_bin], max_size - len(quic_packet_binary), 8)
+    return quic_packet_binary + varint_bits(count - 1) + ''.join(ranges_bin[:count])
 
 
 def parse_quic_ack_packet(quic_packet_binary):
@@ -260,24 +487,22 @@ def parse_quic_ack_packet(quic_packet_binary):
     header_form = quic_packet_binary[0]  # 1 bit
     key_phase_bit = quic_packet_binary[1]  # 1 bit
 
-    # Assuming fixed lengths for DCID and Packet Number as in construction
-    dcid_bin = quic_packet_binary[2:66]  # Next 64 bits for DCID
-    packet_number_bin = quic_packet_binary[66:98]  # Next 32 bits for Packet Number
-
-    # Convert binary components to their respective values
-    dcid = int(dcid_bin, 2)
-    packet_number = int(packet_number_bin, 2)
+    # Every field after the first two bits is a variable-length integer
+    dcid, position = parse_varint_bits(quic_packet_binary, 2)
+    packet_number, position = parse_varint_bits(quic_packet_binary, position)
 
     # Parse the ACK fields
-    ack_delay = int(quic_packet_binary[98:114], 2)  # Next 16 bits are for ACK delay
-    blocks_count = int(quic_packet_binary[114:146], 2)  # Next 32 bits are for blocks count
-    ack_ranges = []
-    i = 0
-    while 210 + i*64 <= len(quic_packet_binary):
-        left = int(quic_packet_binary[146 + i*64: 178 + i*64], 2)
-        right = int(quic_packet_binary[178 + i*64: 210 + i*64], 2)
-        ack_ranges.append((left,right))
-        i += 1
+    largest_acknowledged, position = parse_varint_bits(quic_packet_binary, position)
+    ack_delay, position = parse_varint_bits(quic_packet_binary, position)
+    range_count, position = parse_varint_bits(quic_packet_binary, position)
+    first_range, position = parse_varint_bits(quic_packet_binary, position)
+    gaps_and_lengths = []
+    for _ in range(range_count):
+        gap, position = parse_varint_bits(quic_packet_binary, position)
+        length, position = parse_varint_bits(quic_packet_binary, position)
+        gaps_and_lengths.append((gap, length))
+    ack_ranges = list(ack_ranges_from_fields(largest_acknowledged, first_range, gaps_and_lengths))
+    blocks_count = range_count + 1
 
     # Constructing and returning the parsed information
     parsed_header = {
@@ -285,6 +510,7 @@ def parse_quic_ack_packet(quic_packet_binary):
         "key_phase_bit": int(key_phase_bit),
         "dcid": dcid,
         "packet_number": packet_number,
+        "largest_acknowledged": largest_acknowledged,
         "ack_delay": ack_delay,
         "blocks_count": blocks_count,
         "ack_ranges": ack_ranges
@@ -292,9 +518,596 @@ def parse_quic_ack_packet(quic_packet_binary):
 
     return parsed_header
 
-def send_hello_packet(socket, streamID, dcid, scid, side, address):
+def pack_quic_long_header(packet_type, version, dcid_num, scid_num, payload):
+    """
+    Constructs a binary QUIC long header. Mirrors construct_quic_long_header, but every field is packed into bytes.
+
+    Parameters:
+    - packet_type: the type of the packet
+    - version: the QUIC version this packet is in
+    - dcid_num: the destination connection ID as an integer
+    - scid_num: the source connection ID as an integer
+    - payload: the frame or frames that are sent with the packet as bytes
+
+    Returns:
+    The packet as bytes.
+    """
+    # Header Form (1) + Fixed Bit (1) + Long Packet Type (2 bits) + Reserved Bits (00) + Packet Number Length (11)
+    first_byte = HEADER_FORM_FLAG | FIXED_BIT_FLAG | (packet_type << 4) | 0x03
+    # The connection IDs take only the bytes they need, after their length
+    dcid = cid_bytes(int(dcid_num))
+    scid = cid_bytes(int(scid_num))
+    header = (bytes((first_byte,)) + VERSION_STRUCT.pack(version) + bytes((len(dcid),)) + dcid + bytes((len(scid),)) +
+              scid + encode_varint(len(payload)))
+    return header + payload
+
+
+def unpack_quic_long_header(packet):
+    """
+    Parses a binary QUIC long header, as constructed by pack_quic_long_header.
+
+    Parameters:
+    - packet: The packet as bytes, bytearray or memoryview.
+
+    Returns:
+    A dictionary with the parsed header components and payload.
+    """
+    first_byte = packet[0]
+    version, = VERSION_STRUCT.unpack_from(packet, 1)
+    position = 1 + VERSION_STRUCT.size
+    dcid_end = position + 1 + packet[position]
+    dcid = int.from_bytes(packet[position + 1:dcid_end], 'big')
+    scid_end = dcid_end + 1 + packet[dcid_end]
+    scid = int.from_bytes(packet[dcid_end + 1:scid_end], 'big')
+    payload_length, payload_start = decode_varint(packet, scid_end)
+
+    return {
+        'packet_type': (first_byte >> 4) & 0x03,
+        'type_specific_bits': first_byte & 0x0f,
+        'version': version,
+        'dcid': dcid,
+        'scid': scid,
+        'payload': bytes(packet[payload_start:payload_start + payload_length])
+    }
+
+
+def pack_quic_short_header(dcid, packet_number, payload, largest_acked=-1):
+    """
+    Constructs a binary QUIC short header followed by the payload.
+
+    Parameters:
+    - dcid: The Destination Connection ID as an integer.
+    - packet_number: The packet number as an integer.
+    - payload: The frame or frames as bytes.
+    - largest_acked: The largest packet number the receiver ACKed (-1 if none), which sets how many bytes of the
+      packet number are sent.
+
+    Returns:
+    The packet as bytes.
+    """
+    length = packet_number_length(packet_number, largest_acked)
+    # Header Form (0), Key Phase Bit (assuming 0) and the packet number length share the first byte
+    return (bytes((length - 1,)) + encode_varint(dcid) +
+            truncate_packet_number(packet_number, length).to_bytes(length, 'big') + payload)
+
+
+def unpack_quic_short_header(packet, largest_packet_number=-1):
+    """
+    Parses a binary QUIC short header, as constructed by pack_quic_short_header.
+
+    Parameters:
+    - packet: The packet as bytes, bytearray or memoryview.
+    - largest_packet_number: The largest packet number received so far (-1 if none).
+
+    Returns:
+    A dictionary with the parsed header components and payload.
+    """
+    view = QuicShortPacketView(packet, largest_packet_number)
+
+    return {
+        "header_form": view.header_form,
+        "key_phase_bit": view.key_phase_bit,
+        "dcid": view.dcid,
+        "packet_number": view.packet_number,
+        "payload": bytes(view.payload)
+    }
+
+
+def pack_quic_frame(frame_type, stream_id, offset, data):
+    """
+    Constructs a binary QUIC frame.
+
+    Parameters:
+    - frame_type: An integer representing the frame type.
+    - stream_id: An integer representing the stream identifier.
+    - offset: An integer representing the data offset in this stream.
+    - data: The actual data payload as bytes (a str is encoded first).
+
+    Returns:
+    The frame as bytes.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    return pack_frame_header(frame_type, stream_id, offset, len(data)) + data
+
+
+def pack_frame_header(frame_type, stream_id, offset, data_length):
+    """
+    :return: The header of a binary frame, four variable-length integers
+    """
+    return encode_varint(frame_type) + encode_varint(stream_id) + encode_varint(offset) + encode_varint(data_length)
+
+
+def unpack_quic_frame(frame):
+    """
+    Parses a binary QUIC frame, as constructed by pack_quic_frame.
+
+    Parameters:
+    - frame: The frame as bytes, bytearray or memoryview.
+
+    Returns:
+    A dictionary with the parsed frame components.
+    """
+    view = QuicFrameView(frame)
+
+    return {
+        "frame_type": view.frame_type,
+        "stream_id": view.stream_id,
+        "offset": view.offset,
+        "data_length": view.data_length,
+        "data": bytes(view.data)
+    }
+
+
+def pack_quic_ack_packet(dcid, packet_number, ack_delay, ack_ranges, max_size=MAX_ACK_SIZE):
     """
-    Sends an hello packet with a single frame.
+    Constructs a binary QUIC ACK packet.
+
+    Parameters:
+    - dcid: The Destination Connection ID as an integer.
+    - packet_number: The packet number as an integer.
+    - ack_delay: (in ms) How long the receiver held the ACK after the largest ACKed packet arrived.
+    - ack_ranges: A list of pairs that represent the ACKed ranges.
+    - max_size: The most bytes in the packet. The oldest ranges that don't fit are left out.
+
+    Returns:
+    The ACK packet as bytes.
+    """
+    largest, fields = ack_frame_fields(ack_ranges)
+    encoded_ranges = [b''.join(encode_varint(field) for field in range_fields) for range_fields in fields]
+
+    # Header Form (1) and Key Phase Bit (0), then variable-length integers
+    header = (bytes((HEADER_FORM_FLAG,)) + encode_varint(dcid) + encode_varint(packet_number) + encode_varint(largest) +
+              encode_varint(ack_delay))
+    count = fit_ack_ranges([len(encoded) for encoded in encoded_ranges], max_size - len(header))
+    return header + encode_varint(count - 1) + b''.join(encoded_ranges[:count])
+
+
+def unpack_quic_ack_packet(packet):
+    """
+    Parses a binary QUIC ACK packet, as constructed by pack_quic_ack_packet.
+
+    Parameters:
+    - packet: The packet as bytes, bytearray or memoryview.
+
+    Returns:
+    A dictionary with the parsed header components.
+    """
+    view = QuicAckPacketView(packet)
+    dcid, packet_number, largest_acknowledged, ack_delay, range_count, _ = view.fields()
+    ack_ranges = view.ack_ranges
+    blocks_count = range_count + 1
+
+    return {
+        "header_form": view.header_form,
+        "key_phase_bit": view.key_phase_bit,
+        "dcid": dcid,
+        "packet_number": packet_number,
+        "largest_acknowledged": largest_acknowledged,
+        "ack_delay": ack_delay,
+        "blocks_count": blocks_count,
+        "ack_ranges": ack_ranges
+    }
+
+
+class QuicShortPacketView:
+    """
+    A zero-copy view of a binary short header packet. The header is decoded once, when the view is made, and the
+    payload is a memoryview into the receive buffer, so the buffer must not be reused while the view is in use.
+    Supports view['field'] so it can be used wherever the dictionary returned by unpack_quic_short_header is.
+    """
+    __slots__ = ('buffer', 'dcid', 'packet_number', 'payload_start')
+
+    def __init__(self, buffer, largest_packet_number=-1):
+        """
+        :param largest_packet_number: The largest packet number received so far (-1 if none), to recover the full
+        packet number
+        """
+        self.buffer = buffer = memoryview(buffer)
+        length = (buffer[0] & PACKET_NUMBER_LENGTH_MASK) + 1
+        self.dcid, position = decode_varint(buffer, 1)
+        self.payload_start = position + length
+        self.packet_number = decode_packet_number(int.from_bytes(buffer[position:self.payload_start], 'big'), length,
+                                                  largest_packet_number)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def header_form(self):
+        return self.buffer[0] >> 7
+
+    @property
+    def key_phase_bit(self):
+        return (self.buffer[0] >> 6) & 0x01
+
+    @property
+    def payload(self):
+        return self.buffer[self.payload_start:]
+
+    def frame(self):
+        """
+        :return: A QuicFrameView of the frame carried in the payload
+        """
+        return QuicFrameView(self.payload)
+
+
+class QuicFrameView:
+    """
+    A zero-copy view of a binary frame. The header is decoded once, when the view is made, and the data is a
+    memoryview into the buffer the frame was received in.
+    Supports view['field'] so it can be used wherever the dictionary returned by unpack_quic_frame is.
+    """
+    __slots__ = ('buffer', 'frame_type', 'stream_id', 'offset', 'data_length', 'data_start')
+
+    def __init__(self, buffer):
+        self.buffer = buffer = memoryview(buffer)
+        self.frame_type, position = decode_varint(buffer, 0)
+        self.stream_id, position = decode_varint(buffer, position)
+        self.offset, position = decode_varint(buffer, position)
+        self.data_length, self.data_start = decode_varint(buffer, position)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def data(self):
+        return self.buffer[self.data_start:self.data_start + self.data_length]
+
+
+class QuicAckPacketView:
+    """
+    A zero-copy view of a binary ACK packet. The ranges are decoded straight from the receive buffer.
+    Supports view['field'] so it can be used wherever the dictionary returned by unpack_quic_ack_packet is.
+    """
+    __slots__ = ('buffer', '_fields')
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self._fields = None
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def header_form(self):
+        return self.buffer[0] >> 7
+
+    @property
+    def key_phase_bit(self):
+        return (self.buffer[0] >> 6) & 0x01
+
+    def fields(self):
+        """
+        :return: (DCID, packet number, largest acknowledged, ACK delay, ACK range count, the position of the first ACK
+        range)
+        """
+        if self._fields is None:
+            buffer = self.buffer
+            dcid, position = decode_varint(buffer, 1)
+            packet_number, position = decode_varint(buffer, position)
+            largest_acknowledged, position = decode_varint(buffer, position)
+            ack_delay, position = decode_varint(buffer, position)
+            range_count, position = decode_varint(buffer, position)
+            self._fields = (dcid, packet_number, largest_acknowledged, ack_delay, range_count, position)
+        return self._fields
+
+    @property
+    def dcid(self):
+        return self.fields()[0]
+
+    @property
+    def packet_number(self):
+        return self.fields()[1]
+
+    @property
+    def largest_acknowledged(self):
+        return self.fields()[2]
+
+    @property
+    def ack_delay(self):
+        return self.fields()[3]
+
+    @property
+    def blocks_count(self):
+        return self.fields()[4] + 1
+
+    def iter_ack_ranges(self):
+        """
+        :return: An iterator over the (first, last) ACKed ranges, newest first as they were sent
+        """
+        _, _, largest_acknowledged, _, range_count, position = self.fields()
+        buffer = self.buffer
+        first_range, position = decode_varint(buffer, position)
+
+        def gaps_and_lengths(position):
+            for _ in range(range_count):
+                gap, position = decode_varint(buffer, position)
+                length, position = decode_varint(buffer, position)
+                yield gap, length
+
+        return ack_ranges_from_fields(largest_acknowledged, first_range, gaps_and_lengths(position))
+
+    @property
+    def ack_ranges(self):
+        return list(self.iter_ack_ranges())
+
+
+def negotiate_version(offered_version):
+    """
+    Picks the wire format version to use for a connection.
+
+    :param offered_version: The version the client asked for in its hello packet
+    :return: The highest supported version that isn't newer than the offered one
+    """
+    return max([version for version in SUPPORTED_VERSIONS if version <= offered_version],
+               default=QUIC_VERSION_BITSTRING)
+
+
+def is_short_header(packet):
+    """
+    Checks whether a received datagram carries a short header, in either wire format.
+
+    :param packet: The received datagram
+    :return: True for short header packets, False for long header and ACK packets
+    """
+    first_byte = packet[0]
+    if first_byte in BITSTRING_FIRST_BYTES:
+        return first_byte == ord(SHORT_HEADER_BIT)
+    return not first_byte & HEADER_FORM_FLAG
+
+
+def is_long_header(packet):
+    """
+    Checks whether a received datagram carries a long header (an hello), rather than a short header or an ACK. Long
+    headers are always bit strings, starting with the header form and fixed bits '11', where a bit-string ACK starts
+    with '10'. Binary ACKs have the header form flag without the fixed bit.
+
+    :param packet: The received datagram
+    :return: True for long header packets
+    """
+    first_byte = packet[0]
+    if first_byte in BITSTRING_FIRST_BYTES:
+        return first_byte == ord(LONG_HEADER_BIT) and packet[1] == ord('1')
+    return first_byte & (HEADER_FORM_FLAG | FIXED_BIT_FLAG) == HEADER_FORM_FLAG | FIXED_BIT_FLAG
+
+
+def short_header_dcid(packet):
+    """
+    Reads the DCID of a received short header packet in either wire format, before its connection (and so its version)
+    is known.
+
+    :param packet: A datagram for which is_short_header is True
+    :return: The DCID as an integer
+    """
+    if packet[0] in BITSTRING_FIRST_BYTES:
+        # The DCID follows the first 4 bits, and is at most 64 bits long
+        return parse_varint_bits(bytes(packet[4:68]).decode('latin-1'), 0)[0]
+    return decode_varint(packet, 1)[0]
+
+
+def cid_bytes(cid):
+    """
+    :return: A connection ID as the fewest bytes that hold it, for the long header
+    """
+    return cid.to_bytes(max((cid.bit_length() + 7) // 8, 1), 'big')
+
+
+def encode_quic_frame(frame_type, stream_id, offset, data, version=QUIC_VERSION_BITSTRING):
+    """
+    Constructs a frame in the given wire format version.
+
+    :return: A bit string for QUIC_VERSION_BITSTRING, bytes for QUIC_VERSION_BINARY
+    """
+    if version == QUIC_VERSION_BINARY:
+        return pack_quic_frame(frame_type, stream_id, offset, data)
+    if not isinstance(data, str):
+        # Bit-string frames carry their data as text, one character per byte
+        data = bytes(data).decode('latin-1')
+    return construct_quic_frame(frame_type, stream_id, offset, data)
+
+
+def encode_flow_control_frame(frame_type, limit, stream_id=0, version=QUIC_VERSION_BITSTRING):
+    """
+    Constructs a MAX_DATA, MAX_STREAM_DATA, DATA_BLOCKED or STREAM_DATA_BLOCKED frame.
+
+    :param limit: The new limit, or the limit the sender is blocked at, in bytes
+    :param stream_id: The stream of the stream-level frames
+    """
+    return encode_quic_frame(frame_type, stream_id, limit, '', version)
+
+
+def decode_quic_frame(frame, version=QUIC_VERSION_BITSTRING):
+    """
+    Parses a frame in the given wire format version.
+
+    :return: A dictionary with the parsed frame components, or a QuicFrameView for QUIC_VERSION_BINARY
+    """
+    if version == QUIC_VERSION_BINARY:
+        return QuicFrameView(frame)
+    return parse_quic_frame(frame)
+
+
+def encode_quic_short_packet(dcid, packet_number, payload, version=QUIC_VERSION_BITSTRING, largest_acked=-1):
+    """
+    Constructs a short header packet in the given wire format version, ready to be sent.
+
+    :param payload: A frame as returned by encode_quic_frame with the same version
+    :param largest_acked: The largest packet number the receiver ACKed, or -1 if none
+    :return: The packet as bytes
+    """
+    if version == QUIC_VERSION_BINARY:
+        return pack_quic_short_header(dcid, packet_number, payload, largest_acked)
+    # One byte per character, so that data bytes above 0x7f stay one byte on the wire
+    return construct_quic_short_header_binary(dcid, packet_number, payload, largest_acked).encode('latin-1')
+
+
+def decode_quic_short_packet(packet, version=QUIC_VERSION_BITSTRING, largest_packet_number=-1):
+    """
+    Parses a received short header packet in the given wire format version.
+
+    :param largest_packet_number: The largest packet number received so far, or -1 if none
+    :return: A dictionary with the parsed header components and payload, or a QuicShortPacketView for
+    QUIC_VERSION_BINARY
+    """
+    if version == QUIC_VERSION_BINARY:
+        return QuicShortPacketView(packet, largest_packet_number)
+    if not isinstance(packet, str):
+        packet = bytes(packet).decode('latin-1')
+    return parse_quic_short_header_binary(packet, largest_packet_number)
+
+
+def encode_quic_ack_packet(dcid, packet_number, ack_delay, ack_ranges, version=QUIC_VERSION_BITSTRING):
+    """
+    Constructs an ACK packet in the given wire format version, ready to be sent.
+
+    :return: The packet as bytes
+    """
+    if version == QUIC_VERSION_BINARY:
+        return pack_quic_ack_packet(dcid, packet_number, ack_delay, ack_ranges)
+    return construct_quic_ack_packet(dcid, packet_number, ack_delay, ack_ranges).encode()
+
+
+def decode_quic_ack_packet(packet, version=QUIC_VERSION_BITSTRING):
+    """
+    Parses a received ACK packet in the given wire format version.
+
+    :return: A dictionary with the parsed header components, or a QuicAckPacketView for QUIC_VERSION_BINARY
+    """
+    if version == QUIC_VERSION_BINARY:
+        return QuicAckPacketView(packet)
+    if isinstance(packet, memoryview):
+        packet = packet.tobytes()
+    return parse_quic_ack_packet(packet)
+
+
+class PacketEncoder:
+    """
+    Builds the short header packets of one connection. The DCID never changes, so it is encoded once, and every packet
+    only adds its packet number and copies its frame. In the binary format every frame is written at the same place in
+    the buffer, right after the longest possible header, and the header is written just before it: the packets are
+    memoryviews into the encoder's buffers, and a packet stays valid until buffer_count more packets are encoded.
+    """
+    __slots__ = ('dcid', 'version', 'buffers', 'views', 'next_buffer', 'dcid_bits', 'header_prefixes', 'frame_start')
+
+    def __init__(self, dcid, version=QUIC_VERSION_BITSTRING, buffer_count=1, max_size=2048):
+        """
+        :param dcid: The DCID of every packet
+        :param version: The negotiated wire format version
+        :param buffer_count: How many packets may be in use at the same time (e.g. one batch)
+        :param max_size: The largest packet size
+        """
+        self.dcid = dcid
+        self.version = version
+        self.dcid_bits = varint_bits(dcid)
+        # The first byte and the DCID, for every packet number length
+        dcid_bytes = encode_varint(dcid)
+        self.header_prefixes = [None] + [bytes((length - 1,)) + dcid_bytes
+                                         for length in range(1, MAX_PACKET_NUMBER_LENGTH + 1)]
+        self.frame_start = 1 + len(dcid_bytes) + MAX_PACKET_NUMBER_LENGTH
+        self.buffers = [bytearray(self.frame_start + max_size) for _ in range(buffer_count)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.next_buffer = 0
+
+    def encode(self, packet_number, frame, largest_acked=-1):
+        """
+        :param packet_number: The packet number
+        :param frame: A frame encoded in the encoder's version, or a frame reference with frame_type, stream_id, offset
+        and data attributes
+        :param largest_acked: The largest packet number the receiver ACKed, or -1 if none
+        :return: The packet, as bytes for QUIC_VERSION_BITSTRING and as a memoryview for QUIC_VERSION_BINARY
+        """
+        length = packet_number_length(packet_number, largest_acked)
+        truncated = truncate_packet_number(packet_number, length)
+        if self.version != QUIC_VERSION_BINARY:
+            if not isinstance(frame, (str, bytes, bytearray, memoryview)):
+                frame = encode_quic_frame(frame.frame_type, frame.stream_id, frame.offset, frame.data, self.version)
+            # Header Form and Key Phase Bit, the packet number length, the DCID and the packet number
+            return (SHORT_HEADER_BIT + '0' + format(length - 1, '02b') + self.dcid_bits +
+                    format(truncated, f'0{8 * length}b') + frame).encode('latin-1')
+
+        buffer = self.buffers[self.next_buffer]
+        view = self.views[self.next_buffer]
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+
+        # The header ends where the frame starts
+        header = self.header_prefixes[length] + truncated.to_bytes(length, 'big')
+        position = self.frame_start
+        start = position - len(header)
+        buffer[start:position] = header
+        if isinstance(frame, (bytes, bytearray, memoryview)):
+            end = position + len(frame)
+            buffer[position:end] = frame
+        else:
+            # A frame reference: write the frame header, and copy the data straight from its source
+            data = frame.data
+            header = pack_frame_header(frame.frame_type, frame.stream_id, frame.offset, len(data))
+            buffer[position:position + len(header)] = header
+            position += len(header)
+            end = position + len(data)
+            buffer[position:end] = data
+        return view[start:end]
+
+
+def hello_data(side, shard=None, max_ack_delay=None):
+    """
+    :param side: 'Server' or 'Client'
+    :param shard: (transfer ID, offset, size, total size) if the connection sends one shard of a larger file
+    :param max_ack_delay: The longest the server delays an ACK, in ms, so the client's PTO covers it
+    :return: The data of an hello frame: ClientHello or ServerHello, followed by the metadata there is
+    """
+    data = side + "Hello"
+    if max_ack_delay is not None:
+        data += f" max_ack_delay={max_ack_delay}"
+    if shard is not None:
+        data += " shard=" + ",".join(str(value) for value in shard)
+    return data
+
+
+def parse_hello_data(data):
+    """
+    Parses the data of an hello frame, as built by hello_data.
+
+    :return: (ClientHello or ServerHello, the shard metadata tuple or None, the max ACK delay in ms or None)
+    """
+    if not isinstance(data, str):
+        data = bytes(data).decode()
+    hello, *fields = data.split(' ')
+    shard = max_ack_delay = None
+    for field in fields:
+        name, _, value = field.partition('=')
+        if name == 'shard':
+            shard = tuple(int(value) for value in value.split(','))
+        elif name == 'max_ack_delay':
+            max_ack_delay = int(value)
+    return hello, shard, max_ack_delay
+
+
+def send_hello_packet(socket, streamID, dcid, scid, side, address, version=QUIC_VERSION_BITSTRING, shard=None,
+                      max_ack_delay=None):
+    """
+    Sends an hello packet with a single frame. Hello packets always use the bit-string format, so that the version
+    field can be read before the wire format is agreed on.
 
     Parameters:
     - socket: The socket used for sending the packet.
@@ -303,6 +1116,9 @@ def send_hello_packet(socket, streamID, dcid, scid, side, address):
     - scid: Source CID as an integer.
     - side: A string represnting the side of the connection: 'Server' or 'Client'.
     - address: (destination IP , destination port)
+    - version: The wire format version offered by the client, or chosen by the server.
+    - shard: The shard metadata of a ClientHello, as in hello_data.
+    - max_ack_delay: The server's max ACK delay in ms, sent in a ServerHello.
     """
 
     """
@@ -310,18 +1126,18 @@ def send_hello_packet(socket, streamID, dcid, scid, side, address):
     frame type 6 is being used for handshake
     offset is 0
     """
-    hello_frame = construct_quic_frame(6, streamID, 0, side + "Hello")
+    hello_frame = construct_quic_frame(6, streamID, 0, hello_data(side, shard, max_ack_delay))
 
     """
     ---Construct Hello packet---
     packet type is 0
-    version is 1
+    version is the offered/negotiated wire format version
     payload is hello_frame
     """
-    hello_packet = construct_quic_long_header(0, 1, dcid, scid, hello_frame)
+    hello_packet = construct_quic_long_header(0, version, dcid, scid, hello_frame)
     socket.sendto(hello_packet.encode(), address)
 
-def send_connection_close_packet(socket, streamID, dcid, packet_number, address):
+def send_connection_close_packet(socket, streamID, dcid, packet_number, address, version=QUIC_VERSION_BITSTRING):
     """
     Sends an connection_close packet with a single frame.
 
@@ -330,6 +1146,7 @@ def send_connection_close_packet(socket, streamID, dcid, packet_number, address)
     - streamID: The ID of the stream the packet is being sent on.
     - dcid: Destination CID as an integer.
     - address: (destination IP , destination port)
+    - version: The negotiated wire format version.
     """
 
     """
@@ -338,143 +1155,565 @@ def send_connection_close_packet(socket, streamID, dcid, packet_number, address)
     offset is 0
     data is 'CONNECTION_CLOSE'
     """
-    connection_close_frame = construct_quic_frame(0x1c, streamID, 0, "CONNECTION_CLOSE")
+    connection_close_frame = encode_quic_frame(0x1c, streamID, 0, "CONNECTION_CLOSE", version)
 
 
     # ---Construct CONNECTION_CLOSE packet---
-    connection_close_packet = construct_quic_short_header_binary(dcid, packet_number, connection_close_frame)
+    connection_close_packet = encode_quic_short_packet(dcid, packet_number, connection_close_frame, version)
+
+    socket.sendto(connection_close_packet, address)
+
 
-    socket.sendto(connection_close_packet.encode(), address)
+def percentile(values, fraction):
+    """
+    :param values: A sorted list
+    :param fraction: Between 0 and 1, e.g. 0.99 for the 99th percentile
+    :return: The nearest-rank percentile of the values, or None if there are none
+    """
+    if not values:
+        return None
+    return values[min(max(math.ceil(fraction * len(values)) - 1, 0), len(values) - 1)]
 
 
-def time_based_recovery(sock, address, packet_queue, last_ack_time, current_packet_number, time_threshold):
+class RttEstimator:
+    """
+    Estimates the round trip time from ACK arrivals, as described in RFC 9002, and derives the loss detection
+    thresholds from it. All times are in seconds.
+    """
+    __slots__ = ('latest_rtt', 'smoothed_rtt', 'rttvar', 'min_rtt', 'max_ack_delay', 'samples')
+
+    def __init__(self, initial_rtt=INITIAL_RTT, max_ack_delay=0):
+        """
+        :param max_ack_delay: The peer's max ACK delay, if known; the ACK delays it reports can only raise it
+        """
+        self.latest_rtt = initial_rtt
+        self.smoothed_rtt = initial_rtt
+        self.rttvar = initial_rtt / 2
+        self.min_rtt = None
+        self.max_ack_delay = max_ack_delay
+        self.samples = 0
+
+    def update(self, latest_rtt, ack_delay=0):
+        """
+        Adds an RTT sample.
+
+        :param latest_rtt: Time from sending the largest newly ACKed packet until its ACK arrived
+        :param ack_delay: The ACK delay reported by the receiver, subtracted when the sample allows it
+        """
+        self.latest_rtt = latest_rtt
+        self.max_ack_delay = max(self.max_ack_delay, ack_delay)
+        self.samples += 1
+
+        if self.min_rtt is None:
+            self.min_rtt = latest_rtt
+            self.smoothed_rtt = latest_rtt
+            self.rttvar = latest_rtt / 2
+            return
+
+        self.min_rtt = min(self.min_rtt, latest_rtt)
+        adjusted_rtt = latest_rtt
+        if latest_rtt - ack_delay >= self.min_rtt:
+            adjusted_rtt = latest_rtt - ack_delay
+        self.rttvar = 3 / 4 * self.rttvar + 1 / 4 * abs(self.smoothed_rtt - adjusted_rtt)
+        self.smoothed_rtt = 7 / 8 * self.smoothed_rtt + 1 / 8 * adjusted_rtt
+
+    def time_threshold(self):
+        """
+        :return: How long before the last ACK a packet must have been sent to be declared lost
+        """
+        return max(TIME_THRESHOLD_FACTOR * max(self.smoothed_rtt, self.latest_rtt), TIMER_GRANULARITY)
+
+    def pto(self):
+        """
+        :return: The probe timeout for the tail packets
+        """
+        return self.smoothed_rtt + max(4 * self.rttvar, TIMER_GRANULARITY) + self.max_ack_delay
+
+
+class RangeSet:
+    """
+    A set of integers stored as sorted, disjoint [start, end) ranges. Adjacent ranges are merged, so packet numbers
+    received in order, or a fully received file, take a single range. Lookups are binary searches, and the merged
+    ranges can be sent in an ACK packet as they are.
+    """
+    __slots__ = ('starts', 'ends', 'total')
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.total = 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __contains__(self, value):
+        i = bisect_right(self.starts, value) - 1
+        return i >= 0 and value < self.ends[i]
+
+    def clear(self):
+        self.starts = []
+        self.ends = []
+        self.total = 0
+
+    def add(self, start, end=None):
+        """
+        Adds the range [start, end), or the single value start.
+
+        :return: The parts of the range that weren't in the set yet, as a list of (start, end)
+        """
+        if end is None:
+            end = start + 1
+        if start >= end:
+            return []
+        # Appending right after the last range is the common case, for packet numbers and offsets alike
+        if self.ends and self.ends[-1] == start:
+            self.ends[-1] = end
+            self.total += end - start
+            return [(start, end)]
+
+        # The ranges that overlap or touch [start, end) are i..j-1
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end)
+
+        new_ranges = []
+        cursor = start
+        for k in range(i, j):
+            if self.starts[k] > cursor:
+                new_ranges.append((cursor, self.starts[k]))
+            cursor = max(cursor, self.ends[k])
+        if cursor < end:
+            new_ranges.append((cursor, end))
+
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+        self.total += sum(new_end - new_start for new_start, new_end in new_ranges)
+        return new_ranges
+
+    def covers(self, start, end):
+        """
+        :return: True if all of [start, end) is in the set
+        """
+        i = bisect_right(self.starts, start) - 1
+        return start >= end or (i >= 0 and self.ends[i] >= end)
+
+    def missing(self, end):
+        """
+        :return: The gaps in [0, end), as a list of (start, end)
+        """
+        gaps = []
+        cursor = 0
+        for range_start, range_end in self:
+            if range_start >= end:
+                break
+            if range_start > cursor:
+                gaps.append((cursor, range_start))
+            cursor = max(cursor, range_end)
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def ack_ranges(self):
+        """
+        :return: The ranges as inclusive (first, last) pairs, as ACK packets carry them
+        """
+        return [(start, end - 1) for start, end in self]
+
+    def keep_last(self, count):
+        """
+        Drops all but the last count ranges.
+        """
+        if len(self.starts) <= count:
+            return
+        dropped = len(self.starts) - count
+        self.total -= sum(end - start for start, end in zip(self.starts[:dropped], self.ends[:dropped]))
+        del self.starts[:dropped]
+        del self.ends[:dropped]
+
+
+class SentPacket:
+    """
+    A packet that was sent and isn't ACKed yet. Only its frame is kept, apart from the header: either the encoded frame,
+    or a reference to where the frame's data is. A retransmission puts the frame under a new header.
+    """
+    __slots__ = ('packet_number', 'send_time', 'frame', 'size')
+
+    def __init__(self, packet_number, send_time, frame, size):
+        self.packet_number = packet_number
+        self.send_time = send_time
+        self.frame = frame
+        self.size = size
+
+
+class SentPacketMap:
+    """
+    The packets in flight, keyed by packet number. Packet numbers only grow and every retransmission gets a new one,
+    so the insertion order is also the send time order: the oldest packet is always first. ACKed packets are removed
+    right away, so marking a packet as ACKed and retransmitting it are both O(1). It also counts the PTO expiries since
+    the last ACK that ACKed something, for the PTO backoff.
+    """
+    __slots__ = ('_packets', 'largest_acked', 'dcid', 'encoder', 'pto_count')
+
+    def __init__(self, dcid=None):
+        """
+        :param dcid: The DCID of the packets, for their retransmissions
+        """
+        self._packets = OrderedDict()
+        self.largest_acked = -1
+        self.dcid = dcid
+        self.encoder = None
+        self.pto_count = 0
+
+    def __len__(self):
+        return len(self._packets)
+
+    def __iter__(self):
+        return iter(self._packets.values())
+
+    def __contains__(self, packet_number):
+        return packet_number in self._packets
+
+    def add(self, packet_number, send_time, packet, frame):
+        """
+        Records a packet that was just sent.
+
+        :param packet: The packet, only used for its size
+        :param frame: The packet's frame, as passed to PacketEncoder.encode
+        :return: The new SentPacket
+        """
+        record = SentPacket(packet_number, send_time, frame, len(packet))
+        self._packets[packet_number] = record
+        return record
+
+    def first(self):
+        """
+        :return: The oldest packet in flight, or None if there is none
+        """
+        for record in self._packets.values():
+            return record
+        return None
+
+    def on_ack(self, packet_number):
+        """
+        Marks a single packet as ACKed.
+
+        :return: The SentPacket that got ACKed, or None if it was already ACKed or retransmitted
+        """
+        if packet_number > self.largest_acked:
+            self.largest_acked = packet_number
+        return self._packets.pop(packet_number, None)
+
+    def on_ack_ranges(self, ack_ranges):
+        """
+        Marks the packets of all the ranges of an ACK as ACKed, in a single merge pass: the map and the sorted ranges
+        are walked together in packet number order, up to the largest ACKed packet. The cost is
+        O(in flight + ranges log ranges), for sorting the ranges and walking the packets up to the largest ACKed one,
+        and doesn't grow with the span of packet numbers the ranges cover.
+
+        :param ack_ranges: Disjoint inclusive (first, last) ranges, in any order
+        :return: A list of the SentPackets that got ACKed, in send order
+        """
+        ack_ranges = sorted(ack_ranges)
+        if not ack_ranges:
+            return []
+        largest = ack_ranges[-1][1]
+        if largest > self.largest_acked:
+            self.largest_acked = largest
+
+        packets = self._packets
+        acked = []
+        ranges = iter(ack_ranges)
+        first, last = next(ranges)
+        for packet_number, record in packets.items():
+            if packet_number > largest:
+                break
+            while packet_number > last:
+                first, last = next(ranges)
+            if packet_number >= first:
+                acked.append(record)
+        for record in acked:
+            del packets[record.packet_number]
+        return acked
+
+    def on_ack_range(self, first, last):
+        """
+        Marks every packet in the range [first, last] as ACKed. Costs the smaller of the range length and the number
+        of packets in flight.
+
+        :return: A list of the SentPackets that got ACKed, in send order
+        """
+        if last > self.largest_acked:
+            self.largest_acked = last
+
+        packets = self._packets
+        if last - first + 1 <= len(packets):
+            acked = [packets.pop(packet_number) for packet_number in range(first, last + 1)
+                     if packet_number in packets]
+        else:
+            acked = [record for record in packets.values() if first <= record.packet_number <= last]
+            for record in acked:
+                del packets[record.packet_number]
+        return acked
+
+    def retransmit(self, record, packet_number, send_time, size):
+        """
+        Moves a lost packet to the end of the map under its new packet number.
+        """
+        del self._packets[record.packet_number]
+        record.packet_number = packet_number
+        record.send_time = send_time
+        record.size = size
+        self._packets[packet_number] = record
+
+    def packet_encoder(self, version):
+        """
+        :return: The PacketEncoder for the retransmissions, reused from one retransmission to the next
+        """
+        if self.encoder is None or self.encoder.version != version:
+            self.encoder = PacketEncoder(self.dcid, version)
+        return self.encoder
+
+
+def now():
+    """
+    :return: The current time in seconds, the default clock of the recovery functions
+    """
+    return datetime.timestamp(datetime.now())
+
+
+def retransmit_packet(sock, address, packet_queue, record, current_packet_number, version=QUIC_VERSION_BITSTRING,
+                      congestion=None, clock=now, trace=None, trigger=None):
+    """
+    Sends a lost packet again under a new packet number.
+
+    :param sock: The socket
+    :param address: Server address
+    :param packet_queue: The SentPacketMap holding the lost packet
+    :param record: The lost SentPacket
+    :param current_packet_number: The packet number to give the retransmission
+    :param version: The negotiated wire format version
+    :param congestion: The congestion controller, told about the loss (unless the PTO expired) and the new send
+    :param clock: Returns the current time (a simulated clock in QUIC_sim)
+    :param trace: A QUIC_trace.Tracer, given the loss, the new send and the congestion window
+    :param trigger: The recovery algorithm that declared the packet lost, for the trace
+    """
+    send_time = clock()
+    if trace is not None:
+        trace.packet_lost(send_time, record.packet_number, record.size, trigger)
+    if congestion is not None:
+        if trigger == PTO_TRIGGER:
+            congestion.on_pto(record.size, send_time)
+        else:
+            congestion.on_loss(record.size, record.send_time, send_time)
+
+    # Put the frame under a header with the new packet number
+    encoder = packet_queue.packet_encoder(version)
+    packet = encoder.encode(current_packet_number, record.frame, packet_queue.largest_acked)
+    packet_queue.retransmit(record, current_packet_number, send_time, len(packet))
+    sock.sendto(packet, address)
+
+    if congestion is not None:
+        congestion.on_packet_sent(len(packet), send_time)
+    if trace is not None:
+        trace.packet_sent(send_time, current_packet_number, len(packet), record.frame)
+        if congestion is not None:
+            trace.metrics_updated(send_time, current_packet_number, None, congestion)
+
+
+def time_based_recovery(sock, address, packet_queue, last_ack_time, current_packet_number, time_threshold,
+                        version=QUIC_VERSION_BITSTRING, rtt=None, congestion=None, clock=now, trace=None):
     """
     Detects packet losses using the time threshold. Any packet that was sent more than TIME_THRESHOLD seconds before
-    the last ack was received (and isn't ACKed yet) will be declared as lost and sent again.
+    the last ack was received (and isn't ACKed yet, while a later packet is) will be declared as lost and sent again.
 
     :param sock: The socket
     :param address: Server address
-    :param packet_queue: The packet queue
+    :param packet_queue: The SentPacketMap
     :param last_ack_time: The time of the last ack that has been received
     :param current_packet_number:
-    :param time_threshold:
+    :param time_threshold: Fixed threshold in seconds, or None to derive it from rtt
+    :param version: The negotiated wire format version
+    :param rtt: The RttEstimator, used when time_threshold is None
+    :param congestion: The congestion controller, told about every lost packet
+    :param clock: Returns the current time
+    :param trace: A QUIC_trace.Tracer, given every lost packet
     :return: (number of retransmissions ,new current packet number)
     """
-    # Make a deep copy for packet_queue
-    packet_queue_copy = copy.deepcopy(packet_queue)
-    counter = 0
-    for element in packet_queue_copy:
-        if last_ack_time - element[2] > time_threshold and not element[1]:
-            packet_queue.remove(element)
-
-            # Assign the packet a new packet number and append it to the queue
-            element[0] = current_packet_number
-            lost_packet = parse_quic_short_header_binary(element[3])
-            lost_packet['packet_number'] = current_packet_number
-            element[3] = construct_quic_short_header_binary(lost_packet["dcid"], lost_packet["packet_number"],
-                                                                lost_packet["payload"])
-            element[2] = datetime.timestamp(datetime.now())
-            packet_queue.append(element)
+    if time_threshold is None:
+        time_threshold = rtt.time_threshold()
+
+    # The map is ordered by send time, so the lost packets are all at its head. Packets sent after the largest ACKed
+    # one may simply not have been ACKed yet.
+    lost_packets = []
+    for record in packet_queue:
+        if record.packet_number > packet_queue.largest_acked or last_ack_time - record.send_time <= time_threshold:
+            break
+        lost_packets.append(record)
 
-            # Resend the packet
-            sock.sendto(element[3].encode(), address)
-            counter += 1
-            current_packet_number += 1
-    return counter, current_packet_number
+    for record in lost_packets:
+        retransmit_packet(sock, address, packet_queue, record, current_packet_number, version, congestion, clock, trace,
+                          TIME_THRESHOLD_TRIGGER)
+        current_packet_number += 1
+    return len(lost_packets), current_packet_number
 
 
-def packet_number_based_recovery(sock, address, packet_queue,current_packet_number, packet_reoredering_threshold):
+def packet_number_based_recovery(sock, address, packet_queue,current_packet_number, packet_reoredering_threshold,
+                                 version=QUIC_VERSION_BITSTRING, congestion=None, clock=now, trace=None):
     """
     Detects packet losses using the packet threshold. Any packet that has a smaller packet number than the latest ACKed
     packet minus the PACKET_REORDERING_THRESHOLD will be declared as lost and sent again.
 
     :param sock: The socket
     :param address: Server address
-    :param packet_queue: The packet queue
+    :param packet_queue: The SentPacketMap
     :param current_packet_number:
     :param packet_reoredering_threshold:
+    :param version: The negotiated wire format version
+    :param congestion: The congestion controller, told about every lost packet
+    :param clock: Returns the current time
+    :param trace: A QUIC_trace.Tracer, given every lost packet
     :return: (number of retransmissions ,new current packet number)
     """
-    last_ack = 0
-    i = 0
-
-    for element in reversed(packet_queue):
-        if element[1]:
-            last_ack = len(packet_queue) - i - 1
+    # The map is ordered by packet number, so the lost packets are all at its head
+    lost_packets = []
+    for record in packet_queue:
+        if record.packet_number >= packet_queue.largest_acked - packet_reoredering_threshold:
             break
-        i += 1
+        lost_packets.append(record)
 
-    
-    counter = 0
-    for i in range(0, last_ack - packet_reoredering_threshold):
-        if packet_queue[0][1]:
-            packet_queue.popleft()
-        else:
-            # Update the lost packet in the queue
-            packet_queue[0][0] = current_packet_number
-            lost_packet = parse_quic_short_header_binary(packet_queue[0][3])
-            lost_packet['packet_number'] = current_packet_number
-            packet_queue[0][3] = construct_quic_short_header_binary(lost_packet["dcid"],
-                                                                        lost_packet["packet_number"],
-                                                                        lost_packet["payload"])
-            packet_queue[0][2] = datetime.timestamp(datetime.now())
+    for record in lost_packets:
+        retransmit_packet(sock, address, packet_queue, record, current_packet_number, version, congestion, clock, trace,
+                          PACKET_THRESHOLD_TRIGGER)
+        current_packet_number += 1
+    return len(lost_packets), current_packet_number
 
-            # Append it to the queue and send it again
-            packet_queue.append(packet_queue[0])
-            sock.sendto(packet_queue[0][3].encode(), address)
 
-            counter += 1
-            current_packet_number += 1
-            packet_queue.popleft()
-    return counter, current_packet_number
+def probe_timeout(packet_queue, rtt=None, PTO_TIMEOUT=None):
+    """
+    :param PTO_TIMEOUT: Fixed timeout in seconds, or None to derive it from rtt
+    :return: The PTO, doubled for every expiry since the last ACK that ACKed something (RFC 9002, section 6.2.1)
+    """
+    pto = rtt.pto() if PTO_TIMEOUT is None else PTO_TIMEOUT
+    return pto * 2 ** packet_queue.pto_count
 
 
-def PTO_recovery(sock, address, packet_queue, current_packet_number, PTO_TIMEOUT):
+def loss_timeout(packet_queue, TIME_THRESHOLD, PTO_TIMEOUT, rtt=None, clock=now):
     """
-    Detects packet losses using the timeout for the tail packets. Any packet that was sent more than PTO_TIMEOUT
-    seconds ago will be declared as lost and sent again.
+    How long to wait for an ACK before running the recovery for the tail: until the oldest packet in flight can be
+    declared lost by the time threshold, once a later packet was ACKed, or else until its PTO expires (RFC 9002,
+    appendix A.8).
+
+    :param TIME_THRESHOLD: Fixed time threshold in seconds, None to derive it from rtt, or 0 if it is disabled
+    :param PTO_TIMEOUT: Fixed timeout in seconds, or None to derive it from rtt
+    :return: The timeout in seconds, a whole PTO if nothing is in flight
+    """
+    pto = probe_timeout(packet_queue, rtt, PTO_TIMEOUT)
+    oldest = packet_queue.first()
+    if oldest is None:
+        return pto
+    deadline = oldest.send_time + pto
+    if TIME_THRESHOLD != 0 and oldest.packet_number <= packet_queue.largest_acked:
+        time_threshold = rtt.time_threshold() if TIME_THRESHOLD is None else TIME_THRESHOLD
+        deadline = min(deadline, oldest.send_time + time_threshold)
+    return max(deadline - clock(), 0)
+
+
+def PTO_recovery(sock, address, packet_queue, current_packet_number, PTO_TIMEOUT, version=QUIC_VERSION_BITSTRING,
+                 rtt=None, congestion=None, clock=now, trace=None):
+    """
+    Probes the tail packets. When the oldest packet was sent more than the PTO (backed off by probe_timeout) ago, the
+    PTO has expired: the MAX_PROBE_PACKETS oldest packets are sent again, and the PTO doubles until an ACK arrives.
+    The packets left in flight are declared lost by the other algorithms once the probes are ACKed, if they are lost.
 
     :param sock: The socket
     :param address: Server address
-    :param packet_queue: The packet queue
+    :param packet_queue: The SentPacketMap
     :param current_packet_number:
-    :param PTO_TIMEOUT:
+    :param PTO_TIMEOUT: Fixed timeout in seconds, or None to derive it from rtt
+    :param version: The negotiated wire format version
+    :param rtt: The RttEstimator, used when PTO_TIMEOUT is None
+    :param congestion: The congestion controller, told about every packet sent again, which doesn't shrink its window
+    :param clock: Returns the current time
+    :param trace: A QUIC_trace.Tracer, given every lost packet
     :return: (number of retransmissions ,new current packet number)
     """
-    
-    # Make a deep copy for packet_queue
-    packet_queue_copy = copy.deepcopy(packet_queue)
-    counter = 0
-    for element in packet_queue_copy:
-        if datetime.now().timestamp() - element[2] > PTO_TIMEOUT and not element[1]:
-            packet_queue.remove(element)
-
-            element[0] = current_packet_number
-            lost_packet = parse_quic_short_header_binary(element[3])
-            lost_packet['packet_number'] = current_packet_number
-            element[3] = construct_quic_short_header_binary(lost_packet["dcid"], lost_packet["packet_number"],
-                                                                lost_packet["payload"])
-            element[2] = datetime.timestamp(datetime.now())
+    pto = probe_timeout(packet_queue, rtt, PTO_TIMEOUT)
+    oldest = packet_queue.first()
+    if oldest is None or clock() - oldest.send_time <= pto:
+        return 0, current_packet_number
 
-            packet_queue.append(element)
-            sock.sendto(element[3].encode(), address)
-            counter += 1
-            current_packet_number += 1
-    return counter, current_packet_number
+    lost_packets = list(itertools.islice(packet_queue, MAX_PROBE_PACKETS))
+    packet_queue.pto_count += 1
+    for record in lost_packets:
+        retransmit_packet(sock, address, packet_queue, record, current_packet_number, version, congestion, clock, trace,
+                          PTO_TRIGGER)
+        current_packet_number += 1
+    return len(lost_packets), current_packet_number
 
 
-def receive_ACKs(sock, address, packet_queue, tail, current_packet_number, PACKET_REORDERING_THRESHOLD, TIME_THRESHOLD, PTO_TIMEOUT):
+def on_ACK_received(ack_packet, packet_queue, ack_time, rtt=None, congestion=None, ack_latencies=None, trace=None):
     """
-
+    Applies a parsed ACK packet to the packets in flight.
+
+    :param ack_packet: The parsed ACK packet (a dictionary or a QuicAckPacketView)
+    :param packet_queue: The SentPacketMap
+    :param ack_time: The time the ACK arrived
+    :param rtt: The RttEstimator, updated if the ACK newly ACKs its largest packet number
+    :param congestion: The congestion controller, told about every ACKed packet
+    :param ack_latencies: A list that gets the time from sending to the ACK of every newly ACKed packet
+    :param trace: A QUIC_trace.Tracer, given the ACK and the RTT and congestion window after it
+    :return: The number of newly ACKed packets
+    """
+    ack_ranges = ack_packet['ack_ranges']
+    acked = packet_queue.on_ack_ranges(ack_ranges)
+    if congestion is not None:
+        for record in acked:
+            congestion.on_ack(record.size, record.send_time, ack_time)
+    if ack_latencies is not None:
+        ack_latencies.extend(ack_time - record.send_time for record in acked)
+    if acked:
+        # The peer is reachable again: no more PTO backoff
+        packet_queue.pto_count = 0
+
+    # Only the largest ACKed packet gives an RTT sample, and only the first time it is ACKed
+    if rtt is not None and acked and acked[-1].packet_number == ack_packet['largest_acknowledged']:
+        rtt.update(ack_time - acked[-1].send_time, ack_packet['ack_delay'] / 1000)
+
+    if trace is not None:
+        packet_number = ack_packet['packet_number']
+        trace.ack_received(ack_time, packet_number, ack_packet['ack_delay'], ack_ranges)
+        if acked:
+            trace.metrics_updated(ack_time, packet_number, rtt, congestion)
+    return len(acked)
+
+
+def receive_ACKs(sock, address, packet_queue, tail, current_packet_number, PACKET_REORDERING_THRESHOLD, TIME_THRESHOLD, PTO_TIMEOUT,
+                 version=QUIC_VERSION_BITSTRING, rtt=None, congestion=None, io=None, flow=None, clock=now,
+                 ack_latencies=None, trace=None):
+    """
+    Receives the pending ACKs, feeds RTT samples to the estimator and runs the active recovery algorithms.
 
     :param sock: The socket
     :param address: Server address
-    :param packet_queue: The packet queue
+    :param packet_queue: The SentPacketMap
     :param tail: true if we're receiving ACKs for tail packets
     :param current_packet_number:
     :param PACKET_REORDERING_THRESHOLD:
-    :param TIME_THRESHOLD:
-    :param PTO_TIMEOUT:
+    :param TIME_THRESHOLD: Fixed time threshold, None to derive it from rtt, or 0 to turn time based recovery off
+    :param PTO_TIMEOUT: Fixed probe timeout, or None to derive it from rtt
+    :param version: The negotiated wire format version
+    :param rtt: The RttEstimator, updated from every ACK that newly ACKs its largest packet number
+    :param congestion: The congestion controller, told about every ACKed and lost packet
+    :param io: A QUIC_io.BatchSocketIO for the socket, to receive the ACKs in batches
+    :param flow: A QUIC_flow.SendFlowControl, given the MAX_DATA and MAX_STREAM_DATA frames that arrive with the ACKs
+    :param clock: Returns the current time (a simulated clock in QUIC_sim, with a simulated socket as sock and io)
+    :param ack_latencies: A list that gets the time from sending to the ACK of every newly ACKed packet
+    :param trace: A QUIC_trace.Tracer, given every received packet, ACK and loss
     :return: (number of retransmissions, number of retransmissions by time, number of retransmissions by packet number,
     new current packet number)
     """
@@ -485,57 +1724,62 @@ def receive_ACKs(sock, address, packet_queue, tail, current_packet_number, PACKE
 
     last_ack_time = -1
     if tail:
-        last_ack_time = datetime.timestamp(datetime.now())
+        last_ack_time = clock()
 
     # Try to receive ACKs
     try:
         while True:
-            ready = select.select([sock], [], [], 0)
-            if ready[0]:
-                ack, _ = sock.recvfrom(2048)
-                last_ack_time = datetime.timestamp(datetime.now())
-
-                # Avoid parsing short headers
-                if ack[0] == ord(SHORT_HEADER_BIT):
-                    continue
-
-                ack_packet = parse_quic_ack_packet(ack)
-                ack_ranges = ack_packet['ack_ranges']
-                curr_block = 0
-                for element in packet_queue:
-                    if curr_block >= len(ack_ranges):
-                        break
-                    if ack_ranges[curr_block][0] <= element[0] <= ack_ranges[curr_block][1]:
-                        element[1] = True
-                    elif element[0] > ack_ranges[curr_block][1]:
-                        curr_block += 1
-
+            if io is not None:
+                datagrams = io.receive()
             else:
+                ready = select.select([sock], [], [], 0)
+                datagrams = [sock.recvfrom(2048)] if ready[0] else []
+
+            if not datagrams:
                 # No more ACKs available, break from the loop
                 break
 
+            last_ack_time = clock()
+            for ack, _ in datagrams:
+                # Short headers carry the flow control updates
+                if is_short_header(ack):
+                    if flow is not None or trace is not None:
+                        packet = decode_quic_short_packet(ack, version)
+                        frame = decode_quic_frame(packet['payload'], version)
+                        if trace is not None:
+                            trace.packet_received(last_ack_time, packet['packet_number'], len(ack), frame)
+                        if flow is not None:
+                            flow.on_frame(frame)
+                    continue
+                if is_long_header(ack):
+                    # A late ServerHello, answering a retransmitted ClientHello
+                    continue
+
+                on_ACK_received(decode_quic_ack_packet(ack, version), packet_queue, last_ack_time, rtt, congestion,
+                                ack_latencies, trace)
+
     except BlockingIOError:
         # No data available
         pass
 
-    # Pop all True elements from the head of the deque until reaching false
-    while packet_queue and packet_queue[0][1]:
-        packet_queue.popleft()
-
-    if TIME_THRESHOLD:
-        count, packet_number = time_based_recovery(sock,address,packet_queue, last_ack_time,current_packet_number, TIME_THRESHOLD)
+    if TIME_THRESHOLD != 0:
+        count, packet_number = time_based_recovery(sock,address,packet_queue, last_ack_time,current_packet_number, TIME_THRESHOLD,
+                                                   version, rtt, congestion, clock, trace)
         retransmit_counter += count
         time_retransmit_counter += count
         current_packet_number = packet_number
 
     if PACKET_REORDERING_THRESHOLD:
-        count, packet_number = packet_number_based_recovery(sock,address,packet_queue,current_packet_number, PACKET_REORDERING_THRESHOLD)
+        count, packet_number = packet_number_based_recovery(sock,address,packet_queue,current_packet_number,
+                                                            PACKET_REORDERING_THRESHOLD, version, congestion, clock,
+                                                            trace)
         retransmit_counter += count
         packet_number_retransmit_counter += count
         current_packet_number = packet_number
 
     if tail:  # PTO for tail packets
-        count, packet_number = PTO_recovery(sock,address,packet_queue,current_packet_number,PTO_TIMEOUT)
+        count, packet_number = PTO_recovery(sock,address,packet_queue,current_packet_number,PTO_TIMEOUT, version, rtt,
+                                            congestion, clock, trace)
         retransmit_counter += count
         current_packet_number = packet_number
 
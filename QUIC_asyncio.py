@@ -0,0 +1,559 @@
+"""
+asyncio versions of the QUIC client and server.
+
+Both sides are DatagramProtocols built on the QUIC_api codecs and recovery functions. Nothing polls: the ACK delay on
+the server and the PTO/time threshold loss detection and pacing on the client are loop timers, so an idle or slow link
+costs no CPU, and a single process can run many transfers at once.
+
+Usage:
+    python QUIC_asyncio.py server [-d ACK_DELAY]
+    python QUIC_asyncio.py client [-k TRANSFERS] [-f FILE ...] [-t TIME_THRESHOLD] [-n PACKET_THRESHOLD] [-c CONGESTION]
+"""
+import argparse
+import asyncio
+import os
+from datetime import datetime
+
+import QUIC_api as api
+import QUIC_connection
+import QUIC_flow
+import QUIC_streams
+import QUIC_congestion as congestion_control
+
+SERVER_IP = '127.0.0.1'
+SERVER_PORT = 9997
+MAX_DATAGRAM_SIZE = 2048
+HANDSHAKE_TIMEOUT = 0.05
+FILE_PATH = os.path.abspath(os.path.dirname(__file__)) + "/alphanumeric_file.txt"
+
+
+def now():
+    return datetime.timestamp(datetime.now())
+
+
+class QuicServerProtocol(asyncio.DatagramProtocol):
+    """
+    Serves any number of clients on one socket. Connections live in a QUIC_connection.ConnectionTable, and a single
+    loop timer fires at the earliest ACK or idle deadline of all of them.
+    """
+
+    def __init__(self, ack_delay=QUIC_connection.MAX_ACK_DELAY, max_connections=0,
+                 idle_timeout=QUIC_connection.IDLE_TIMEOUT, output_dir=None,
+                 max_data=QUIC_flow.INITIAL_MAX_DATA, max_stream_data=QUIC_flow.INITIAL_MAX_STREAM_DATA,
+                 first_cid=QUIC_connection.SERVER_CID, cid_step=1, on_close=None,
+                 ack_threshold=QUIC_connection.ACK_ELICITING_THRESHOLD):
+        """
+        :param ack_delay: The maximum ACK delay in ms
+        :param max_connections: Stop after this many connections were closed (0: serve forever)
+        :param idle_timeout: Close a connection that received nothing for this many seconds
+        :param output_dir: The directory the received streams are written to, or None to discard them
+        :param max_data: The connection flow control window
+        :param max_stream_data: The stream flow control window
+        :param first_cid: The CID of the first connection
+        :param cid_step: The gap between the CIDs of consecutive connections
+        :param on_close: Called with every closed ServerConnection
+        :param ack_threshold: ACK every this many ack-eliciting packets
+        """
+        self.loop = asyncio.get_running_loop()
+        self.max_connections = max_connections
+        self.connections = QUIC_connection.ConnectionTable(first_cid, idle_timeout, output_dir, max_data,
+                                                           max_stream_data, cid_step, ack_delay, ack_threshold)
+        self.on_close = on_close
+        self.closed_connections = 0
+        self.transport = None
+        self.timer = None
+        self.timer_deadline = None
+        self.done = self.loop.create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if not api.is_short_header(data):
+            self.hello_received(data, address)
+            return
+
+        connection = self.connections.get(api.short_header_dcid(data))
+        if connection is None:
+            # Data from a client that never completed the handshake
+            return
+
+        packet = api.decode_quic_short_packet(data, connection.version, connection.largest_packet_number)
+        frame = api.decode_quic_frame(packet['payload'], connection.version)
+
+        if frame['frame_type'] == api.CONNECTION_CLOSE_FRAME:
+            self.close_received(connection)
+            return
+
+        if QUIC_streams.is_stream_frame(frame['frame_type']):
+            if not connection.on_packet(packet['packet_number'], frame, now()):
+                # The client sent past the limits it was given
+                self.close_received(connection)
+                return
+            self.schedule(connection.ack_deadline)
+        elif frame['frame_type'] in (api.DATA_BLOCKED_FRAME, api.STREAM_DATA_BLOCKED_FRAME):
+            connection.on_blocked(packet['packet_number'], frame, now())
+            self.schedule(connection.ack_deadline)
+
+    def hello_received(self, data, address):
+        parsed_packet = api.parse_quic_long_header(data)
+        parsed_frame = api.parse_quic_frame(parsed_packet['payload'])
+        hello, shard, _ = api.parse_hello_data(parsed_frame['data'])
+        if hello != "ClientHello":
+            return
+
+        # A retransmitted ClientHello gets the same answer
+        connection, new = self.connections.accept(int(parsed_packet['scid'], 2),
+                                                  api.negotiate_version(parsed_packet['version']), address, now(),
+                                                  shard)
+        api.send_hello_packet(socket=self.transport, streamID=0, dcid=connection.client_cid, scid=connection.cid,
+                              side='Server', address=address, version=connection.version,
+                              max_ack_delay=self.connections.max_ack_delay)
+        self.schedule(self.connections.next_deadline())
+
+    def schedule(self, deadline):
+        """
+        Moves the timer earlier if deadline comes before it.
+        """
+        if self.timer is not None and self.timer_deadline <= deadline:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer_deadline = deadline
+        self.timer = self.loop.call_later(max(deadline - now(), 0), self.timeout)
+
+    def timeout(self):
+        self.timer = None
+        current_time = now()
+        for connection in self.connections.due_acks(current_time):
+            self.send_ack(connection)
+        for connection in self.connections.evict_idle(current_time):
+            self.connection_closed(connection)
+
+        deadline = self.connections.next_deadline()
+        if deadline is not None:
+            self.schedule(deadline)
+
+    def send_ack(self, connection):
+        ack_packet = connection.build_ack(now())
+        if ack_packet is not None:
+            self.transport.sendto(ack_packet, connection.address)
+        for update_packet in connection.build_window_updates():
+            self.transport.sendto(update_packet, connection.address)
+
+    def close_received(self, connection):
+        self.send_ack(connection)
+        api.send_connection_close_packet(socket=self.transport, streamID=0, dcid=connection.client_cid,
+                                         packet_number=0, address=connection.address, version=connection.version)
+        self.connections.remove(connection)
+        self.connection_closed(connection)
+
+    def connection_closed(self, connection):
+        self.closed_connections += 1
+        print(f"Connection from CID {connection.client_cid} closed, received {connection.frames_received} frames.")
+        if self.on_close is not None:
+            self.on_close(connection)
+        if self.max_connections and self.closed_connections >= self.max_connections:
+            self.stop()
+
+    def shutdown(self):
+        """
+        Closes every open connection, telling its client with a CONNECTION_CLOSE, and stops the server.
+        """
+        for connection in self.connections:
+            self.close_received(connection)
+        self.stop()
+
+    def stop(self):
+        if self.done.done():
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.done.set_result(self.closed_connections)
+
+
+class QuicClientProtocol(asyncio.DatagramProtocol):
+    """
+    Sends files to the server, each on its own stream. The send loop is driven by ACK arrivals and timers: packets go out whenever the
+    congestion window and the pacer allow, and a single loss timer covers the time threshold and the PTO.
+    """
+
+    def __init__(self, file_paths, client_cid=1, quic_version=api.QUIC_VERSION_BINARY, time_threshold=None,
+                 packet_threshold=7, pto_timeout=None, congestion='newreno', pacing_rate=None,
+                 scheduler=QUIC_streams.ROUND_ROBIN, shard=None, trace=None):
+        """
+        :param file_paths: The files to send, one stream each
+        :param client_cid: This client's CID
+        :param quic_version: The wire format version offered in the ClientHello
+        :param time_threshold: Fixed time threshold, None to derive it from the RTT, 0 to turn it off
+        :param packet_threshold: Packet reordering threshold, 0 to turn it off
+        :param pto_timeout: Fixed probe timeout, or None to derive it from the RTT
+        :param congestion: The congestion controller's name
+        :param pacing_rate: Fixed pacing rate in bytes per second, None to derive it, 0 to turn pacing off
+        :param scheduler: The stream scheduling policy, QUIC_streams.ROUND_ROBIN or QUIC_streams.PRIORITY
+        :param shard: (transfer ID, offset, size, total size) to send only that range of the first file, announced in
+        the ClientHello
+        :param trace: A QUIC_trace.Tracer for the connection's events
+        """
+        self.loop = asyncio.get_running_loop()
+        self.flow = QUIC_flow.SendFlowControl()
+        self.streams = QUIC_streams.StreamScheduler(scheduler, self.flow)
+        self.shard = shard
+        if shard is not None:
+            self.streams.open_stream(file_paths[0], offset=shard[1], length=shard[2])
+        else:
+            for priority, file_path in enumerate(file_paths):
+                self.streams.open_stream(file_path, priority)
+        self.file_size = self.streams.size
+        self.client_cid = client_cid
+        self.offered_version = quic_version
+        self.version = None
+        self.server_cid = QUIC_connection.SERVER_CID
+        self.time_threshold = time_threshold
+        self.packet_threshold = packet_threshold
+        self.pto_timeout = pto_timeout
+
+        self.rtt = api.RttEstimator()
+        self.congestion = congestion_control.create_congestion_controller(congestion, self.rtt, MAX_DATAGRAM_SIZE)
+        self.pacing = pacing_rate != 0
+        self.pacer = congestion_control.Pacer(self.congestion, pacing_rate)
+        self.packet_queue = api.SentPacketMap()
+
+        self.transport = None
+        self.address = None
+        self.buffer_size = None
+        self.encoder = None
+        self.current_packet_number = 0
+        self.unique_packets = 0
+        self.retransmit_counter = 0
+        self.time_retransmit_counter = 0
+        self.packet_number_retransmit_counter = 0
+        # The time from sending to the ACK of every packet
+        self.ack_latencies = []
+        self.trace = trace
+
+        self.hello_time = None
+        self.handshake_timer = None
+        self.loss_timer = None
+        self.send_timer = None
+        self.resend_blocked = False
+        self.close_sent = False
+        self.start_time = None
+        self.done = self.loop.create_future()
+
+    # --- Handshake ---
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        self.start_time = now()
+        self.send_hello()
+
+    def send_hello(self):
+        api.send_hello_packet(socket=self.transport, streamID=0, dcid=self.server_cid, scid=self.client_cid,
+                              side='Client', address=self.address, version=self.offered_version, shard=self.shard)
+        # Only an unambiguous ServerHello gives an RTT sample
+        self.hello_time = now() if self.handshake_timer is None else None
+        self.handshake_timer = self.loop.call_later(HANDSHAKE_TIMEOUT, self.handshake_timeout)
+
+    def handshake_timeout(self):
+        self.retransmit_counter += 1
+        self.send_hello()
+
+    def hello_received(self, data):
+        parsed_packet = api.parse_quic_long_header(data)
+        parsed_frame = api.parse_quic_frame(parsed_packet['payload'])
+        hello, _, max_ack_delay = api.parse_hello_data(parsed_frame['data'])
+        if self.version is not None or hello != 'ServerHello':
+            return
+
+        self.handshake_timer.cancel()
+        if max_ack_delay is not None:
+            # The server may hold an ACK this long, so the PTO waits for it
+            self.rtt.max_ack_delay = max_ack_delay / 1000
+        if self.hello_time is not None:
+            self.rtt.update(now() - self.hello_time)
+        self.version = parsed_packet['version']
+        self.server_cid = self.packet_queue.dcid = int(parsed_packet['scid'], 2)
+        # The transport copies a datagram it can't send right away, so a single buffer is enough
+        self.encoder = api.PacketEncoder(self.server_cid, self.version)
+        # The data of a packet fills the datagram up to the longest header this connection can have
+        self.buffer_size = MAX_DATAGRAM_SIZE - api.packet_overhead(self.version, self.server_cid,
+                                                                   self.streams.next_stream_id, self.streams.size)
+        self.send_pending()
+
+    # --- Receiving ---
+
+    def datagram_received(self, data, address):
+        if self.version is None:
+            if not api.is_short_header(data):
+                self.hello_received(data)
+            return
+
+        if api.is_short_header(data):
+            packet = api.decode_quic_short_packet(data, self.version)
+            frame = api.decode_quic_frame(packet['payload'], self.version)
+            if self.trace is not None:
+                self.trace.packet_received(now(), packet['packet_number'], len(data), frame)
+            if frame['frame_type'] == api.CONNECTION_CLOSE_FRAME:
+                self.finish()
+            elif self.flow.on_frame(frame):
+                self.send_pending()
+            return
+        if api.is_long_header(data):
+            # A late ServerHello, answering a retransmitted ClientHello
+            return
+
+        ack_time = now()
+        api.on_ACK_received(api.decode_quic_ack_packet(data, self.version), self.packet_queue, ack_time, self.rtt,
+                            self.congestion, self.ack_latencies, self.trace)
+        self.detect_losses(ack_time, tail=False)
+        self.send_pending()
+
+    # --- Loss detection ---
+
+    def detect_losses(self, last_ack_time, tail):
+        """
+        Runs the recovery algorithms from QUIC_api, with the transport in place of the socket.
+
+        :param last_ack_time: The time of the last ACK (or now, when a timer fired)
+        :param tail: True when the loss timer fired, to also run the PTO recovery
+        """
+        if self.time_threshold != 0:
+            count, self.current_packet_number = api.time_based_recovery(
+                self.transport, self.address, self.packet_queue, last_ack_time, self.current_packet_number,
+                self.time_threshold, self.version, self.rtt, self.congestion, trace=self.trace)
+            self.retransmit_counter += count
+            self.time_retransmit_counter += count
+
+        if self.packet_threshold:
+            count, self.current_packet_number = api.packet_number_based_recovery(
+                self.transport, self.address, self.packet_queue, self.current_packet_number, self.packet_threshold,
+                self.version, self.congestion, trace=self.trace)
+            self.retransmit_counter += count
+            self.packet_number_retransmit_counter += count
+
+        if tail:
+            count, self.current_packet_number = api.PTO_recovery(
+                self.transport, self.address, self.packet_queue, self.current_packet_number, self.pto_timeout,
+                self.version, self.rtt, self.congestion, trace=self.trace)
+            self.retransmit_counter += count
+
+        self.set_loss_timer()
+
+    def set_loss_timer(self):
+        """
+        Arms a single timer for the earliest of the time threshold and the PTO of the oldest packet in flight.
+        """
+        if self.loss_timer is not None:
+            self.loss_timer.cancel()
+            self.loss_timer = None
+
+        # With nothing in flight, the timer only runs while flow control blocks the streams, to send the blocked
+        # frames again after a PTO
+        if self.packet_queue.first() is None and (self.streams.finished or self.streams.can_send):
+            return
+        timeout = api.loss_timeout(self.packet_queue, self.time_threshold, self.pto_timeout, self.rtt)
+        self.loss_timer = self.loop.call_later(timeout, self.loss_timeout)
+
+    def loss_timeout(self):
+        self.loss_timer = None
+        self.resend_blocked = True
+        self.detect_losses(now(), tail=True)
+        self.send_pending()
+
+    # --- Sending ---
+
+    def send_pending(self):
+        """
+        Sends new packets while the congestion window, flow control and the pacer allow, then closes once everything
+        is ACKed.
+        """
+        if self.send_timer is not None:
+            return
+
+        while not self.streams.finished and self.congestion.can_send() and self.streams.can_send:
+            send_time = now()
+            if self.pacing:
+                next_send_time = self.pacer.next_send_time(send_time)
+                if next_send_time > send_time:
+                    self.send_timer = self.loop.call_later(next_send_time - send_time, self.pacing_timeout)
+                    break
+
+            stream_frame = self.streams.read(self.buffer_size)
+            packet = self.encoder.encode(self.current_packet_number, stream_frame, self.packet_queue.largest_acked)
+
+            self.packet_queue.add(self.current_packet_number, send_time, packet, stream_frame)
+            self.transport.sendto(packet, self.address)
+            self.congestion.on_packet_sent(len(packet), send_time)
+            self.pacer.on_packet_sent(len(packet), send_time)
+            if self.trace is not None:
+                self.trace.packet_sent(send_time, self.current_packet_number, len(packet), stream_frame)
+            self.current_packet_number += 1
+            self.unique_packets += 1
+
+        if not self.streams.finished and not self.streams.can_send:
+            # Tell the server which limits hold the streams back
+            for frame_type, stream_id, limit in self.streams.blocked_frames(self.resend_blocked):
+                frame = api.encode_flow_control_frame(frame_type, limit, stream_id, self.version)
+                self.transport.sendto(api.encode_quic_short_packet(self.server_cid, self.current_packet_number, frame,
+                                                                   self.version), self.address)
+                self.current_packet_number += 1
+        self.resend_blocked = False
+
+        if self.loss_timer is None:
+            self.set_loss_timer()
+
+        if self.streams.finished and len(self.packet_queue) == 0 and not self.close_sent:
+            self.close_sent = True
+            api.send_connection_close_packet(socket=self.transport, streamID=0, dcid=self.server_cid,
+                                             packet_number=self.current_packet_number, address=self.address,
+                                             version=self.version)
+            # Don't wait for the server's CONNECTION_CLOSE forever
+            self.loop.call_later(self.rtt.pto(), self.finish)
+
+    def pacing_timeout(self):
+        self.send_timer = None
+        self.send_pending()
+
+    def finish(self):
+        if self.done.done():
+            return
+        for timer in (self.handshake_timer, self.loss_timer, self.send_timer):
+            if timer is not None:
+                timer.cancel()
+        self.streams.close()
+        self.transport.close()
+        self.done.set_result(self.statistics())
+
+    def statistics(self):
+        total_time = now() - self.start_time
+        self.ack_latencies.sort()
+        return {
+            'client_cid': self.client_cid,
+            'shard': self.shard,
+            'file_size': self.file_size,
+            'total_time': total_time,
+            'bandwidth': self.file_size / total_time / 1024 / 1024,
+            'unique_packets': self.unique_packets,
+            'retransmissions': self.retransmit_counter,
+            'time_retransmissions': self.time_retransmit_counter,
+            'packet_number_retransmissions': self.packet_number_retransmit_counter,
+            'smoothed_rtt': self.rtt.smoothed_rtt,
+            'ack_latency_p50': api.percentile(self.ack_latencies, 0.5),
+            'ack_latency_p99': api.percentile(self.ack_latencies, 0.99),
+            'data_blocked': self.flow.data_blocked_sent,
+            'stream_data_blocked': self.flow.stream_data_blocked_sent,
+            'window_updates': self.flow.updates_received,
+        }
+
+
+async def run_server(host=SERVER_IP, port=SERVER_PORT, ack_delay=QUIC_connection.MAX_ACK_DELAY, max_connections=0,
+                     output_dir=None, max_data=QUIC_flow.INITIAL_MAX_DATA,
+                     max_stream_data=QUIC_flow.INITIAL_MAX_STREAM_DATA,
+                     ack_threshold=QUIC_connection.ACK_ELICITING_THRESHOLD):
+    """
+    Runs the server until max_connections connections were closed, or forever if it is 0.
+
+    :return: The number of closed connections
+    """
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: QuicServerProtocol(ack_delay, max_connections, output_dir=output_dir, max_data=max_data,
+                                   max_stream_data=max_stream_data, ack_threshold=ack_threshold),
+        local_addr=(host, port))
+    print(f"Server listening on {host}:{port}")
+    try:
+        return await protocol.done
+    finally:
+        transport.close()
+
+
+async def run_client(file_paths=(FILE_PATH,), host=SERVER_IP, port=SERVER_PORT, **options):
+    """
+    Sends files to the server over one connection.
+
+    :param options: Keyword arguments for QuicClientProtocol
+    :return: A dictionary with the transfer statistics
+    """
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: QuicClientProtocol(file_paths, **options), remote_addr=(host, port))
+    return await protocol.done
+
+
+async def run_clients(count, file_paths=(FILE_PATH,), host=SERVER_IP, port=SERVER_PORT, **options):
+    """
+    Runs count transfers of the same files concurrently, each with its own socket and CID.
+
+    :return: A list of statistics dictionaries, one per transfer
+    """
+    return await asyncio.gather(*[run_client(file_paths, host, port, client_cid=cid, **options)
+                                  for cid in range(1, count + 1)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="asyncio QUIC client and server")
+    subparsers = parser.add_subparsers(dest='side', required=True)
+
+    server_parser = subparsers.add_parser('server')
+    server_parser.add_argument("-d", "--delay", type=int, default=QUIC_connection.MAX_ACK_DELAY,
+                               help="The maximum time a receiver might delay sending an ACK")
+    server_parser.add_argument("-a", "--ack-threshold", type=int, default=QUIC_connection.ACK_ELICITING_THRESHOLD,
+                               help="Send an ACK every this many ack-eliciting packets (default: 2)")
+    server_parser.add_argument("-m", "--max-connections", type=int, default=0,
+                               help="Exit after this many connections were closed (default: 0, serve forever)")
+    server_parser.add_argument("-o", "--output-dir", default=None,
+                               help="Write every received stream to a file in this directory")
+    server_parser.add_argument("--max-data", type=int, default=QUIC_flow.INITIAL_MAX_DATA,
+                               help="Connection flow control window in bytes")
+    server_parser.add_argument("--max-stream-data", type=int, default=QUIC_flow.INITIAL_MAX_STREAM_DATA,
+                               help="Stream flow control window in bytes")
+    server_parser.add_argument("--port", type=int, default=SERVER_PORT)
+
+    client_parser = subparsers.add_parser('client')
+    client_parser.add_argument("-k", "--transfers", type=int, default=1,
+                               help="Number of concurrent transfers of the file (default: 1)")
+    client_parser.add_argument("-f", "--files", nargs='+', default=[FILE_PATH],
+                               help="The files to send, each on its own stream")
+    client_parser.add_argument("-s", "--scheduler", default=QUIC_streams.ROUND_ROBIN,
+                               choices=QUIC_streams.SCHEDULERS,
+                               help="Stream scheduling: take turns, or send the files in the given order")
+    client_parser.add_argument("-t", "--time", type=float, default=None,
+                               help="Value of time_threshold in seconds (default: derived from the RTT). "
+                                    "Enter 0 to turn off time based recovery.")
+    client_parser.add_argument("-n", "--number", type=int, default=7,
+                               help="packet_reordering_threshold (default: 7). Enter 0 to turn off packet number "
+                                    "based recovery.")
+    client_parser.add_argument("-q", "--quic-version", type=int, default=api.QUIC_VERSION_BINARY,
+                               choices=api.SUPPORTED_VERSIONS)
+    client_parser.add_argument("-c", "--congestion", default='newreno',
+                               choices=congestion_control.CONGESTION_CONTROLLERS)
+    client_parser.add_argument("--port", type=int, default=SERVER_PORT)
+    args = parser.parse_args()
+
+    if args.side == 'server':
+        if args.output_dir is not None:
+            os.makedirs(args.output_dir, exist_ok=True)
+        asyncio.run(run_server(port=args.port, ack_delay=args.delay, max_connections=args.max_connections,
+                               output_dir=args.output_dir, max_data=args.max_data,
+                               max_stream_data=args.max_stream_data, ack_threshold=args.ack_threshold))
+        return
+
+    if args.time == 0 and args.number == 0:
+        raise Exception("Need to have at least one recovery algorithm")
+    results = asyncio.run(run_clients(args.transfers, args.files, port=args.port, quic_version=args.quic_version,
+                                      time_threshold=args.time, packet_threshold=args.number,
+                                      congestion=args.congestion, scheduler=args.scheduler))
+    for result in results:
+        print(f"CID {result['client_cid']}: {result['total_time']:.6f} seconds, "
+              f"Bandwidth: {result['bandwidth']:.3f} MB/s, "
+              f"{result['unique_packets']} unique packets, {result['retransmissions']} re-transmitted, "
+              f"flow control blocked {result['data_blocked'] + result['stream_data_blocked']} times")
+    total_bytes = sum(result['file_size'] for result in results)
+    total_time = max(result['total_time'] for result in results)
+    print(f"Aggregate bandwidth: {total_bytes / total_time / 1024 / 1024:.3f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+"""
+Throughput benchmarks over a matrix of file sizes, loss rates, ACK delays and recovery thresholds.
+
+Every configuration runs several times, each run with its own seed for the loss, so the same matrix gives the same
+losses on every machine. The loss comes from a QUIC_netem relay between the client and the server. A run can be:
+    asyncio     the QUIC_asyncio client and server, and the relay, on one event loop in this process
+    subprocess  QUIC_Server.py and QUIC_Client.py as processes, through a relay in a thread of this process
+    sim         QUIC_sim's simulated transfer, which measures the algorithms rather than the machine
+Every run reports the goodput (file bytes per second of the whole transfer), the retransmissions, the CPU time (of
+this process for asyncio and sim, of the client and server processes for subprocess) and the p50 and p99 of the time
+from sending a packet to its ACK. The results go to JSON and CSV, and can be compared to a baseline: the JSON of an
+earlier run.
+
+Usage:
+    python QUIC_benchmark.py [--mode {asyncio,subprocess,sim}] [-s SIZE ...] [-l LOSS ...] [-d ACK_DELAY ...]
+                             [-t TIME_THRESHOLD ...] [-n PACKET_THRESHOLD ...] [-r REPEATS] [-w WARMUP]
+                             [--json FILE] [--csv FILE] [--baseline FILE] [--tolerance TOLERANCE]
+"""
+import argparse
+import asyncio
+import csv
+import gc
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import QUIC_asyncio
+import QUIC_connection
+import QUIC_netem
+import QUIC_sim
+
+MODES = ('asyncio', 'subprocess', 'sim')
+ROOT = os.path.abspath(os.path.dirname(__file__))
+RUN_TIMEOUT = 120  # in seconds
+REPEATS = 3
+WARMUP_RUNS = 1
+# A change of a median by more than this many percent, the wrong way, is a regression
+TOLERANCE = 10
+
+CONFIG_FIELDS = ('size', 'loss', 'ack_delay', 'time_threshold', 'packet_threshold')
+RUN_FIELDS = ('goodput', 'total_time', 'unique_packets', 'retransmissions', 'cpu_time', 'ack_latency_p50',
+              'ack_latency_p99')
+# The metrics compared to the baseline, and whether more is better
+COMPARED_METRICS = {'goodput': True, 'cpu_time': False, 'ack_latency_p99': False}
+
+
+def configurations(sizes, losses, ack_delays, time_thresholds, packet_thresholds):
+    """
+    :param sizes: File sizes in bytes
+    :param losses: Loss rates in percent
+    :param ack_delays: The server's maximum ACK delays in ms
+    :param time_thresholds: Time thresholds in seconds, None to derive them from the RTT, or 0 to turn them off
+    :param packet_thresholds: Packet reordering thresholds, or 0 to turn them off
+    :return: A list of every combination, as dictionaries, without the ones with no recovery algorithm
+    """
+    return [dict(zip(CONFIG_FIELDS, values))
+            for values in itertools.product(sizes, losses, ack_delays, time_thresholds, packet_thresholds)
+            if values[3] != 0 or values[4] != 0]
+
+
+def config_key(config):
+    return ','.join(f'{field}={config[field]}' for field in CONFIG_FIELDS)
+
+
+def benchmark_file(size, directory):
+    """
+    :return: The path of a file of size random alphanumeric bytes, the same for the same size, written once
+    """
+    path = os.path.join(directory, f'benchmark_{size}.txt')
+    if not os.path.exists(path):
+        alphabet = b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+        table = bytes(alphabet[byte % len(alphabet)] for byte in range(256))
+        with open(path, 'wb') as file:
+            file.write(random.Random(size).randbytes(size).translate(table))
+    return path
+
+
+def run_result(client_statistics, cpu_time):
+    """
+    :param client_statistics: The statistics of a client, from QUIC_asyncio, QUIC_sim or parse_client_output
+    :return: The RUN_FIELDS of the run, with the goodput in MB/s and the ACK latencies in ms
+    """
+    def milliseconds(seconds):
+        return None if seconds is None else seconds * 1000
+
+    return {
+        'goodput': client_statistics['file_size'] / client_statistics['total_time'] / 1024 / 1024,
+        'total_time': client_statistics['total_time'],
+        'unique_packets': client_statistics['unique_packets'],
+        'retransmissions': client_statistics['retransmissions'],
+        'cpu_time': cpu_time,
+        'ack_latency_p50': milliseconds(client_statistics['ack_latency_p50']),
+        'ack_latency_p99': milliseconds(client_statistics['ack_latency_p99']),
+    }
+
+
+async def run_asyncio(file_path, config, seed, timeout):
+    loop = asyncio.get_running_loop()
+    transport, server = await loop.create_datagram_endpoint(
+        lambda: QUIC_asyncio.QuicServerProtocol(ack_delay=config['ack_delay'], max_connections=1),
+        local_addr=(QUIC_asyncio.SERVER_IP, 0))
+    relay = QUIC_netem.symmetric_relay(transport.get_extra_info('sockname')[:2], seed, loss=config['loss'] / 100)
+    await relay.start(port=0)
+    cpu_start = time.process_time()
+    try:
+        result = await asyncio.wait_for(
+            QUIC_asyncio.run_client([file_path], port=relay.address[1], time_threshold=config['time_threshold'],
+                                    packet_threshold=config['packet_threshold']), timeout)
+        await asyncio.wait_for(server.done, timeout)
+    finally:
+        relay.close()
+        transport.close()
+    return run_result(result, time.process_time() - cpu_start)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((QUIC_asyncio.SERVER_IP, 0))
+        return sock.getsockname()[1]
+
+
+def parse_client_output(output):
+    """
+    :param output: What QUIC_Client.py printed
+    :return: The statistics dictionary of the transfer, with the keys of QUIC_asyncio's
+    """
+    result = {}
+    for line in output.splitlines():
+        if line.startswith("Total time is:"):
+            result['total_time'] = float(line.split(" ")[3])
+        elif line.startswith("File Size:"):
+            result['file_size'] = int(line.split(" ")[2])
+        elif line.startswith("Unique packets:"):
+            result['unique_packets'] = int(line.split(" ")[2])
+        elif line.startswith("Re-transmitted packets:"):
+            result['retransmissions'] = int(line.split(" ")[2])
+        elif line.startswith("ACK latency:"):
+            # ACK latency: p50 X ms, p99 Y ms, with n/a for X and Y when nothing was ACKed
+            fields = line.replace(',', '').split(" ")
+            result['ack_latency_p50'] = None if fields[3] == 'n/a' else float(fields[3]) / 1000
+            result['ack_latency_p99'] = None if fields[6] == 'n/a' else float(fields[6]) / 1000
+    return result
+
+
+def run_subprocess(file_path, config, seed, timeout):
+    port = free_port()
+    environment = dict(os.environ, PYTHONUNBUFFERED='1')
+    usage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'QUIC_Server.py'), '--port', str(port),
+                               '-d', str(config['ack_delay']), '-m', '1'],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, env=environment)
+    try:
+        # Start the client once the server is listening
+        server.stdout.readline()
+        client_command = [sys.executable, os.path.join(ROOT, 'QUIC_Client.py'), '-f', file_path,
+                          '-n', str(config['packet_threshold'])]
+        if config['time_threshold'] is not None:
+            client_command += ['-t', str(config['time_threshold'])]
+        relay = QUIC_netem.symmetric_relay((QUIC_asyncio.SERVER_IP, port), seed, loss=config['loss'] / 100)
+        with QUIC_netem.BackgroundRelay(relay, port=0):
+            client = subprocess.run(client_command + ['--port', str(relay.address[1])], capture_output=True,
+                                    text=True, timeout=timeout, env=environment)
+            server.communicate(timeout=timeout)
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+    usage_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if client.returncode != 0:
+        raise RuntimeError(f"QUIC_Client.py exited with {client.returncode}: {client.stderr.strip()}")
+    cpu_time = (usage_end.ru_utime + usage_end.ru_stime) - (usage_start.ru_utime + usage_start.ru_stime)
+    return run_result(parse_client_output(client.stdout), cpu_time)
+
+
+def run_sim(file_path, config, seed, timeout):
+    uplink, downlink = QUIC_sim.link_models(config['loss'] / 100, seed=seed)
+    cpu_start = time.process_time()
+    result = QUIC_sim.simulate_transfer([file_path], uplink=uplink, downlink=downlink, ack_delay=config['ack_delay'],
+                                        time_threshold=config['time_threshold'],
+                                        packet_threshold=config['packet_threshold'])
+    return run_result(result, time.process_time() - cpu_start)
+
+
+def run_once(mode, file_path, config, seed, timeout=RUN_TIMEOUT):
+    """
+    Runs one transfer.
+
+    :return: The RUN_FIELDS of the run
+    """
+    # Garbage from the previous run shouldn't be collected during this one
+    gc.collect()
+    if mode == 'asyncio':
+        return asyncio.run(run_asyncio(file_path, config, seed, timeout))
+    if mode == 'subprocess':
+        return run_subprocess(file_path, config, seed, timeout)
+    if mode == 'sim':
+        return run_sim(file_path, config, seed, timeout)
+    raise ValueError(f"Unknown benchmark mode {mode}")
+
+
+def summarize(runs):
+    """
+    :param runs: The results of the runs of one configuration, without the failed ones
+    :return: The median of every RUN_FIELD, and the minimum and maximum goodput
+    """
+    summary = {'runs': len(runs)}
+    for field in RUN_FIELDS:
+        values = [run[field] for run in runs if run[field] is not None]
+        summary[field] = statistics.median(values) if values else None
+    goodputs = [run['goodput'] for run in runs]
+    summary['goodput_min'] = min(goodputs) if goodputs else None
+    summary['goodput_max'] = max(goodputs) if goodputs else None
+    return summary
+
+
+def run_benchmark(configs, mode='asyncio', repeats=REPEATS, warmup=WARMUP_RUNS, timeout=RUN_TIMEOUT, directory=None,
+                  log=print):
+    """
+    Runs every configuration repeats times, run i with seed i.
+
+    Before measuring, warmup runs of the first configuration are thrown away. In one process, the first transfers
+    also pay for warming up the allocator: glibc raises its mmap threshold only after a large block is freed, so until
+    then every 256 KB receive buffer of asyncio is a fresh mmap, and the page faults cost more than the protocol.
+
+    :param directory: Where the benchmark files are written (default: a temporary directory)
+    :param log: Called with a line of progress after every configuration
+    :return: A list with a dictionary per configuration: its 'config', 'key', 'runs', 'errors' and 'summary'
+    """
+    if directory is None:
+        with tempfile.TemporaryDirectory() as directory:
+            return run_benchmark(configs, mode, repeats, warmup, timeout, directory, log)
+
+    if configs and warmup:
+        for seed in range(warmup):
+            run_once(mode, benchmark_file(configs[0]['size'], directory), configs[0], seed, timeout)
+
+    results = []
+    for config in configs:
+        file_path = benchmark_file(config['size'], directory)
+        runs = []
+        errors = []
+        for seed in range(repeats):
+            try:
+                runs.append(dict(run_once(mode, file_path, config, seed, timeout), seed=seed))
+            except (TimeoutError, asyncio.TimeoutError, subprocess.TimeoutExpired, RuntimeError) as error:
+                errors.append({'seed': seed, 'error': f"{type(error).__name__}: {error}"})
+        summary = summarize(runs)
+        results.append({'config': config, 'key': config_key(config), 'runs': runs, 'errors': errors,
+                        'summary': summary})
+        if log is not None:
+            log(format_summary(config, summary, len(errors)))
+    return results
+
+
+def format_summary(config, summary, errors=0):
+    line = (f"size {config['size']} loss {config['loss']}% ack delay {config['ack_delay']} ms "
+            f"thresholds {config['packet_threshold']}/{config['time_threshold']}: ")
+    if not summary['runs']:
+        return line + f"all {errors} runs failed"
+    line += (f"{summary['goodput']:.3f} MB/s ({summary['goodput_min']:.3f}-{summary['goodput_max']:.3f}), "
+             f"{summary['retransmissions']:.0f} re-transmitted, CPU {summary['cpu_time']:.3f} s")
+    if summary['ack_latency_p50'] is not None:
+        line += f", ACK latency p50 {summary['ack_latency_p50']:.3f} ms p99 {summary['ack_latency_p99']:.3f} ms"
+    if errors:
+        line += f", {errors} runs failed"
+    return line
+
+
+def environment():
+    """
+    :return: What the results depend on besides the code: the machine, the Python and the commit
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                                timeout=10).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def write_json(path, mode, results, repeats=REPEATS):
+    with open(path, 'w') as file:
+        json.dump({'mode': mode, 'repeats': repeats, 'environment': environment(), 'results': results}, file,
+                  indent=2)
+
+
+def write_csv(path, results):
+    """
+    Writes a row per configuration, with the summary of its runs.
+    """
+    summary_fields = ['runs', *RUN_FIELDS, 'goodput_min', 'goodput_max']
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow([*CONFIG_FIELDS, *summary_fields, 'errors'])
+        for result in results:
+            writer.writerow([result['config'][field] for field in CONFIG_FIELDS]
+                            + [result['summary'][field] for field in summary_fields] + [len(result['errors'])])
+
+
+def load_baseline(path):
+    """
+    :return: The summaries of a JSON written by write_json, by configuration key
+    """
+    with open(path) as file:
+        baseline = json.load(file)
+    return {result['key']: result['summary'] for result in baseline['results']}
+
+
+def compare_to_baseline(results, baseline, tolerance=TOLERANCE):
+    """
+    :param results: The results of run_benchmark
+    :param baseline: The summaries by configuration key, from load_baseline
+    :param tolerance: The change in percent that counts as a regression, if it goes the wrong way
+    :return: A list with a dictionary per configuration and COMPARED_METRICS in both: its 'key', 'metric',
+    'baseline', 'current', 'change' in percent and 'regression'
+    """
+    comparisons = []
+    for result in results:
+        old = baseline.get(result['key'])
+        if old is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old_value, new_value = old.get(metric), result['summary'].get(metric)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            worse = -change if higher_is_better else change
+            comparisons.append({'key': result['key'], 'metric': metric, 'baseline': old_value, 'current': new_value,
+                                'change': change, 'regression': worse > tolerance})
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark transfers over a matrix of file sizes, loss rates, ACK "
+                                                 "delays and recovery thresholds")
+    parser.add_argument("--mode", default='asyncio', choices=MODES,
+                        help="Run the client and server in this process, as processes, or simulated (default: asyncio)")
+    parser.add_argument("-s", "--sizes", type=float, nargs='+', default=[1],
+                        help="File sizes in MB (default: 1)")
+    parser.add_argument("-l", "--loss", type=float, nargs='+', default=[0, 1, 5],
+                        help="Loss rates in percent, in each direction (default: 0 1 5)")
+    parser.add_argument("-d", "--ack-delay", type=int, nargs='+', default=[QUIC_connection.MAX_ACK_DELAY],
+                        help=f"The server's maximum ACK delays in ms (default: {QUIC_connection.MAX_ACK_DELAY})")
+    parser.add_argument("-t", "--time", type=float, nargs='+', default=[None],
+                        help="Time thresholds in seconds, 0 to turn time based recovery off (default: from the RTT)")
+    parser.add_argument("-n", "--number", type=int, nargs='+', default=[7],
+                        help="Packet reordering thresholds, 0 to turn packet number based recovery off (default: 7)")
+    parser.add_argument("-r", "--repeats", type=int, default=REPEATS,
+                        help=f"Runs of every configuration (default: {REPEATS})")
+    parser.add_argument("-w", "--warmup", type=int, default=WARMUP_RUNS,
+                        help=f"Runs to throw away before measuring (default: {WARMUP_RUNS})")
+    parser.add_argument("--timeout", type=float, default=RUN_TIMEOUT,
+                        help=f"Give up on a run after this many seconds (default: {RUN_TIMEOUT})")
+    parser.add_argument("--json", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--csv", default=None, help="Write a row per configuration to this CSV file")
+    parser.add_argument("--baseline", default=None, help="Compare to the JSON of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help=f"Changes of more than this many percent are regressions (default: {TOLERANCE})")
+    args = parser.parse_args()
+
+    configs = configurations([int(size * 1024 * 1024) for size in args.sizes], args.loss, args.ack_delay, args.time,
+                             args.number)
+    results = run_benchmark(configs, args.mode, args.repeats, args.warmup, args.timeout)
+    if args.json is not None:
+        write_json(args.json, args.mode, results, args.repeats)
+    if args.csv is not None:
+        write_csv(args.csv, results)
+
+    if args.baseline is not None:
+        comparisons = compare_to_baseline(results, load_baseline(args.baseline), args.tolerance)
+        for comparison in comparisons:
+            print(f"{comparison['key']} {comparison['metric']}: {comparison['baseline']:.3f} -> "
+                  f"{comparison['current']:.3f} ({comparison['change']:+.1f}%)"
+                  f"{' REGRESSION' if comparison['regression'] else ''}")
+        regressions = sum(comparison['regression'] for comparison in comparisons)
+        print(f"{regressions} regressions in {len(comparisons)} comparisons")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
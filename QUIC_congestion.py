@@ -0,0 +1,259 @@
+"""
+Congestion control and pacing for the client's send loop.
+
+Every controller keeps track of the bytes in flight and exposes the same interface:
+- on_packet_sent: a packet (new or retransmitted) was sent
+- on_ack: a packet was ACKed
+- on_loss: a packet was declared lost by one of the recovery algorithms
+- on_pto: a packet was sent again because the probe timeout expired, which is not a loss signal
+- can_send: whether the congestion window has room for another packet
+The Pacer spreads the packets the window allows over the RTT instead of sending them back-to-back.
+All times are in seconds, all sizes in bytes.
+"""
+import abc
+
+MAX_DATAGRAM_SIZE = 2048
+
+# RFC 9002 window limits, in datagrams
+INITIAL_WINDOW_PACKETS = 10
+MINIMUM_WINDOW_PACKETS = 2
+LOSS_REDUCTION_FACTOR = 0.5
+
+# RFC 9438 constants
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+
+# Pacing: send at 1.25 * cwnd / RTT (RFC 9002), allowing bursts of a few packets
+PACING_GAIN = 1.25
+PACING_BURST_PACKETS = 4
+MIN_PACING_RTT = 0.001
+
+
+class CongestionController(abc.ABC):
+    """
+    Base class for the congestion controllers. Tracks the bytes in flight and the congestion window, and leaves the
+    window updates to the subclasses, which must implement on_congestion_avoidance_ack and on_congestion_event.
+    """
+
+    name = None
+
+    def __init__(self, rtt, max_datagram_size=MAX_DATAGRAM_SIZE):
+        """
+        :param rtt: The connection's RttEstimator
+        :param max_datagram_size: The size of a full packet
+        """
+        self.rtt = rtt
+        self.max_datagram_size = max_datagram_size
+        self.congestion_window = INITIAL_WINDOW_PACKETS * max_datagram_size
+        self.minimum_window = MINIMUM_WINDOW_PACKETS * max_datagram_size
+        self.ssthresh = float('inf')
+        self.bytes_in_flight = 0
+        self.recovery_start_time = -1
+        self.congestion_events = 0
+
+    def can_send(self, packet_size=None):
+        """
+        :param packet_size: The size of the next packet (default: a full packet)
+        :return: True if the congestion window has room for the packet
+        """
+        if packet_size is None:
+            packet_size = self.max_datagram_size
+        return self.bytes_in_flight + packet_size <= self.congestion_window
+
+    def in_slow_start(self):
+        return self.congestion_window < self.ssthresh
+
+    def on_packet_sent(self, sent_bytes, now):
+        self.bytes_in_flight += sent_bytes
+
+    def on_ack(self, acked_bytes, sent_time, now):
+        self.bytes_in_flight -= acked_bytes
+
+        # Packets sent before the current recovery period started don't grow the window
+        if sent_time <= self.recovery_start_time:
+            return
+        if self.in_slow_start():
+            self.congestion_window += acked_bytes
+        else:
+            self.on_congestion_avoidance_ack(acked_bytes, now)
+
+    def on_loss(self, lost_bytes, sent_time, now):
+        self.bytes_in_flight -= lost_bytes
+
+        # A single congestion event per recovery period
+        if sent_time <= self.recovery_start_time:
+            return
+        self.recovery_start_time = now
+        self.congestion_events += 1
+        self.on_congestion_event(now)
+
+    def on_pto(self, probe_bytes, now):
+        # A PTO is not a loss signal (RFC 9002, section 7.5): the packet only stops counting as in flight
+        self.bytes_in_flight -= probe_bytes
+
+    @abc.abstractmethod
+    def on_congestion_avoidance_ack(self, acked_bytes, now):
+        """
+        Grows the window for a packet ACKed outside of slow start and of the recovery period.
+        """
+
+    @abc.abstractmethod
+    def on_congestion_event(self, now):
+        """
+        Reduces the window, once per recovery period.
+        """
+
+
+class NoCongestionControl(CongestionController):
+    """
+    Never limits the sender. Keeps the behavior from before congestion control was added.
+    """
+
+    name = 'none'
+
+    def can_send(self, packet_size=None):
+        return True
+
+    def on_congestion_avoidance_ack(self, acked_bytes, now):
+        pass
+
+    def on_congestion_event(self, now):
+        pass
+
+
+class NewReno(CongestionController):
+    """
+    The NewReno controller from RFC 9002: the window doubles every RTT in slow start, grows by one packet per RTT in
+    congestion avoidance, and is halved once per recovery period.
+    """
+
+    name = 'newreno'
+
+    def on_congestion_avoidance_ack(self, acked_bytes, now):
+        self.congestion_window += self.max_datagram_size * acked_bytes / self.congestion_window
+
+    def on_congestion_event(self, now):
+        self.ssthresh = max(self.congestion_window * LOSS_REDUCTION_FACTOR, self.minimum_window)
+        self.congestion_window = self.ssthresh
+
+
+class Cubic(CongestionController):
+    """
+    The CUBIC controller from RFC 9438: after a loss the window grows along a cubic curve that plateaus around the
+    window where the loss happened, and never grows slower than Reno would.
+    """
+
+    name = 'cubic'
+
+    def __init__(self, rtt, max_datagram_size=MAX_DATAGRAM_SIZE):
+        super().__init__(rtt, max_datagram_size)
+        self.w_max = 0  # window before the last reduction, in packets
+        self.k = 0  # time to get back to w_max, in seconds
+        self.epoch_start = None
+        self.w_est = 0  # Reno-friendly window estimate, in packets
+
+    def on_congestion_avoidance_ack(self, acked_bytes, now):
+        cwnd = self.congestion_window / self.max_datagram_size
+        if self.epoch_start is None:
+            # First congestion avoidance ACK without a previous loss
+            self.epoch_start = now
+            self.w_max = cwnd
+            self.k = 0
+            self.w_est = cwnd
+
+        t = now - self.epoch_start
+        target = CUBIC_C * (t + self.rtt.smoothed_rtt - self.k) ** 3 + self.w_max
+        target = min(max(target, cwnd), 1.5 * cwnd)
+
+        acked_packets = acked_bytes / self.max_datagram_size
+        self.w_est += 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) * acked_packets / cwnd
+
+        if self.w_est > target:
+            # Reno-friendly region
+            cwnd = max(cwnd, self.w_est)
+        else:
+            cwnd += acked_packets * (target - cwnd) / cwnd
+        self.congestion_window = cwnd * self.max_datagram_size
+
+    def on_congestion_event(self, now):
+        cwnd = self.congestion_window / self.max_datagram_size
+        self.w_max = cwnd
+        self.epoch_start = now
+        self.ssthresh = max(self.congestion_window * CUBIC_BETA, self.minimum_window)
+        self.congestion_window = self.ssthresh
+        self.w_est = self.congestion_window / self.max_datagram_size
+        self.k = (self.w_max * (1 - CUBIC_BETA) / CUBIC_C) ** (1 / 3)
+
+
+class Pacer:
+    """
+    A token bucket pacer. Tokens (bytes) refill at the pacing rate up to a small burst, and a packet may be sent once
+    there are enough tokens for it. The rate is either fixed or derived from the congestion window and the RTT.
+    """
+
+    def __init__(self, congestion, rate=None, burst_packets=PACING_BURST_PACKETS):
+        """
+        :param congestion: The connection's congestion controller
+        :param rate: A fixed pacing rate in bytes per second, or None to derive it from the window and the RTT
+        :param burst_packets: How many full packets may be sent back-to-back
+        """
+        self.congestion = congestion
+        self.rate = rate
+        self.capacity = burst_packets * congestion.max_datagram_size
+        self.tokens = self.capacity
+        self.last_update = None
+        self.paced_packets = 0
+        self.rate_total = 0
+
+    def pacing_rate(self):
+        """
+        :return: The current pacing rate in bytes per second
+        """
+        if self.rate is not None:
+            return self.rate
+        return PACING_GAIN * self.congestion.congestion_window / max(self.congestion.rtt.smoothed_rtt, MIN_PACING_RTT)
+
+    def average_pacing_rate(self):
+        """
+        :return: The mean pacing rate over all paced packets, in bytes per second
+        """
+        return self.rate_total / self.paced_packets if self.paced_packets else self.pacing_rate()
+
+    def refill(self, now):
+        if self.last_update is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.pacing_rate())
+        self.last_update = now
+
+    def next_send_time(self, now, packet_size=None):
+        """
+        :param now: The current time
+        :param packet_size: The size of the next packet (default: a full packet)
+        :return: When the next packet may be sent, now at the earliest
+        """
+        if packet_size is None:
+            packet_size = self.congestion.max_datagram_size
+        self.refill(now)
+        if self.tokens >= packet_size:
+            return now
+        return now + (packet_size - self.tokens) / self.pacing_rate()
+
+    def on_packet_sent(self, sent_bytes, now):
+        self.refill(now)
+        self.tokens -= sent_bytes
+        self.paced_packets += 1
+        self.rate_total += self.pacing_rate()
+
+
+CONGESTION_CONTROLLERS = {controller.name: controller for controller in (NewReno, Cubic, NoCongestionControl)}
+
+
+def create_congestion_controller(name, rtt, max_datagram_size=MAX_DATAGRAM_SIZE):
+    """
+    Creates a congestion controller by its command line name.
+
+    :param name: 'newreno', 'cubic' or 'none'
+    :param rtt: The connection's RttEstimator
+    :param max_datagram_size: The size of a full packet
+    :return: The congestion controller
+    """
+    return CONGESTION_CONTROLLERS[name](rtt, max_datagram_size)
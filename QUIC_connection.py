@@ -0,0 +1,348 @@
+"""
+Connection state for a server that serves many clients on a single socket.
+
+Every connection gets its own server CID in the ServerHello, and the client uses it as the DCID of its short header
+packets, so a data packet is matched to its connection by its DCID alone. Handshake packets are matched by the client's
+SCID and address instead, so a retransmitted ClientHello gets the same connection back.
+
+A ClientHello may announce a shard: one byte range of a file that is sent over several connections at once. The shard
+is sent on stream 0, and written at its offset into a single output file named after the transfer ID.
+
+ACKs follow RFC 9000, section 13.2: a connection ACKs every few ack-eliciting packets, or once the oldest unACKed one
+waited max_ack_delay, and right away when a packet arrives out of order, since a gap may be a loss the client should
+hear about soon. Data sent again into a gap of a stream, and the end of a stream, are ACKed right away too, since the
+client is waiting on them (as RFC 5681, section 4.2 has TCP do for segments that fill a gap). Every ACK reports how
+long it was actually held. An ACK repeats every range received so far (up to MAX_ACK_RANGES, and as many as fit in the
+packet, newest first), so a lost ACK is made up for by the next one.
+"""
+import os
+
+import QUIC_api as api
+import QUIC_flow
+import QUIC_streams
+
+SERVER_CID = 2
+IDLE_TIMEOUT = 10  # in seconds
+MAX_ACK_DELAY = 20  # in ms
+ACK_ELICITING_THRESHOLD = 2  # ack-eliciting packets per ACK
+MAX_ACK_RANGES = 32  # the oldest ranges beyond this are no longer ACKed
+
+
+class AckScheduler:
+    """
+    Decides when the received packets are ACKed, and measures how long the ACK was held.
+    """
+    __slots__ = ('max_ack_delay', 'threshold', 'max_ranges', 'packets', 'new_packets', 'largest_received',
+                 'largest_time', 'ack_eliciting', 'deadline', 'immediate_acks')
+
+    def __init__(self, max_ack_delay=MAX_ACK_DELAY, threshold=ACK_ELICITING_THRESHOLD, max_ranges=MAX_ACK_RANGES):
+        """
+        :param max_ack_delay: The longest time an ack-eliciting packet waits for its ACK, in ms
+        :param threshold: ACK once this many ack-eliciting packets arrived
+        :param max_ranges: The most ranges kept for the ACKs; older ones are dropped
+        """
+        self.max_ack_delay = max_ack_delay / 1000
+        self.threshold = threshold
+        self.max_ranges = max_ranges
+        # Every packet number received, repeated in every ACK
+        self.packets = api.RangeSet()
+        # True when a packet arrived since the last ACK
+        self.new_packets = False
+        # The largest packet number ever received, to spot gaps and reordering, and when it arrived
+        self.largest_received = None
+        self.largest_time = None
+        self.ack_eliciting = 0
+        self.deadline = None
+        self.immediate_acks = 0
+
+    def on_packet(self, packet_number, now, ack_eliciting=True, immediate=False):
+        """
+        Records a received packet and moves the ACK deadline.
+
+        :param ack_eliciting: False for packets that are ACKed with the next ACK but never cause one
+        :param immediate: ACK right away, for frames the client waits on
+        :return: True if the ACK is due now
+        """
+        out_of_order = self.largest_received is not None and packet_number != self.largest_received + 1
+        if self.largest_received is None or packet_number > self.largest_received:
+            self.largest_received = packet_number
+            self.largest_time = now
+        self.packets.add(packet_number)
+        self.packets.keep_last(self.max_ranges)
+        self.new_packets = True
+
+        if not ack_eliciting:
+            return False
+        self.ack_eliciting += 1
+        if immediate or out_of_order or self.ack_eliciting >= self.threshold:
+            if self.deadline is None or self.deadline > now:
+                self.immediate_acks += 1
+            self.deadline = now
+        elif self.deadline is None:
+            self.deadline = now + self.max_ack_delay
+        return self.deadline <= now
+
+    def build(self, now):
+        """
+        ACKs every packet received so far.
+
+        :return: (ACK ranges, ACK delay in ms), or None if no packet arrived since the last ACK
+        """
+        self.deadline = None
+        self.ack_eliciting = 0
+        if not self.new_packets:
+            return None
+        self.new_packets = False
+        # The time from the arrival of the largest ACKed packet until now. The field is a variable-length integer, which
+        # holds any delay
+        ack_delay = max(round((now - self.largest_time) * 1000), 0)
+        return self.packets.ack_ranges(), ack_delay
+
+
+class ServerConnection:
+    """
+    The state the server keeps for one client: its streams, the packet numbers waiting to be ACKed, and the flow
+    control limits given to the client.
+    """
+
+    def __init__(self, cid, client_cid, version, address, now, output_dir=None, max_data=QUIC_flow.INITIAL_MAX_DATA,
+                 max_stream_data=QUIC_flow.INITIAL_MAX_STREAM_DATA, shard=None, max_ack_delay=MAX_ACK_DELAY,
+                 ack_threshold=ACK_ELICITING_THRESHOLD):
+        """
+        :param cid: The server CID of this connection
+        :param client_cid: The client's CID, the DCID of every packet sent to the client
+        :param version: The negotiated wire format version
+        :param address: The client's address
+        :param now: The time the ClientHello arrived
+        :param output_dir: The directory the received streams are written to, or None to discard them
+        :param max_data: The connection flow control window
+        :param max_stream_data: The flow control window of every stream
+        :param shard: (transfer ID, offset, size, total size) from the ClientHello, or None
+        :param max_ack_delay: The longest an ACK is delayed, in ms
+        :param ack_threshold: ACK every this many ack-eliciting packets
+        """
+        self.cid = cid
+        self.client_cid = client_cid
+        self.version = version
+        self.address = address
+        self.output_dir = output_dir
+        self.shard = shard
+        self.streams = {}
+        self.ack = AckScheduler(max_ack_delay, ack_threshold)
+        self.packet_number = 1
+        self.acks_sent = 0
+        self.flow = QUIC_flow.ReceiveFlowControl(max_data, max_stream_data)
+        self.last_activity = now
+
+    @property
+    def ack_deadline(self):
+        return self.ack.deadline
+
+    @property
+    def largest_packet_number(self):
+        """
+        :return: The largest packet number received from the client, or -1, to decode the truncated packet numbers
+        """
+        return -1 if self.ack.largest_received is None else self.ack.largest_received
+
+    @property
+    def frames_received(self):
+        return sum(stream.frames for stream in self.streams.values())
+
+    def on_packet(self, packet_number, frame, now):
+        """
+        Records a received STREAM frame and schedules the ACK of its packet.
+
+        :param packet_number: The packet number of the packet carrying the frame
+        :param frame: The parsed frame
+        :return: False if the frame went past a flow control limit, and the connection must be closed
+        """
+        self.last_activity = now
+        stream_id = frame['stream_id']
+        fin = frame['frame_type'] & QUIC_streams.STREAM_FIN_BIT
+        if not self.flow.on_stream_frame(stream_id, frame['offset'] + len(frame['data']), fin):
+            return False
+
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            # The peer opens a stream by sending on it
+            stream = self.streams[stream_id] = self.open_stream(stream_id)
+        # The client waits on the ACK of data it sent again (below the end of what arrived) and of the end of a stream
+        immediate = fin or frame['offset'] < stream.received_end
+        stream.on_frame(frame['offset'], frame['data'], fin)
+        self.flow.on_consumed(stream_id, stream.consumed)
+        self.ack.on_packet(packet_number, now, immediate=immediate)
+        return True
+
+    def on_blocked(self, packet_number, frame, now):
+        """
+        Records a DATA_BLOCKED or STREAM_DATA_BLOCKED frame. The client can't send until it hears back, so the limit
+        is sent again with an ACK right away.
+        """
+        self.last_activity = now
+        self.flow.on_blocked(frame)
+        self.ack.on_packet(packet_number, now, immediate=True)
+
+    def open_stream(self, stream_id):
+        if self.shard is not None and stream_id == 0:
+            transfer_id, offset, _, total_size = self.shard
+            path = None if self.output_dir is None else os.path.join(self.output_dir, f"transfer_{transfer_id}")
+            return QUIC_streams.ReceiveStream(stream_id, path, offset, total_size)
+        return QUIC_streams.ReceiveStream(stream_id, self.stream_output_path(stream_id))
+
+    def stream_output_path(self, stream_id):
+        if self.output_dir is None:
+            return None
+        return os.path.join(self.output_dir, f"connection_{self.cid}_stream_{stream_id}")
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.close()
+
+    def statistics(self):
+        """
+        :return: A dictionary with the connection's totals
+        """
+        return {
+            'cid': self.cid,
+            'client_cid': self.client_cid,
+            'shard': self.shard,
+            'frames': self.frames_received,
+            'bytes': sum(stream.bytes_received for stream in self.streams.values()),
+            'streams': len(self.streams),
+            'complete_streams': sum(1 for stream in self.streams.values() if stream.complete),
+            'ack_packets': self.acks_sent,
+            'immediate_acks': self.ack.immediate_acks,
+            'window_updates': self.flow.updates_sent,
+            'blocked_frames': self.flow.blocked_received,
+        }
+
+    def build_ack(self, now):
+        """
+        ACKs the packet numbers received since the last ACK.
+
+        :param now: The current time, to measure the ACK delay reported in the ACK packet
+        :return: The ACK packet, or None if there is nothing to ACK
+        """
+        ack = self.ack.build(now)
+        if ack is None:
+            return None
+        ack_ranges, ack_delay = ack
+
+        ack_packet = api.encode_quic_ack_packet(self.client_cid, self.packet_number, ack_delay, ack_ranges,
+                                                self.version)
+        self.packet_number += 1
+        self.acks_sent += 1
+        return ack_packet
+
+    def build_window_updates(self):
+        """
+        Moves the flow control limits forward as the streams are consumed.
+
+        :return: A list of packets, one MAX_DATA or MAX_STREAM_DATA frame each
+        """
+        packets = []
+        for frame_type, stream_id, limit in self.flow.updates():
+            frame = api.encode_flow_control_frame(frame_type, limit, stream_id, self.version)
+            packets.append(api.encode_quic_short_packet(self.client_cid, self.packet_number, frame, self.version))
+            self.packet_number += 1
+        return packets
+
+
+class ConnectionTable:
+    """
+    The server's connections, keyed by their server CID and by (client address, client CID).
+    """
+
+    def __init__(self, first_cid=SERVER_CID, idle_timeout=IDLE_TIMEOUT, output_dir=None,
+                 max_data=QUIC_flow.INITIAL_MAX_DATA, max_stream_data=QUIC_flow.INITIAL_MAX_STREAM_DATA, cid_step=1,
+                 max_ack_delay=MAX_ACK_DELAY, ack_threshold=ACK_ELICITING_THRESHOLD):
+        """
+        :param first_cid: The server CID of the first connection; every new connection gets the CID cid_step after
+        the previous one
+        :param idle_timeout: Connections that receive nothing for this many seconds are evicted
+        :param output_dir: The directory the received streams are written to, or None to discard them
+        :param max_data: The connection flow control window of every connection
+        :param max_stream_data: The flow control window of every stream
+        :param cid_step: The gap between CIDs, so that tables of different processes never give out the same CID
+        :param max_ack_delay: The longest every connection delays an ACK, in ms
+        :param ack_threshold: Every connection ACKs every this many ack-eliciting packets
+        """
+        self.next_cid = first_cid
+        self.cid_step = cid_step
+        self.idle_timeout = idle_timeout
+        self.output_dir = output_dir
+        self.max_data = max_data
+        self.max_stream_data = max_stream_data
+        self.max_ack_delay = max_ack_delay
+        self.ack_threshold = ack_threshold
+        self.connections = {}
+        self.handshakes = {}
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(list(self.connections.values()))
+
+    def get(self, cid):
+        """
+        :param cid: The DCID of a short header packet
+        :return: The connection, or None if the CID is unknown
+        """
+        return self.connections.get(cid)
+
+    def accept(self, client_cid, version, address, now, shard=None):
+        """
+        Finds the connection of a ClientHello, or opens a new one.
+
+        :param shard: The shard metadata of the ClientHello, if it has any
+        :return: (connection, True if the connection is new)
+        """
+        connection = self.handshakes.get((address, client_cid))
+        if connection is not None:
+            return connection, False
+
+        connection = ServerConnection(self.next_cid, client_cid, version, address, now, self.output_dir, self.max_data,
+                                      self.max_stream_data, shard, self.max_ack_delay, self.ack_threshold)
+        self.next_cid += self.cid_step
+        self.connections[connection.cid] = connection
+        self.handshakes[(address, client_cid)] = connection
+        return connection, True
+
+    def remove(self, connection):
+        connection.close()
+        del self.connections[connection.cid]
+        del self.handshakes[(connection.address, connection.client_cid)]
+
+    def next_deadline(self):
+        """
+        :return: The earliest ACK or idle deadline of all connections, or None if there are no connections
+        """
+        deadline = None
+        for connection in self.connections.values():
+            connection_deadline = connection.last_activity + self.idle_timeout
+            if connection.ack_deadline is not None and connection.ack_deadline < connection_deadline:
+                connection_deadline = connection.ack_deadline
+            if deadline is None or connection_deadline < deadline:
+                deadline = connection_deadline
+        return deadline
+
+    def due_acks(self, now):
+        """
+        :return: The connections whose ACK delay ended
+        """
+        return [connection for connection in self.connections.values()
+                if connection.ack_deadline is not None and connection.ack_deadline <= now]
+
+    def evict_idle(self, now):
+        """
+        Removes the connections that were idle for longer than the idle timeout.
+
+        :return: The evicted connections
+        """
+        idle = [connection for connection in self.connections.values()
+                if now - connection.last_activity > self.idle_timeout]
+        for connection in idle:
+            self.remove(connection)
+        return idle
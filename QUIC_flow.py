@@ -0,0 +1,233 @@
+"""
+Flow control (RFC 9000, section 4): the receiver limits how much data the sender may send, on every stream and on the
+whole connection, so a fast sender can't make the receiver buffer without bound.
+
+The receiver advertises a limit (an absolute offset) and moves it forward with MAX_DATA / MAX_STREAM_DATA frames as it
+consumes the data, keeping a window of the same size ahead of what it consumed. A sender that reaches a limit stops and
+says so with a DATA_BLOCKED / STREAM_DATA_BLOCKED frame, which also makes the receiver repeat its current limit in case
+an update was lost. Both sides start from the same initial limits, which stand in for the transport parameters.
+All sizes are in bytes.
+"""
+import QUIC_api as api
+
+INITIAL_MAX_DATA = 4 * 1024 * 1024
+INITIAL_MAX_STREAM_DATA = 1024 * 1024
+
+
+class SendWindow:
+    """
+    The peer's limit on one stream or on the connection, and the data sent against it.
+    """
+    __slots__ = ('maximum', 'sent', 'blocked_at')
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.sent = 0
+        self.blocked_at = None
+
+    @property
+    def available(self):
+        return max(self.maximum - self.sent, 0)
+
+    def on_max(self, maximum):
+        """
+        Raises the limit. Limits never go down, so an update that arrives late is ignored.
+
+        :return: True if the limit was raised
+        """
+        if maximum <= self.maximum:
+            return False
+        self.maximum = maximum
+        return True
+
+
+class SendFlowControl:
+    """
+    The sender's side: how much more each stream, and the connection, may send.
+    """
+
+    def __init__(self, max_data=INITIAL_MAX_DATA, max_stream_data=INITIAL_MAX_STREAM_DATA):
+        """
+        :param max_data: The initial connection limit
+        :param max_stream_data: The initial limit of every stream
+        """
+        self.connection = SendWindow(max_data)
+        self.initial_max_stream_data = max_stream_data
+        self.streams = {}
+        self.data_blocked_sent = 0
+        self.stream_data_blocked_sent = 0
+        self.updates_received = 0
+
+    def stream(self, stream_id):
+        window = self.streams.get(stream_id)
+        if window is None:
+            window = self.streams[stream_id] = SendWindow(self.initial_max_stream_data)
+        return window
+
+    def credit(self, stream_id):
+        """
+        :return: How many new bytes the stream may send now
+        """
+        return min(self.connection.available, self.stream(stream_id).available)
+
+    def on_sent(self, stream_id, length):
+        """
+        Counts new stream data against the limits. Retransmissions aren't counted again.
+        """
+        self.connection.sent += length
+        self.stream(stream_id).sent += length
+
+    def on_frame(self, frame):
+        """
+        Applies a MAX_DATA or MAX_STREAM_DATA frame from the receiver.
+
+        :param frame: The decoded frame
+        :return: True if a limit was raised
+        """
+        if frame['frame_type'] == api.MAX_DATA_FRAME:
+            window = self.connection
+        elif frame['frame_type'] == api.MAX_STREAM_DATA_FRAME:
+            window = self.stream(frame['stream_id'])
+        else:
+            return False
+        self.updates_received += 1
+        return window.on_max(frame['offset'])
+
+    def blocked_frames(self, stream_ids, resend=False):
+        """
+        Finds the limits the sender is blocked at. Each limit is reported once, unless resend is set (when no update
+        arrived for a while, and the last one might have been lost).
+
+        :param stream_ids: The streams that still have data to send
+        :return: A list of (frame type, stream ID, limit)
+        """
+        frames = []
+        windows = [(api.DATA_BLOCKED_FRAME, 0, self.connection)]
+        windows += [(api.STREAM_DATA_BLOCKED_FRAME, stream_id, self.stream(stream_id)) for stream_id in stream_ids]
+        for frame_type, stream_id, window in windows:
+            if window.available or (window.blocked_at == window.maximum and not resend):
+                continue
+            window.blocked_at = window.maximum
+            frames.append((frame_type, stream_id, window.maximum))
+            if frame_type == api.DATA_BLOCKED_FRAME:
+                self.data_blocked_sent += 1
+            else:
+                self.stream_data_blocked_sent += 1
+        return frames
+
+    @property
+    def blocked_count(self):
+        return self.data_blocked_sent + self.stream_data_blocked_sent
+
+
+class ReceiveWindow:
+    """
+    The limit given to the peer on one stream or on the connection, the highest offset received, and how much of the
+    data was consumed.
+    """
+    __slots__ = ('window', 'maximum', 'received', 'consumed', 'update_pending', 'final')
+
+    def __init__(self, window, maximum):
+        """
+        :param window: How far ahead of the consumed data the limit is kept
+        :param maximum: The initial limit
+        """
+        self.window = window
+        self.maximum = maximum
+        self.received = 0
+        self.consumed = 0
+        self.update_pending = False
+        self.final = False
+
+    def next_maximum(self):
+        """
+        :return: The new limit to advertise, or None if the current one is still far enough ahead. The limit moves once
+        half the window was consumed, so an update goes out every half window rather than on every packet.
+        """
+        if self.final:
+            # The peer already sent the end of the stream
+            return None
+        maximum = self.consumed + self.window
+        if maximum - self.maximum >= self.window // 2 or self.update_pending:
+            self.update_pending = False
+            self.maximum = max(maximum, self.maximum)
+            return self.maximum
+        return None
+
+
+class ReceiveFlowControl:
+    """
+    The receiver's side: checks the received data against the limits, and builds the updates as data is consumed.
+    """
+
+    def __init__(self, max_data=INITIAL_MAX_DATA, max_stream_data=INITIAL_MAX_STREAM_DATA,
+                 initial_max_data=INITIAL_MAX_DATA, initial_max_stream_data=INITIAL_MAX_STREAM_DATA):
+        """
+        :param max_data: The connection window
+        :param max_stream_data: The window of every stream
+        :param initial_max_data: The connection limit the sender starts with
+        :param initial_max_stream_data: The limit every stream starts with
+        """
+        self.connection = ReceiveWindow(max_data, initial_max_data)
+        self.max_stream_data = max_stream_data
+        self.initial_max_stream_data = initial_max_stream_data
+        self.streams = {}
+        self.updates_sent = 0
+        self.blocked_received = 0
+
+    def stream(self, stream_id):
+        window = self.streams.get(stream_id)
+        if window is None:
+            window = self.streams[stream_id] = ReceiveWindow(self.max_stream_data, self.initial_max_stream_data)
+        return window
+
+    def on_stream_frame(self, stream_id, end, fin=False):
+        """
+        Checks a received STREAM frame against the limits.
+
+        :param end: The offset right after the frame's data
+        :param fin: True if the frame is the last one of the stream
+        :return: False if the frame goes past a limit (a FLOW_CONTROL_ERROR)
+        """
+        window = self.stream(stream_id)
+        new_bytes = max(end - window.received, 0)
+        if end > window.maximum or self.connection.received + new_bytes > self.connection.maximum:
+            return False
+        window.received += new_bytes
+        window.final = window.final or fin
+        self.connection.received += new_bytes
+        return True
+
+    def on_consumed(self, stream_id, consumed):
+        """
+        :param consumed: How many bytes from the start of the stream were consumed
+        """
+        window = self.stream(stream_id)
+        if consumed > window.consumed:
+            self.connection.consumed += consumed - window.consumed
+            window.consumed = consumed
+
+    def on_blocked(self, frame):
+        """
+        Handles a DATA_BLOCKED or STREAM_DATA_BLOCKED frame: the next updates repeat the limit even if it didn't move.
+        """
+        self.blocked_received += 1
+        if frame['frame_type'] == api.DATA_BLOCKED_FRAME:
+            self.connection.update_pending = True
+        else:
+            self.stream(frame['stream_id']).update_pending = True
+
+    def updates(self):
+        """
+        :return: The MAX_DATA and MAX_STREAM_DATA updates to send, as a list of (frame type, stream ID, limit)
+        """
+        frames = []
+        maximum = self.connection.next_maximum()
+        if maximum is not None:
+            frames.append((api.MAX_DATA_FRAME, 0, maximum))
+        for stream_id, window in self.streams.items():
+            maximum = window.next_maximum()
+            if maximum is not None:
+                frames.append((api.MAX_STREAM_DATA_FRAME, stream_id, maximum))
+        self.updates_sent += len(frames)
+        return frames
@@ -0,0 +1,209 @@
+"""
+Batched datagram I/O.
+
+On Linux, BatchSocketIO sends and receives many datagrams per system call with sendmmsg/recvmmsg (called through
+ctypes). Everywhere else, and for sockets the batch calls don't support, it falls back to one sendto/recvfrom_into per
+datagram behind the same interface.
+"""
+import ctypes
+import ctypes.util
+import errno
+import select
+import socket
+import sys
+
+BATCH_SIZE = 64
+MAX_DATAGRAM_SIZE = 2048
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint8 * 4), ('sin_zero', ctypes.c_uint8 * 8)]
+
+
+def load_mmsg_functions():
+    """
+    :return: (sendmmsg, recvmmsg) from libc, or None if they aren't available
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        sendmmsg = libc.sendmmsg
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return sendmmsg, recvmmsg
+
+
+MMSG_FUNCTIONS = load_mmsg_functions()
+
+
+def datagram_buffer(datagram):
+    """
+    :return: A ctypes buffer of the datagram. Writable buffers, like the PacketEncoder's, are used in place; other
+    buffers that aren't bytes are copied.
+    """
+    if isinstance(datagram, bytes):
+        return ctypes.c_char_p(datagram)
+    view = memoryview(datagram)
+    if view.readonly or not view.c_contiguous:
+        return ctypes.c_char_p(bytes(view))
+    return (ctypes.c_char * view.nbytes).from_buffer(view)
+
+
+class BatchSocketIO:
+    """
+    Sends and receives datagrams in batches on a non-blocking UDP socket. Received datagrams are memoryviews into
+    buffers owned by this object, and stay valid until the next call to receive.
+    """
+
+    def __init__(self, sock, batch_size=BATCH_SIZE, buffer_size=MAX_DATAGRAM_SIZE, use_mmsg=True):
+        """
+        :param sock: The UDP socket, non-blocking
+        :param batch_size: The most datagrams handled by a single call
+        :param buffer_size: The size of each receive buffer
+        :param use_mmsg: Set to False to force the one-syscall-per-datagram fallback
+        """
+        self.sock = sock
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.use_mmsg = use_mmsg and MMSG_FUNCTIONS is not None and sock.family == socket.AF_INET
+        self.send_calls = 0
+        self.receive_calls = 0
+
+        self.buffers = [bytearray(buffer_size) for _ in range(batch_size)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+
+        if self.use_mmsg:
+            self.sendmmsg, self.recvmmsg = MMSG_FUNCTIONS
+            # Receive side: one iovec and one address per buffer, all allocated once
+            self.receive_iovecs = (iovec * batch_size)()
+            self.receive_addresses = (sockaddr_in * batch_size)()
+            self.receive_headers = (mmsghdr * batch_size)()
+            for i, buffer in enumerate(self.buffers):
+                self.receive_iovecs[i].iov_base = ctypes.addressof((ctypes.c_char * buffer_size).from_buffer(buffer))
+                self.receive_iovecs[i].iov_len = buffer_size
+                header = self.receive_headers[i].msg_hdr
+                header.msg_name = ctypes.addressof(self.receive_addresses[i])
+                header.msg_iov = ctypes.pointer(self.receive_iovecs[i])
+                header.msg_iovlen = 1
+            # Send side: the iovecs are pointed at the outgoing datagrams on every call
+            self.send_iovecs = (iovec * batch_size)()
+            self.send_headers = (mmsghdr * batch_size)()
+            self.send_address = sockaddr_in()
+            self.send_address_key = None
+            for i in range(batch_size):
+                header = self.send_headers[i].msg_hdr
+                header.msg_name = ctypes.addressof(self.send_address)
+                header.msg_namelen = ctypes.sizeof(sockaddr_in)
+                header.msg_iov = ctypes.pointer(self.send_iovecs[i])
+                header.msg_iovlen = 1
+
+    def send(self, datagrams, address):
+        """
+        Sends all the datagrams to the same address.
+
+        :param datagrams: A list of bytes-like objects
+        :param address: (destination IP, destination port)
+        :return: The number of datagrams sent
+        """
+        if not self.use_mmsg:
+            for datagram in datagrams:
+                while True:
+                    try:
+                        self.sock.sendto(datagram, address)
+                        break
+                    except BlockingIOError:
+                        # The socket buffer is full: wait until it drains
+                        select.select([], [self.sock], [])
+                    finally:
+                        self.send_calls += 1
+            return len(datagrams)
+
+        if self.send_address_key != address:
+            self.send_address.sin_family = socket.AF_INET
+            self.send_address.sin_port = socket.htons(address[1])
+            self.send_address.sin_addr[:] = socket.inet_aton(socket.gethostbyname(address[0]))
+            self.send_address_key = address
+
+        sent = 0
+        while sent < len(datagrams):
+            batch = datagrams[sent:sent + self.batch_size]
+            # Keep the buffers alive until the system call returns
+            buffers = [datagram_buffer(datagram) for datagram in batch]
+            for i, buffer in enumerate(buffers):
+                self.send_iovecs[i].iov_base = ctypes.cast(buffer, ctypes.c_void_p)
+                self.send_iovecs[i].iov_len = len(batch[i])
+
+            result = self.sendmmsg(self.sock.fileno(), self.send_headers, len(buffers), 0)
+            self.send_calls += 1
+            if result < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # The socket buffer is full: wait until it drains
+                    select.select([], [self.sock], [])
+                    continue
+                raise OSError(error, 'sendmmsg failed')
+            sent += result
+        return sent
+
+    def receive(self):
+        """
+        Receives the datagrams that are already waiting on the socket, without blocking.
+
+        :return: A list of (datagram, address) pairs, empty if nothing was waiting
+        """
+        if not self.use_mmsg:
+            return self.receive_fallback()
+
+        for i in range(self.batch_size):
+            self.receive_headers[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+        result = self.recvmmsg(self.sock.fileno(), self.receive_headers, self.batch_size, MSG_DONTWAIT, None)
+        self.receive_calls += 1
+        if result < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise OSError(error, 'recvmmsg failed')
+
+        datagrams = []
+        for i in range(result):
+            address = self.receive_addresses[i]
+            datagrams.append((self.views[i][:self.receive_headers[i].msg_len],
+                              (socket.inet_ntoa(bytes(address.sin_addr)), socket.ntohs(address.sin_port))))
+        return datagrams
+
+    def receive_fallback(self):
+        # The socket doesn't block, so running out of datagrams raises BlockingIOError
+        datagrams = []
+        for view in self.views:
+            try:
+                nbytes, address = self.sock.recvfrom_into(view)
+            except (BlockingIOError, socket.timeout):
+                break
+            finally:
+                self.receive_calls += 1
+            datagrams.append((view[:nbytes], address))
+        return datagrams
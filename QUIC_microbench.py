@@ -0,0 +1,338 @@
+"""
+Microbenchmarks for the QUIC_api codecs: the time and the memory every frame, packet and ACK builder and parser costs
+per call, in both wire format versions.
+
+Every case runs with representative sizes: STREAM frames and packets with PAYLOAD_SIZES bytes of data, and ACKs with
+ACK_RANGE_COUNTS ranges. The time is the best of a few repeats of a loop long enough to time, in ns per call. With
+--memory, tracemalloc then measures every call's peak memory (what it allocated, freed or not) and the memory its result
+keeps, in bytes. tracemalloc slows everything down, so it runs after the timing.
+
+--against loads a second QUIC_api, from a file or from a git revision, and runs every case on both side by side: to see
+what a change to the codecs costs before committing it, e.g. --against HEAD~1. A codec from before the wire format
+versions (the encode_*/decode_* functions) runs the cases on its bit-string construct_*/parse_* functions instead, in
+version 1 only.
+
+Usage:
+    python QUIC_microbench.py [-c CASE ...] [-q VERSION ...] [--memory] [--against FILE_OR_REVISION] [--json FILE]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import QUIC_api
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+PAYLOAD_SIZES = (16, 512, 2000)
+ACK_RANGE_COUNTS = (1, 4, 16, 64)
+# Packet numbers of a connection well into its transfer, so they take more than one byte
+PACKET_NUMBER = 100000
+DCID = 2
+STREAM_FRAME = 0x08
+MAX_DATA_FRAME = 0x10
+# Time a loop for at least this long, and keep the best of this many loops
+MIN_TIME = 0.05  # in seconds
+REPEATS = 5
+MEMORY_CALLS = 100
+
+
+def payload(size):
+    return bytes(ord('a') + i % 26 for i in range(size))
+
+
+def ack_ranges(count):
+    """
+    :return: count ranges of 5 packets, 4 packets apart, the newest ending at PACKET_NUMBER
+    """
+    return [(PACKET_NUMBER - 9 * i - 4, PACKET_NUMBER - 9 * i) for i in range(count)]
+
+
+def legacy(api, version):
+    """
+    :return: True if the codec is from before the wire format versions, so the case falls back on its bit-string
+    construct_*/parse_* functions, with the data as text and the packets encoded as the sender did
+    """
+    if hasattr(api, 'encode_quic_frame'):
+        return False
+    if version != QUIC_api.QUIC_VERSION_BITSTRING:
+        raise ValueError(f"the codec has no wire format version {version}")
+    return True
+
+
+# Every case is set up with (codec, version, parameter) and returns the call to measure
+
+def frame_encode(api, version, size):
+    if legacy(api, version):
+        text = payload(size).decode('latin-1')
+        return lambda: api.construct_quic_frame(STREAM_FRAME, 4, PACKET_NUMBER * 2000, text)
+    data = payload(size)
+    return lambda: api.encode_quic_frame(STREAM_FRAME, 4, PACKET_NUMBER * 2000, data, version)
+
+
+def frame_decode(api, version, size):
+    if legacy(api, version):
+        frame = api.construct_quic_frame(STREAM_FRAME, 4, PACKET_NUMBER * 2000, payload(size).decode('latin-1'))
+        return lambda: api.parse_quic_frame(frame)['data']
+    frame = api.encode_quic_frame(STREAM_FRAME, 4, PACKET_NUMBER * 2000, payload(size), version)
+    return lambda: api.decode_quic_frame(frame, version)['data']
+
+
+def flow_control_frame_encode(api, version, _):
+    return lambda: api.encode_flow_control_frame(MAX_DATA_FRAME, 4 * 1024 * 1024, 0, version)
+
+
+def short_packet_encode(api, version, size):
+    if legacy(api, version):
+        frame = api.construct_quic_frame(STREAM_FRAME, 4, PACKET_NUMBER * 2000, payload(size).decode('latin-1'))
+        return lambda: api.construct_quic_short_header_binary(DCID, PACKET_NUMBER, frame).encode('latin-1')
+    frame = api.encode_quic_frame(STREAM_FRAME, 4, PACKET_NUMBER * 2000, payload(size), version)
+    return lambda: api.encode_quic_short_packet(DCID, PACKET_NUMBER, frame, version, PACKET_NUMBER - 64)
+
+
+def short_packet_decode(api, version, size):
+    if legacy(api, version):
+        frame = api.construct_quic_frame(STREAM_FRAME, 4, PACKET_NUMBER * 2000, payload(size).decode('latin-1'))
+        packet = api.construct_quic_short_header_binary(DCID, PACKET_NUMBER, frame).encode('latin-1')
+        return lambda: api.parse_quic_short_header_binary(packet.decode('latin-1'))['payload']
+    frame = api.encode_quic_frame(STREAM_FRAME, 4, PACKET_NUMBER * 2000, payload(size), version)
+    packet = api.encode_quic_short_packet(DCID, PACKET_NUMBER, frame, version, PACKET_NUMBER - 64)
+    return lambda: api.decode_quic_short_packet(packet, version, PACKET_NUMBER - 1)['payload']
+
+
+def packet_encoder(api, version, size):
+    """
+    The sender's path: a packet built from a frame reference, with the data copied from a memoryview of the file.
+    Before PacketEncoder, the sender built the frame and then the packet around it.
+    """
+    frame = types.SimpleNamespace(frame_type=STREAM_FRAME, stream_id=4, offset=PACKET_NUMBER * 2000,
+                                  data=memoryview(payload(size)))
+    if legacy(api, version):
+        return lambda: api.construct_quic_short_header_binary(DCID, PACKET_NUMBER, api.construct_quic_frame(
+            frame.frame_type, frame.stream_id, frame.offset, bytes(frame.data).decode('latin-1'))).encode('latin-1')
+    if not hasattr(api, 'PacketEncoder'):
+        return lambda: api.encode_quic_short_packet(DCID, PACKET_NUMBER, api.encode_quic_frame(
+            frame.frame_type, frame.stream_id, frame.offset, frame.data, version), version, PACKET_NUMBER - 64)
+    encoder = api.PacketEncoder(DCID, version)
+    return lambda: encoder.encode(PACKET_NUMBER, frame, PACKET_NUMBER - 64)
+
+
+def ack_encode(api, version, count):
+    ranges = ack_ranges(count)
+    if legacy(api, version):
+        return lambda: api.construct_quic_ack_packet(DCID, PACKET_NUMBER, 20, ranges).encode()
+    return lambda: api.encode_quic_ack_packet(DCID, PACKET_NUMBER, 20, ranges, version)
+
+
+def ack_decode(api, version, count):
+    if legacy(api, version):
+        packet = api.construct_quic_ack_packet(DCID, PACKET_NUMBER, 20, ack_ranges(count)).encode()
+        return lambda: api.parse_quic_ack_packet(packet.decode())['ack_ranges']
+    packet = api.encode_quic_ack_packet(DCID, PACKET_NUMBER, 20, ack_ranges(count), version)
+    return lambda: api.decode_quic_ack_packet(packet, version)['ack_ranges']
+
+
+def hello(api):
+    return api.hello_data('Client') if hasattr(api, 'hello_data') else 'ClientHello'
+
+
+def long_header_encode(api, version, _):
+    frame = api.construct_quic_frame(0, 0, 0, hello(api))
+    return lambda: api.construct_quic_long_header(0, version, DCID, 1, frame).encode()
+
+
+def long_header_decode(api, version, _):
+    packet = api.construct_quic_long_header(0, version, DCID, 1, api.construct_quic_frame(0, 0, 0, hello(api))).encode()
+    return lambda: api.parse_quic_long_header(packet)
+
+
+CASES = {
+    'frame encode': (frame_encode, PAYLOAD_SIZES),
+    'frame decode': (frame_decode, PAYLOAD_SIZES),
+    'flow control frame encode': (flow_control_frame_encode, (None,)),
+    'short packet encode': (short_packet_encode, PAYLOAD_SIZES),
+    'short packet decode': (short_packet_decode, PAYLOAD_SIZES),
+    'packet encoder': (packet_encoder, PAYLOAD_SIZES),
+    'ack encode': (ack_encode, ACK_RANGE_COUNTS),
+    'ack decode': (ack_decode, ACK_RANGE_COUNTS),
+    'long header encode': (long_header_encode, (None,)),
+    'long header decode': (long_header_decode, (None,)),
+}
+
+
+def time_call(call, min_time=MIN_TIME, repeats=REPEATS):
+    """
+    :return: The time of one call in ns, the best of repeats loops of at least min_time seconds each
+    """
+    # Find a loop length that takes at least min_time
+    number = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(number):
+            call()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9:
+            break
+        number *= 10 if elapsed < min_time * 1e8 else 2
+
+    best = elapsed
+    for _ in range(repeats - 1):
+        start = time.perf_counter_ns()
+        for _ in range(number):
+            call()
+        best = min(best, time.perf_counter_ns() - start)
+    return best / number
+
+
+def measure_memory(call, calls=MEMORY_CALLS):
+    """
+    Measures with tracemalloc, which must not be tracing yet.
+
+    :return: (the peak memory of one call, the memory one call's result keeps), in bytes, the smallest of calls calls
+    """
+    call()
+    tracemalloc.start()
+    try:
+        peaks = []
+        kept = []
+        for _ in range(calls):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            result = call()
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            kept.append(current - before)
+            del result
+    finally:
+        tracemalloc.stop()
+    return min(peaks), min(kept)
+
+
+def run_cases(api, cases=None, versions=QUIC_api.SUPPORTED_VERSIONS, memory=False, min_time=MIN_TIME,
+              repeats=REPEATS):
+    """
+    Runs the cases on one codec.
+
+    :param api: The codec: QUIC_api, or a module loaded with load_codec
+    :param cases: The names of the cases to run (default: all of CASES)
+    :param versions: The wire format versions to run them in
+    :param memory: Also measure the memory of every call with tracemalloc
+    :return: A dictionary of result dictionaries by (case, version, parameter), with 'ns' and, with memory, 'peak_bytes'
+    and 'kept_bytes'. A case the codec can't run gets 'error' instead.
+    """
+    results = {}
+    for name in cases or CASES:
+        setup, parameters = CASES[name]
+        for version in versions:
+            for parameter in parameters:
+                try:
+                    call = setup(api, version, parameter)
+                    call()
+                except Exception as error:
+                    results[(name, version, parameter)] = {'error': f"{type(error).__name__}: {error}"}
+                    continue
+                result = {'ns': time_call(call, min_time, repeats)}
+                if memory:
+                    result['peak_bytes'], result['kept_bytes'] = measure_memory(call)
+                results[(name, version, parameter)] = result
+    return results
+
+
+def load_codec(source):
+    """
+    :param source: The path of a QUIC_api.py, or a git revision of this repository to take QUIC_api.py from
+    :return: The codec, loaded as a module of its own next to the current QUIC_api
+    """
+    if os.path.isfile(source):
+        path = source
+    else:
+        code = subprocess.run(['git', 'show', f'{source}:QUIC_api.py'], cwd=ROOT, capture_output=True, text=True)
+        if code.returncode != 0:
+            raise ValueError(f"{source} is neither a file nor a revision with a QUIC_api.py: {code.stderr.strip()}")
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'QUIC_api.py')
+        with open(path, 'w') as file:
+            file.write(code.stdout)
+    name = f'QUIC_api_{abs(hash(source))}'
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def format_parameter(name, parameter):
+    if parameter is None:
+        return ''
+    return f'{parameter} ranges' if name.startswith('ack') else f'{parameter} B'
+
+
+def format_result(result, memory):
+    if result is None or 'error' in result:
+        return f"{'-':>10}" + (f"{'':>18}" if memory else '')
+    line = f"{result['ns']:>10.0f}"
+    if memory:
+        line += f"{result['peak_bytes']:>9}{result['kept_bytes']:>9}"
+    return line
+
+
+def print_results(results, other=None, memory=False):
+    """
+    Prints a row per case, with the other codec's results and their ratio beside them, and then the errors of both.
+    """
+    header = f"{'case':<27}{'version':>8}{'size':>12}{'ns/op':>10}" + (f"{'peak B':>9}{'kept B':>9}" if memory else '')
+    if other is not None:
+        header += f"{'other ns/op':>12}" + (f"{'peak B':>9}{'kept B':>9}" if memory else '') + f"{'ratio':>8}"
+    print(header)
+    for (name, version, parameter), result in results.items():
+        line = (f"{name:<27}{version:>8}{format_parameter(name, parameter):>12}"
+                f"{format_result(result, memory)}")
+        if other is not None:
+            other_result = other.get((name, version, parameter))
+            line += f"  {format_result(other_result, memory)}"
+            if 'ns' in result and other_result is not None and 'ns' in other_result:
+                line += f"{other_result['ns'] / result['ns']:>8.2f}"
+        print(line)
+    for label, codec_results in (('', results), ('other: ', other or {})):
+        for (name, version, parameter), result in codec_results.items():
+            if 'error' in result:
+                print(f"{label}{name} v{version} {format_parameter(name, parameter)}: {result['error']}")
+
+
+def to_json(results):
+    return [{'case': name, 'version': version, 'parameter': parameter, **result}
+            for (name, version, parameter), result in results.items()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time and memory per call of the QUIC_api frame, packet and ACK "
+                                                 "builders and parsers")
+    parser.add_argument("-c", "--cases", nargs='+', default=None, choices=CASES, metavar='CASE',
+                        help=f"The cases to run (default: all of {', '.join(CASES)})")
+    parser.add_argument("-q", "--quic-version", type=int, nargs='+', default=list(QUIC_api.SUPPORTED_VERSIONS),
+                        choices=QUIC_api.SUPPORTED_VERSIONS, help="The wire format versions (default: both)")
+    parser.add_argument("--memory", action='store_true',
+                        help="Also measure the peak and kept memory of every call with tracemalloc")
+    parser.add_argument("--against", default=None,
+                        help="Run the cases on another QUIC_api too: a file, or a git revision (e.g. HEAD~1)")
+    parser.add_argument("--json", default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run_cases(QUIC_api, args.cases, args.quic_version, args.memory)
+    other = None
+    if args.against is not None:
+        other = run_cases(load_codec(args.against), args.cases, args.quic_version, args.memory)
+    print_results(results, other, args.memory)
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump({'python': sys.version, 'results': to_json(results),
+                       'against': None if other is None else {'source': args.against, 'results': to_json(other)}},
+                      file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
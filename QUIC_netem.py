@@ -0,0 +1,395 @@
+"""
+Network emulator: a UDP relay between the clients and a server that impairs the datagrams it forwards, in place of
+`tc qdisc ... netem` on the loopback interface.
+
+Each direction has its own LinkModel, which can add random or bursty (Gilbert-Elliott) loss, a delay with jitter,
+reordering, duplication and a rate limit with a bounded queue. Every model draws from its own random.Random, seeded
+from one seed, so the same seed and the same traffic give the same impairments. The relay needs no privileges and
+leaves the host's interfaces alone. It runs in a thread of a test (BackgroundRelay) or from the command line, with
+the client pointed at the relay's port.
+
+Usage:
+    python QUIC_netem.py [--port PORT] [--server-port SERVER_PORT] [-l LOSS] [--burst BURST] [--delay DELAY]
+                         [--jitter JITTER] [--reorder REORDER] [--duplicate DUPLICATE] [--rate RATE] [--seed SEED]
+"""
+import argparse
+import asyncio
+import collections
+import random
+import threading
+
+SERVER_IP = '127.0.0.1'
+SERVER_PORT = 9997
+RELAY_PORT = 9996
+# Packets waiting for a rate limited link before new ones are dropped, as netem's default limit
+QUEUE_LIMIT = 1000
+
+
+class GilbertElliott:
+    """
+    Bursty loss: a two state Markov chain. Every packet first moves the chain from the good state to the bad one with
+    probability p, or back with probability r, and is then lost with the loss probability of the new state. Losses
+    come in bursts of 1 / r packets on average.
+    """
+
+    def __init__(self, p, r, loss_bad=1.0, loss_good=0.0):
+        """
+        :param p: The probability of moving from the good state to the bad one
+        :param r: The probability of moving from the bad state back to the good one
+        :param loss_bad: The loss probability in the bad state
+        :param loss_good: The loss probability in the good state
+        """
+        self.p = p
+        self.r = r
+        self.loss_bad = loss_bad
+        self.loss_good = loss_good
+        self.bad = False
+
+    @classmethod
+    def from_loss(cls, loss, burst):
+        """
+        :param loss: The average loss rate
+        :param burst: The average number of packets lost in a row
+        :return: A model that loses every packet in the bad state, with the given average loss and burst length
+        """
+        r = 1 / burst
+        return cls(loss * r / (1 - loss), r)
+
+    @property
+    def average_loss(self):
+        bad_share = self.p / (self.p + self.r) if self.p + self.r else 0
+        return bad_share * self.loss_bad + (1 - bad_share) * self.loss_good
+
+    def lost(self, rng):
+        """
+        :param rng: The random.Random of the link
+        :return: True if the next packet is lost
+        """
+        if self.bad:
+            self.bad = rng.random() >= self.r
+        else:
+            self.bad = rng.random() < self.p
+        return rng.random() < (self.loss_bad if self.bad else self.loss_good)
+
+
+class LinkModel:
+    """
+    The impairments of one direction of a link. For every datagram, deliveries() says when its copies arrive at the
+    other side: none if it is lost, two if it is duplicated.
+
+    With a rate, datagrams are sent one after the other at the rate, and the ones that find QUEUE_LIMIT datagrams
+    waiting are dropped. Every copy is then delayed by the delay plus a uniform jitter. As in netem, a reordered
+    datagram skips the delay and so overtakes the datagrams sent before it, and jitter larger than the gap between two
+    datagrams reorders them too.
+    """
+
+    def __init__(self, loss=0.0, gilbert_elliott=None, delay=0.0, jitter=0.0, reorder=0.0, duplicate=0.0, rate=None,
+                 queue_limit=QUEUE_LIMIT, seed=0):
+        """
+        :param loss: The probability of losing a datagram, when gilbert_elliott is None
+        :param gilbert_elliott: A GilbertElliott model for bursty loss
+        :param delay: The one way delay in seconds
+        :param jitter: The delay varies uniformly by up to this many seconds either way
+        :param reorder: The probability of a datagram skipping the delay
+        :param duplicate: The probability of delivering a datagram twice
+        :param rate: The link rate in bytes per second, or None for no limit
+        :param queue_limit: How many datagrams may wait for a rate limited link
+        :param seed: The seed of the link's random.Random
+        """
+        self.loss = loss
+        self.gilbert_elliott = gilbert_elliott
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.rate = rate
+        self.queue_limit = queue_limit
+        self.rng = random.Random(seed)
+        # When the datagrams in the rate limiter's queue finish their transmission
+        self.queue = collections.deque()
+        self.link_free = 0.0
+
+        self.packets = 0
+        self.lost = 0
+        self.queue_drops = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+    def is_lost(self):
+        if self.gilbert_elliott is not None:
+            return self.gilbert_elliott.lost(self.rng)
+        return self.loss > 0 and self.rng.random() < self.loss
+
+    def deliveries(self, size, now):
+        """
+        Decides the fate of one datagram.
+
+        :param size: The datagram's size in bytes
+        :param now: The time the datagram was sent, in seconds
+        :return: A list of the times its copies arrive, empty if it was lost
+        """
+        self.packets += 1
+        if self.rate is not None:
+            while self.queue and self.queue[0] <= now:
+                self.queue.popleft()
+            if len(self.queue) >= self.queue_limit:
+                self.queue_drops += 1
+                return []
+        if self.is_lost():
+            self.lost += 1
+            return []
+
+        copies = 1
+        if self.duplicate > 0 and self.rng.random() < self.duplicate:
+            copies = 2
+            self.duplicated += 1
+
+        times = []
+        for _ in range(copies):
+            sent = now
+            if self.rate is not None:
+                sent = self.link_free = max(now, self.link_free) + size / self.rate
+                self.queue.append(sent)
+            if self.reorder > 0 and self.rng.random() < self.reorder:
+                self.reordered += 1
+                times.append(sent)
+            else:
+                times.append(sent + max(self.delay + self.rng.uniform(-self.jitter, self.jitter), 0))
+        return times
+
+    def statistics(self):
+        return {
+            'packets': self.packets,
+            'lost': self.lost,
+            'queue_drops': self.queue_drops,
+            'duplicated': self.duplicated,
+            'reordered': self.reordered,
+        }
+
+
+class ClientSide(asyncio.DatagramProtocol):
+    """
+    The relay's listening socket, which receives the datagrams of every client.
+    """
+
+    def __init__(self, relay):
+        self.relay = relay
+
+    def datagram_received(self, data, address):
+        self.relay.from_client(data, address)
+
+
+class ServerSide(asyncio.DatagramProtocol):
+    """
+    The socket of one client towards the server, so the server sees every client at its own address.
+    """
+
+    def __init__(self, relay, client_address):
+        self.relay = relay
+        self.client_address = client_address
+
+    def datagram_received(self, data, address):
+        self.relay.from_server(data, self.client_address)
+
+
+class NetemRelay:
+    """
+    Forwards datagrams between clients and a server through two LinkModels: the uplink from the clients to the server
+    and the downlink back. Every datagram is held back with a loop timer until the time its link model gives.
+    """
+
+    def __init__(self, server_address=(SERVER_IP, SERVER_PORT), uplink=None, downlink=None):
+        """
+        :param server_address: Where the datagrams of the clients go
+        :param uplink: The LinkModel of the datagrams from the clients (default: a perfect link)
+        :param downlink: The LinkModel of the datagrams from the server (default: a perfect link)
+        """
+        self.server_address = server_address
+        self.uplink = uplink or LinkModel()
+        self.downlink = downlink or LinkModel()
+        self.loop = None
+        self.transport = None
+        self.address = None
+        # Client address -> its transport towards the server, or a list of the datagrams waiting for it to open
+        self.upstreams = {}
+
+    async def start(self, host=SERVER_IP, port=RELAY_PORT):
+        """
+        Opens the listening socket. The clients send to relay.address (port 0 picks a free port).
+        """
+        self.loop = asyncio.get_running_loop()
+        self.transport, _ = await self.loop.create_datagram_endpoint(lambda: ClientSide(self), local_addr=(host, port))
+        self.address = self.transport.get_extra_info('sockname')[:2]
+
+    def close(self):
+        for upstream in self.upstreams.values():
+            if isinstance(upstream, asyncio.DatagramTransport):
+                upstream.close()
+        self.upstreams = {}
+        if self.transport is not None:
+            self.transport.close()
+
+    def from_client(self, data, client_address):
+        if client_address not in self.upstreams:
+            self.upstreams[client_address] = []
+            self.loop.create_task(self.open_upstream(client_address))
+        for arrival in self.uplink.deliveries(len(data), self.loop.time()):
+            self.loop.call_at(arrival, self.to_server, data, client_address)
+
+    def from_server(self, data, client_address):
+        for arrival in self.downlink.deliveries(len(data), self.loop.time()):
+            self.loop.call_at(arrival, self.transport.sendto, data, client_address)
+
+    async def open_upstream(self, client_address):
+        transport, _ = await self.loop.create_datagram_endpoint(lambda: ServerSide(self, client_address),
+                                                                remote_addr=self.server_address)
+        waiting = self.upstreams.get(client_address)
+        if waiting is None:
+            # The relay was closed meanwhile
+            transport.close()
+            return
+        self.upstreams[client_address] = transport
+        for data in waiting:
+            transport.sendto(data)
+
+    def to_server(self, data, client_address):
+        upstream = self.upstreams.get(client_address)
+        if isinstance(upstream, list):
+            upstream.append(data)
+        elif upstream is not None:
+            upstream.sendto(data)
+
+    def statistics(self):
+        return {'uplink': self.uplink.statistics(), 'downlink': self.downlink.statistics()}
+
+
+def symmetric_relay(server_address=(SERVER_IP, SERVER_PORT), seed=0, **impairments):
+    """
+    :param impairments: Keyword arguments for both LinkModels; a gilbert_elliott model is copied for the downlink
+    :return: A NetemRelay that impairs both directions the same way, with different seeds
+    """
+    downlink_impairments = dict(impairments)
+    model = impairments.get('gilbert_elliott')
+    if model is not None:
+        downlink_impairments['gilbert_elliott'] = GilbertElliott(model.p, model.r, model.loss_bad, model.loss_good)
+    return NetemRelay(server_address, LinkModel(seed=seed, **impairments),
+                      LinkModel(seed=seed + 1, **downlink_impairments))
+
+
+class BackgroundRelay:
+    """
+    Runs a NetemRelay on its own event loop in a daemon thread, so blocking code (a test, or a client and server started
+    as processes) can use it. Use it as a context manager, or call start() and stop().
+    """
+
+    def __init__(self, relay, host=SERVER_IP, port=RELAY_PORT):
+        self.relay = relay
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.error = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.relay.start(self.host, self.port))
+        except OSError as error:
+            self.error = error
+            self.ready.set()
+            self.loop.close()
+            return
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.relay.close()
+            # Let the transports finish closing
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
+
+    def start(self):
+        """
+        :return: The address the clients should send to
+        """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self.relay.address
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self.relay
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+async def run_relay(relay, host=SERVER_IP, port=RELAY_PORT):
+    """
+    Runs the relay until it is cancelled (Ctrl-C).
+    """
+    await relay.start(host, port)
+    print(f"Relay listening on {relay.address[0]}:{relay.address[1]}, forwarding to "
+          f"{relay.server_address[0]}:{relay.server_address[1]}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        relay.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP relay that emulates loss, delay, reordering, duplication and a "
+                                                 "rate limit between QUIC clients and a server")
+    parser.add_argument("--port", type=int, default=RELAY_PORT,
+                        help=f"The port the clients send to (default: {RELAY_PORT})")
+    parser.add_argument("--server-port", type=int, default=SERVER_PORT,
+                        help=f"The port of the server (default: {SERVER_PORT})")
+    parser.add_argument("-l", "--loss", type=float, default=0,
+                        help="Loss rate in percent, in each direction (default: 0)")
+    parser.add_argument("--burst", type=float, default=None,
+                        help="Average loss burst length in packets. Makes the loss bursty (Gilbert-Elliott).")
+    parser.add_argument("--delay", type=float, default=0, help="One way delay in ms (default: 0)")
+    parser.add_argument("--jitter", type=float, default=0, help="Delay variation in ms, either way (default: 0)")
+    parser.add_argument("--reorder", type=float, default=0,
+                        help="Percent of datagrams that skip the delay and overtake the others (default: 0)")
+    parser.add_argument("--duplicate", type=float, default=0,
+                        help="Percent of datagrams delivered twice (default: 0)")
+    parser.add_argument("--rate", type=float, default=None, help="Link rate in Mbit/s (default: no limit)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the impairments (default: 0)")
+    args = parser.parse_args()
+
+    impairments = {
+        'delay': args.delay / 1000,
+        'jitter': args.jitter / 1000,
+        'reorder': args.reorder / 100,
+        'duplicate': args.duplicate / 100,
+        'rate': None if args.rate is None else args.rate * 1000 * 1000 / 8,
+    }
+    if args.burst is not None and args.loss > 0:
+        impairments['gilbert_elliott'] = GilbertElliott.from_loss(args.loss / 100, args.burst)
+    else:
+        impairments['loss'] = args.loss / 100
+    relay = symmetric_relay((SERVER_IP, args.server_port), args.seed, **impairments)
+    try:
+        asyncio.run(run_relay(relay, port=args.port))
+    except KeyboardInterrupt:
+        pass
+    for direction, statistics in relay.statistics().items():
+        print(f"{direction}: {statistics['packets']} datagrams, {statistics['lost']} lost, "
+              f"{statistics['queue_drops']} dropped by the queue, {statistics['duplicated']} duplicated, "
+              f"{statistics['reordered']} reordered")
+
+
+if __name__ == '__main__':
+    main()
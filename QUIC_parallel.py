@@ -0,0 +1,138 @@
+"""
+Parallel client: one large file split into byte ranges (shards), each sent over its own connection.
+
+A single connection is limited by one socket, one congestion window and one core. Sending K shards over K connections,
+each with its own CID, from a pool of processes (or threads) fills a high-BDP link sooner. Every ClientHello carries the
+shard metadata (transfer ID, offset, size and total size), so the server writes every shard at its offset into one
+output file, transfer_<ID> in its output directory. The statistics of the connections are merged into one report.
+
+Usage:
+    python QUIC_parallel.py [-k CONNECTIONS] [-f FILE] [--threads] [-q VERSION] [-c CONGESTION] [--port PORT]
+"""
+import argparse
+import asyncio
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import QUIC_api as api
+import QUIC_asyncio
+import QUIC_congestion as congestion_control
+
+# Statistics that add up over the connections
+SUMMED_STATISTICS = ('file_size', 'unique_packets', 'retransmissions', 'time_retransmissions',
+                     'packet_number_retransmissions', 'data_blocked', 'stream_data_blocked', 'window_updates')
+
+
+def shard_ranges(size, count):
+    """
+    Splits a file into count ranges that differ in size by one byte at most.
+
+    :return: A list of (offset, size)
+    """
+    base, extra = divmod(size, count)
+    ranges = []
+    offset = 0
+    for index in range(count):
+        length = base + 1 if index < extra else base
+        ranges.append((offset, length))
+        offset += length
+    return ranges
+
+
+def send_shard(file_path, shard, client_cid, host, port, options):
+    """
+    Sends one shard over its own connection, in a worker of the pool.
+
+    :return: The connection's statistics dictionary
+    """
+    return asyncio.run(QUIC_asyncio.run_client([file_path], host, port, client_cid=client_cid, shard=shard,
+                                               **options))
+
+
+def merge_statistics(results, total_time):
+    """
+    Merges the statistics of the connections of one transfer.
+
+    :param results: The statistics dictionaries of the connections
+    :param total_time: The time from the first connection's start to the last connection's end
+    :return: A dictionary with the summed statistics, the bandwidth of the whole transfer and the results themselves
+    """
+    merged = {key: sum(result[key] for result in results) for key in SUMMED_STATISTICS}
+    merged['connections'] = len(results)
+    merged['total_time'] = total_time
+    merged['bandwidth'] = merged['file_size'] / total_time / 1024 / 1024
+    merged['smoothed_rtt'] = sum(result['smoothed_rtt'] for result in results) / len(results)
+    merged['per_connection'] = results
+    return merged
+
+
+def run_parallel(file_path, connections, host=QUIC_asyncio.SERVER_IP, port=QUIC_asyncio.SERVER_PORT,
+                 use_threads=False, first_cid=1, **options):
+    """
+    Sends a file split into shards over several connections at once.
+
+    :param connections: The number of connections (and shards)
+    :param use_threads: Run the connections in a thread pool instead of a process pool
+    :param first_cid: The CID of the first connection; the others get the next ones
+    :param options: Keyword arguments for QuicClientProtocol
+    :return: The merged statistics, as in merge_statistics, with the transfer ID
+    """
+    total_size = os.path.getsize(file_path)
+    transfer_id = random.getrandbits(32)
+    pool = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+
+    start_time = QUIC_asyncio.now()
+    with pool(max_workers=connections) as executor:
+        futures = [executor.submit(send_shard, file_path, (transfer_id, offset, size, total_size), first_cid + index,
+                                   host, port, options)
+                   for index, (offset, size) in enumerate(shard_ranges(total_size, connections))]
+        results = [future.result() for future in futures]
+    merged = merge_statistics(results, QUIC_asyncio.now() - start_time)
+    merged['transfer_id'] = transfer_id
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send one file over several QUIC connections at once")
+    parser.add_argument("-k", "--connections", type=int, default=4,
+                        help="Number of connections, each sending one shard of the file (default: 4)")
+    parser.add_argument("-f", "--file", default=QUIC_asyncio.FILE_PATH,
+                        help="The file to send (default: alphanumeric_file.txt)")
+    parser.add_argument("--threads", action='store_true',
+                        help="Run the connections in threads instead of processes")
+    parser.add_argument("-t", "--time", type=float, default=None,
+                        help="Value of time_threshold in seconds (default: derived from the RTT). "
+                             "Enter 0 to turn off time based recovery.")
+    parser.add_argument("-n", "--number", type=int, default=7,
+                        help="packet_reordering_threshold (default: 7). Enter 0 to turn off packet number based "
+                             "recovery.")
+    parser.add_argument("-q", "--quic-version", type=int, default=api.QUIC_VERSION_BINARY,
+                        choices=api.SUPPORTED_VERSIONS)
+    parser.add_argument("-c", "--congestion", default='newreno', choices=congestion_control.CONGESTION_CONTROLLERS)
+    parser.add_argument("--cid", type=int, default=1, help="The CID of the first connection (default: 1)")
+    parser.add_argument("--port", type=int, default=QUIC_asyncio.SERVER_PORT)
+    args = parser.parse_args()
+
+    if args.time == 0 and args.number == 0:
+        raise Exception("Need to have at least one recovery algorithm")
+    merged = run_parallel(args.file, args.connections, port=args.port, use_threads=args.threads, first_cid=args.cid,
+                          quic_version=args.quic_version, time_threshold=args.time, packet_threshold=args.number,
+                          congestion=args.congestion)
+    for result in merged['per_connection']:
+        _, offset, size, _ = result['shard']
+        print(f"CID {result['client_cid']}: bytes {offset}-{offset + size - 1}, {result['total_time']:.6f} seconds, "
+              f"Bandwidth: {result['bandwidth']:.3f} MB/s, {result['retransmissions']} re-transmitted")
+    print(f"Transfer {merged['transfer_id']}: {merged['file_size']} bytes over {merged['connections']} connections "
+          f"in {merged['total_time']:.6f} seconds")
+    print(f"Bandwidth: {merged['bandwidth']:.3f} MB/s")
+    print(f"Unique packets: {merged['unique_packets']}")
+    print(f"Re-transmitted packets: {merged['retransmissions']} ({merged['time_retransmissions']} by time, "
+          f"{merged['packet_number_retransmissions']} by packet number)")
+    print(f"Average smoothed RTT: {merged['smoothed_rtt'] * 1000:.3f} ms")
+    print(f"Flow control: blocked {merged['data_blocked'] + merged['stream_data_blocked']} times, "
+          f"{merged['window_updates']} window updates received")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Reassembly of received streams into files.
+
+Frames may arrive in any order and more than once. Every frame is written straight to its offset in the output file, and
+the ranges of the file that were already written are kept in a RangeSet, so duplicates and overlapping frames only
+write the bytes that are new, and the missing ranges can be reported at any time.
+"""
+import os
+
+import QUIC_api as api
+
+
+def pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+class FileReassembler:
+    """
+    Writes the frames of one stream to a file at their offsets. Without a file, only keeps track of the ranges.
+
+    A stream can also be one shard of a larger file that several connections write to at the same time: its offsets
+    are then moved by the shard's offset in the file, and the file is shared rather than truncated.
+    """
+
+    def __init__(self, path=None, size=None, base_offset=0, file_size=None):
+        """
+        :param path: The output file, created or truncated, or None to discard the data
+        :param size: The size of the stream if it's already known, to preallocate the file
+        :param base_offset: Where the stream starts in the file
+        :param file_size: The size of the whole file, for a shard. The file is created at this size if it's smaller,
+        and never truncated.
+        """
+        self.path = path
+        self.base_offset = base_offset
+        self.shared = file_size is not None
+        self.fd = None
+        if path is not None:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT | (0 if self.shared else os.O_TRUNC), 0o644)
+            if self.shared and os.fstat(self.fd).st_size < file_size:
+                os.ftruncate(self.fd, file_size)
+        self.ranges = api.RangeSet()
+        self.final_size = None
+        self.duplicate_bytes = 0
+        if size is not None:
+            self.set_final_size(size)
+
+    def set_final_size(self, size):
+        """
+        Sets the size of the file, once the stream's FIN arrived.
+        """
+        if self.final_size == size:
+            return
+        self.final_size = size
+        if self.fd is not None and not self.shared:
+            os.ftruncate(self.fd, size)
+
+    def write(self, offset, data):
+        """
+        Writes a frame's data at its offset. Bytes that were already written aren't written again.
+
+        :param data: A bytes-like object, or a string for bit-string frames
+        :return: The number of new bytes written
+        """
+        if self.fd is None:
+            written = sum(end - start for start, end in self.ranges.add(offset, offset + len(data)))
+            self.duplicate_bytes += len(data) - written
+            return written
+
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        data = memoryview(data)
+        written = 0
+        for start, end in self.ranges.add(offset, offset + len(data)):
+            pwrite(self.fd, data[start - offset:end - offset], self.base_offset + start)
+            written += end - start
+        self.duplicate_bytes += len(data) - written
+        return written
+
+    @property
+    def bytes_written(self):
+        return self.ranges.total
+
+    @property
+    def contiguous_bytes(self):
+        """
+        :return: How many bytes from the start of the file were written without a gap
+        """
+        if self.ranges.starts and self.ranges.starts[0] == 0:
+            return self.ranges.ends[0]
+        return 0
+
+    @property
+    def complete(self):
+        return self.final_size is not None and self.ranges.covers(0, self.final_size)
+
+    def missing_ranges(self):
+        """
+        :return: The ranges that weren't received yet, up to the final size (or up to the last received byte while the
+        final size is unknown)
+        """
+        end = self.final_size
+        if end is None:
+            end = self.ranges.ends[-1] if self.ranges.ends else 0
+        return self.ranges.missing(end)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,458 @@
+"""
+Discrete-event simulation of a transfer, to study the recovery algorithms without the wall clock.
+
+The client loop of QUIC_Client.py runs unchanged in spirit: the same QUIC_api recovery functions, SentPacketMap,
+congestion controller, pacer and flow control, and the server side is a real QUIC_connection.ServerConnection. Only
+time and the network are simulated. The recovery functions read a SimulatedClock, the packets go through
+SimulatedSockets, and every direction of the link is a QUIC_netem.LinkModel. Waiting for an ACK or for the pacer skips
+straight to the next event, so a run takes as long as its packets take to process, however long it lasts in simulated
+time. Processing itself takes no simulated time, and the same seed gives the same run.
+
+The handshake isn't simulated: the connection starts established, with the one RTT sample a lossless handshake gives.
+
+Usage:
+    python QUIC_sim.py [--size SIZE] [-l LOSS ...] [-t TIME_THRESHOLD ...] [-n PACKET_THRESHOLD ...] [--delay DELAY]
+                       [--rate RATE] [--burst BURST] [-c CONGESTION] [--seed SEED]
+"""
+import argparse
+import heapq
+import itertools
+import os
+import tempfile
+
+import QUIC_api as api
+import QUIC_connection
+import QUIC_flow
+import QUIC_netem
+import QUIC_streams
+import QUIC_congestion as congestion_control
+
+CLIENT_ADDRESS = ('127.0.0.1', 50000)
+SERVER_ADDRESS = ('127.0.0.1', 9997)
+CLIENT_CID = 1
+SERVER_CID = 2
+MAX_DATAGRAM_SIZE = 2048
+BATCH_SIZE = 64
+# One way delay of the simulated link, about half the RTT of loopback
+LINK_DELAY = 0.0002  # in seconds
+# A run that lasts longer than this in simulated time is stuck
+TIME_LIMIT = 600  # in seconds
+
+
+class SimulatedClock:
+    """
+    Simulated time, and the events scheduled in it. Calling the clock returns the current time, so it can stand in for
+    the clock of the QUIC_api recovery functions.
+    """
+
+    def __init__(self, start=0.0, time_limit=TIME_LIMIT):
+        self.time = start
+        self.time_limit = start + time_limit
+        self.events = []
+        # Breaks the ties between events at the same time, in the order they were scheduled
+        self.sequence = itertools.count()
+        self.events_run = 0
+
+    def __call__(self):
+        return self.time
+
+    def call_at(self, when, callback, *args):
+        heapq.heappush(self.events, (when, next(self.sequence), callback, args))
+
+    def run_until(self, deadline, condition=None):
+        """
+        Runs the events due by the deadline in time order, and moves the clock to the deadline.
+
+        :param condition: Stop early, at the time of the event that made it true
+        :return: True if the condition became true
+        """
+        events = self.events
+        while events and events[0][0] <= deadline:
+            when, _, callback, args = heapq.heappop(events)
+            if when > self.time:
+                self.time = when
+            callback(*args)
+            self.events_run += 1
+            if condition is not None and condition():
+                return True
+        if deadline > self.time:
+            self.time = deadline
+        if self.time > self.time_limit:
+            raise TimeoutError(f"The simulation passed its time limit of {self.time_limit} seconds")
+        return False
+
+
+class SimulatedLink:
+    """
+    One direction of the link: every datagram reaches the destination socket at the times its LinkModel gives, if at
+    all.
+    """
+
+    def __init__(self, clock, model, destination):
+        self.clock = clock
+        self.model = model
+        self.destination = destination
+
+    def send(self, data, source):
+        for arrival in self.model.deliveries(len(data), self.clock()):
+            self.clock.call_at(arrival, self.destination.deliver, data, source)
+
+
+class SimulatedSocket:
+    """
+    Stands in for both the socket and the QUIC_io.BatchSocketIO of an endpoint: sendto() and send() put the datagrams
+    on the link, and receive() takes the ones that arrived so far.
+    """
+
+    def __init__(self, address, on_datagram=None):
+        """
+        :param address: The address the datagrams of this socket come from
+        :param on_datagram: Called with every datagram as it arrives, instead of keeping it for receive()
+        """
+        self.address = address
+        self.on_datagram = on_datagram
+        self.link = None
+        self.inbox = []
+        self.datagrams_sent = 0
+
+    def sendto(self, data, address):
+        # The encoders reuse their buffers, so the datagram is copied as a real send would
+        self.link.send(bytes(data), self.address)
+        self.datagrams_sent += 1
+
+    def send(self, datagrams, address):
+        for data in datagrams:
+            self.sendto(data, address)
+
+    def receive(self):
+        datagrams, self.inbox = self.inbox, []
+        return datagrams
+
+    def deliver(self, data, address):
+        if self.on_datagram is not None:
+            self.on_datagram(data, address)
+        else:
+            self.inbox.append((data, address))
+
+
+class SimulatedServer:
+    """
+    The receiving side of QUIC_Server.py for one established connection: ACKs are sent when the connection's
+    AckScheduler says, on simulated timers.
+    """
+
+    def __init__(self, clock, version, ack_delay=QUIC_connection.MAX_ACK_DELAY,
+                 ack_threshold=QUIC_connection.ACK_ELICITING_THRESHOLD, max_data=QUIC_flow.INITIAL_MAX_DATA,
+                 max_stream_data=QUIC_flow.INITIAL_MAX_STREAM_DATA):
+        self.clock = clock
+        self.sock = SimulatedSocket(SERVER_ADDRESS, self.datagram_received)
+        self.connection = QUIC_connection.ServerConnection(SERVER_CID, CLIENT_CID, version, CLIENT_ADDRESS, clock(),
+                                                           max_data=max_data, max_stream_data=max_stream_data,
+                                                           max_ack_delay=ack_delay, ack_threshold=ack_threshold)
+        self.timer_deadline = None
+
+    def datagram_received(self, packet, address):
+        connection = self.connection
+        packet_parsed = api.decode_quic_short_packet(packet, connection.version, connection.largest_packet_number)
+        frame_parsed = api.decode_quic_frame(packet_parsed['payload'], connection.version)
+        now = self.clock()
+        if QUIC_streams.is_stream_frame(frame_parsed['frame_type']):
+            if not connection.on_packet(packet_parsed['packet_number'], frame_parsed, now):
+                raise ValueError("The client sent past its flow control limits")
+        elif frame_parsed['frame_type'] in (api.DATA_BLOCKED_FRAME, api.STREAM_DATA_BLOCKED_FRAME):
+            connection.on_blocked(packet_parsed['packet_number'], frame_parsed, now)
+
+        self.schedule()
+
+    def schedule(self):
+        """
+        Sends the ACK if it is due, or sets a timer for it unless an earlier one is set.
+        """
+        deadline = self.connection.ack_deadline
+        if deadline is None:
+            return
+        if deadline <= self.clock():
+            self.send_ack()
+        elif self.timer_deadline is None or deadline < self.timer_deadline:
+            self.timer_deadline = deadline
+            self.clock.call_at(deadline, self.timeout)
+
+    def timeout(self):
+        # A timer is never cancelled, so it may find its ACK already sent, or due later
+        if self.timer_deadline is not None and self.timer_deadline <= self.clock():
+            self.timer_deadline = None
+        self.schedule()
+
+    def send_ack(self):
+        connection = self.connection
+        ack_packet = connection.build_ack(self.clock())
+        if ack_packet is not None:
+            self.sock.sendto(ack_packet, CLIENT_ADDRESS)
+        for update_packet in connection.build_window_updates():
+            self.sock.sendto(update_packet, CLIENT_ADDRESS)
+
+
+class SimulatedClient:
+    """
+    The send loop of QUIC_Client.py on simulated time: where the client blocks in select(), the simulation runs the
+    events until a datagram arrives or the timeout passes.
+    """
+
+    def __init__(self, clock, file_paths, time_threshold=None, packet_threshold=7, pto=None, congestion='newreno',
+                 pacing_rate=None, scheduler=QUIC_streams.ROUND_ROBIN, version=api.QUIC_VERSION_BINARY,
+                 handshake_rtt=2 * LINK_DELAY, max_ack_delay=QUIC_connection.MAX_ACK_DELAY, trace=None):
+        """
+        :param clock: The SimulatedClock
+        :param file_paths: The files to send, each on its own stream
+        :param time_threshold: Fixed time threshold, None to derive it from the RTT, or 0 to turn it off
+        :param packet_threshold: The packet reordering threshold, or 0 to turn packet number based recovery off
+        :param pto: Fixed probe timeout, or None to derive it from the RTT
+        :param congestion: The name of the congestion controller
+        :param pacing_rate: Pacing rate in bytes per second, None to derive it from the window, or 0 for no pacing
+        :param scheduler: The stream scheduling policy
+        :param version: The wire format version
+        :param handshake_rtt: The RTT sample of the handshake
+        :param max_ack_delay: The server's max ACK delay in ms, as its ServerHello would advertise it
+        :param trace: A QUIC_trace.Tracer for the client's events, on simulated time
+        """
+        if time_threshold == 0 and packet_threshold == 0:
+            raise Exception("Need to have at least one recovery algorithm")
+        self.clock = clock
+        self.sock = SimulatedSocket(CLIENT_ADDRESS)
+        self.version = version
+        self.thresholds = (packet_threshold, time_threshold, pto)
+        self.pto_timeout = pto
+        self.rtt = api.RttEstimator(max_ack_delay=max_ack_delay / 1000)
+        self.rtt.update(handshake_rtt)
+        self.flow = QUIC_flow.SendFlowControl()
+        self.streams = QUIC_streams.StreamScheduler(scheduler, self.flow)
+        for priority, file_path in enumerate(file_paths):
+            self.streams.open_stream(file_path, priority)
+        self.file_size = self.streams.size
+        self.buffer_size = MAX_DATAGRAM_SIZE - api.packet_overhead(version, SERVER_CID, self.streams.next_stream_id,
+                                                                   self.file_size)
+        self.packet_queue = api.SentPacketMap(SERVER_CID)
+        self.encoder = api.PacketEncoder(SERVER_CID, version, buffer_count=BATCH_SIZE)
+        self.congestion = congestion_control.create_congestion_controller(congestion, self.rtt, MAX_DATAGRAM_SIZE)
+        self.pacing = pacing_rate != 0
+        self.pacer = congestion_control.Pacer(self.congestion, pacing_rate)
+        self.current_packet_number = 0
+        self.unique_packets = 0
+        self.retransmit_counter = 0
+        self.time_retransmit_counter = 0
+        self.packet_number_retransmit_counter = 0
+        self.ack_latencies = []
+        self.trace = trace
+        self.start_time = clock()
+        self.end_time = None
+
+    def wait(self, timeout):
+        """
+        The select() of the client: runs the events until a datagram arrives or the timeout passes.
+
+        :return: True if a datagram arrived
+        """
+        if self.sock.inbox:
+            return True
+        return self.clock.run_until(self.clock() + timeout, lambda: self.sock.inbox)
+
+    def receive_acks(self, tail):
+        retransmissions, time_count, number_count, self.current_packet_number = api.receive_ACKs(
+            self.sock, SERVER_ADDRESS, self.packet_queue, tail, self.current_packet_number, *self.thresholds,
+            version=self.version, rtt=self.rtt, congestion=self.congestion, io=self.sock, flow=self.flow,
+            clock=self.clock, ack_latencies=self.ack_latencies, trace=self.trace)
+        self.retransmit_counter += retransmissions
+        self.time_retransmit_counter += time_count
+        self.packet_number_retransmit_counter += number_count
+
+    def loss_timeout(self):
+        """
+        :return: How long until the oldest packet in flight can be declared lost by the time threshold or the PTO
+        """
+        _, time_threshold, _ = self.thresholds
+        # The recovery functions only declare packets older than the threshold lost
+        return api.loss_timeout(self.packet_queue, time_threshold, self.pto_timeout, self.rtt, self.clock) + 1e-9
+
+    def run(self):
+        """
+        Sends the files until every packet is ACKed.
+
+        :return: A dictionary with the transfer statistics
+        """
+        streams, congestion, pacer, clock = self.streams, self.congestion, self.pacer, self.clock
+        while not streams.finished:
+            # Wait for room in the congestion window and for flow control credit, recovering when a loss timer expires
+            resend_blocked = False
+            while not congestion.can_send() or not streams.can_send:
+                if not streams.can_send:
+                    for frame_type, stream_id, limit in streams.blocked_frames(resend_blocked):
+                        frame = api.encode_flow_control_frame(frame_type, limit, stream_id, self.version)
+                        self.sock.sendto(api.encode_quic_short_packet(SERVER_CID, self.current_packet_number, frame,
+                                                                      self.version), SERVER_ADDRESS)
+                        self.current_packet_number += 1
+                ready = self.wait(self.loss_timeout())
+                resend_blocked = not ready
+                self.receive_acks(not ready)
+
+            # Wait for the pacer, handling the ACKs that arrive in the meantime
+            if self.pacing:
+                send_time = pacer.next_send_time(clock())
+                while send_time > clock():
+                    if self.wait(send_time - clock()):
+                        self.receive_acks(False)
+                    send_time = pacer.next_send_time(clock())
+
+            # Build a batch while the window and the pacer allow
+            batch = []
+            send_time = clock()
+            while True:
+                stream_frame = streams.read(self.buffer_size)
+                packet = self.encoder.encode(self.current_packet_number, stream_frame, self.packet_queue.largest_acked)
+                self.packet_queue.add(self.current_packet_number, send_time, packet, stream_frame)
+                congestion.on_packet_sent(len(packet), send_time)
+                pacer.on_packet_sent(len(packet), send_time)
+                if self.trace is not None:
+                    self.trace.packet_sent(send_time, self.current_packet_number, len(packet), stream_frame)
+                batch.append(packet)
+                self.current_packet_number += 1
+                self.unique_packets += 1
+
+                if (len(batch) == BATCH_SIZE or streams.finished or not congestion.can_send()
+                        or not streams.can_send or (self.pacing and pacer.next_send_time(send_time) > send_time)):
+                    break
+            self.sock.send(batch, SERVER_ADDRESS)
+            self.receive_acks(False)
+
+        # The tail: the client polls until every packet is ACKed, so it runs the recovery as soon as anything changes
+        while len(self.packet_queue) > 0:
+            self.wait(self.loss_timeout())
+            self.receive_acks(True)
+        self.end_time = clock()
+        self.streams.close()
+        return self.statistics()
+
+    def statistics(self):
+        total_time = (self.clock() if self.end_time is None else self.end_time) - self.start_time
+        self.ack_latencies.sort()
+        return {
+            'file_size': self.file_size,
+            'total_time': total_time,
+            'bandwidth': self.file_size / total_time / 1024 / 1024 if total_time else float('inf'),
+            'unique_packets': self.unique_packets,
+            'retransmissions': self.retransmit_counter,
+            'time_retransmissions': self.time_retransmit_counter,
+            'packet_number_retransmissions': self.packet_number_retransmit_counter,
+            'smoothed_rtt': self.rtt.smoothed_rtt,
+            'ack_latency_p50': api.percentile(self.ack_latencies, 0.5),
+            'ack_latency_p99': api.percentile(self.ack_latencies, 0.99),
+            'congestion_window': self.congestion.congestion_window,
+            'congestion_events': self.congestion.congestion_events,
+            'data_blocked': self.flow.data_blocked_sent,
+            'stream_data_blocked': self.flow.stream_data_blocked_sent,
+            'window_updates': self.flow.updates_received,
+        }
+
+
+def simulate_transfer(file_paths=None, size=None, uplink=None, downlink=None, ack_delay=QUIC_connection.MAX_ACK_DELAY,
+                      ack_threshold=QUIC_connection.ACK_ELICITING_THRESHOLD, max_data=QUIC_flow.INITIAL_MAX_DATA,
+                      max_stream_data=QUIC_flow.INITIAL_MAX_STREAM_DATA, time_limit=TIME_LIMIT, **options):
+    """
+    Simulates one transfer from start to the last ACK.
+
+    :param file_paths: The files to send
+    :param size: Instead of file_paths, send a file of zeros of this many bytes
+    :param uplink: The QUIC_netem.LinkModel of the data packets (default: LINK_DELAY and nothing else)
+    :param downlink: The QUIC_netem.LinkModel of the ACKs (default: LINK_DELAY and nothing else)
+    :param ack_delay: The server's maximum ACK delay in ms
+    :param ack_threshold: The server ACKs every this many ack-eliciting packets
+    :param max_data: The connection flow control window
+    :param max_stream_data: The stream flow control window
+    :param time_limit: Raise TimeoutError past this many simulated seconds
+    :param options: Keyword arguments for SimulatedClient
+    :return: The client's statistics, with the server's and the links' under 'server', 'uplink' and 'downlink', and
+    'events', the number of simulated events
+    """
+    if file_paths is None:
+        with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as file:
+            # A sparse file: it costs no disk, and reads as zeros
+            file.truncate(size)
+        try:
+            return simulate_transfer([file.name], None, uplink, downlink, ack_delay, ack_threshold, max_data,
+                                     max_stream_data, time_limit, **options)
+        finally:
+            os.remove(file.name)
+
+    uplink = uplink or QUIC_netem.LinkModel(delay=LINK_DELAY)
+    downlink = downlink or QUIC_netem.LinkModel(delay=LINK_DELAY, seed=1)
+    clock = SimulatedClock(time_limit=time_limit)
+    server = SimulatedServer(clock, options.get('version', api.QUIC_VERSION_BINARY), ack_delay, ack_threshold, max_data,
+                             max_stream_data)
+    client = SimulatedClient(clock, file_paths, handshake_rtt=uplink.delay + downlink.delay, max_ack_delay=ack_delay,
+                             **options)
+    client.sock.link = SimulatedLink(clock, uplink, server.sock)
+    server.sock.link = SimulatedLink(clock, downlink, client.sock)
+
+    statistics = client.run()
+    # Let the last ACKs arrive, so the server's totals are complete
+    clock.run_until(max((event[0] for event in clock.events), default=clock()))
+    server.connection.close()
+    statistics['server'] = server.connection.statistics()
+    statistics['uplink'] = uplink.statistics()
+    statistics['downlink'] = downlink.statistics()
+    statistics['events'] = clock.events_run
+    return statistics
+
+
+def link_models(loss=0.0, burst=None, delay=LINK_DELAY, rate=None, seed=0):
+    """
+    :return: (uplink, downlink) LinkModels with the same impairments and different seeds
+    """
+    models = []
+    for direction_seed in (seed, seed + 1):
+        gilbert_elliott = None if burst is None or loss == 0 else QUIC_netem.GilbertElliott.from_loss(loss, burst)
+        models.append(QUIC_netem.LinkModel(loss=loss, gilbert_elliott=gilbert_elliott, delay=delay, rate=rate,
+                                           seed=direction_seed))
+    return tuple(models)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate transfers over an impaired link, for every combination of "
+                                                 "loss rate and recovery thresholds")
+    parser.add_argument("--size", type=float, default=10,
+                        help="The size of the simulated file in MB (default: 10)")
+    parser.add_argument("-l", "--loss", type=float, nargs='+', default=[0, 0.1, 1, 5],
+                        help="Loss rates in percent, in each direction (default: 0 0.1 1 5)")
+    parser.add_argument("-t", "--time", type=float, nargs='+', default=[None],
+                        help="Time thresholds in seconds, 0 to turn time based recovery off (default: from the RTT)")
+    parser.add_argument("-n", "--number", type=int, nargs='+', default=[7],
+                        help="Packet reordering thresholds, 0 to turn packet number based recovery off (default: 7)")
+    parser.add_argument("--delay", type=float, default=LINK_DELAY * 1000,
+                        help=f"One way delay in ms (default: {LINK_DELAY * 1000})")
+    parser.add_argument("--rate", type=float, default=None, help="Link rate in Mbit/s (default: no limit)")
+    parser.add_argument("--burst", type=float, default=None,
+                        help="Average loss burst length in packets. Makes the loss bursty (Gilbert-Elliott).")
+    parser.add_argument("-c", "--congestion", default='newreno', choices=congestion_control.CONGESTION_CONTROLLERS)
+    parser.add_argument("-d", "--ack-delay", type=int, default=QUIC_connection.MAX_ACK_DELAY,
+                        help="The server's maximum ACK delay in ms")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the link impairments (default: 0)")
+    args = parser.parse_args()
+
+    rate = None if args.rate is None else args.rate * 1000 * 1000 / 8
+    for loss in args.loss:
+        for packet_threshold in args.number:
+            for time_threshold in args.time:
+                if time_threshold == 0 and packet_threshold == 0:
+                    continue
+                uplink, downlink = link_models(loss / 100, args.burst, args.delay / 1000, rate, args.seed)
+                result = simulate_transfer(size=int(args.size * 1024 * 1024), uplink=uplink, downlink=downlink,
+                                           ack_delay=args.ack_delay, time_threshold=time_threshold,
+                                           packet_threshold=packet_threshold, congestion=args.congestion)
+                print(f"loss {loss}% packet threshold {packet_threshold} time threshold {time_threshold}: "
+                      f"{result['total_time']:.3f} seconds, Bandwidth: {result['bandwidth']:.3f} MB/s, "
+                      f"{result['unique_packets']} unique packets, {result['retransmissions']} re-transmitted "
+                      f"({result['time_retransmissions']} by time, {result['packet_number_retransmissions']} by "
+                      f"packet number), {result['events']} events")
+
+
+if __name__ == '__main__':
+    main()
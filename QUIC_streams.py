@@ -0,0 +1,306 @@
+"""
+Streams: many files (or parts of files) sent concurrently over one connection.
+
+Every stream has its own offsets. The last frame of a stream has the FIN bit set, which tells the receiver the stream's
+final size. The sender's StreamScheduler picks the stream of every new packet, so a slow or large stream doesn't hold
+back the others. Stream IDs follow RFC 9000: client-initiated streams are 0, 4, 8, ...
+"""
+import mmap
+import os
+
+import QUIC_api as api
+import QUIC_reassembly
+
+# STREAM frames are 0x08-0x0f; the lowest bit marks the last frame of the stream
+STREAM_FRAME = 0x08
+STREAM_FIN_BIT = 0x01
+STREAM_ID_INCREMENT = 4
+
+ROUND_ROBIN = 'round-robin'
+PRIORITY = 'priority'
+SCHEDULERS = (ROUND_ROBIN, PRIORITY)
+
+
+def is_stream_frame(frame_type):
+    return frame_type & ~0x07 == STREAM_FRAME
+
+
+def stream_frame_type(fin):
+    return STREAM_FRAME | STREAM_FIN_BIT if fin else STREAM_FRAME
+
+
+class FileSource:
+    """
+    A file mapped into memory. Slices of it are memoryviews, so sending and retransmitting a chunk never copies the file
+    into Python objects, and memory use doesn't depend on the file size or the number of packets in flight.
+    """
+
+    def __init__(self, file_path, offset=0, length=None):
+        """
+        :param file_path: The file
+        :param offset: Where the source starts in the file
+        :param length: The length of the source (default: up to the end of the file)
+        """
+        self.file = open(file_path, 'rb')
+        file_size = os.fstat(self.file.fileno()).st_size
+        # Empty files can't be mapped
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if file_size else None
+        view = memoryview(self.map) if file_size else memoryview(b'')
+        self.view = view[offset:] if length is None else view[offset:offset + length]
+        view.release()
+        self.size = len(self.view)
+
+    def slice(self, offset, length):
+        """
+        :return: A memoryview of length bytes from offset (shorter at the end of the file)
+        """
+        return self.view[offset:offset + length]
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class StreamFrame:
+    """
+    A reference to a STREAM frame: where its data is in the stream's source, rather than the data itself. Sent packets
+    keep this reference, and the frame is encoded again from it if the packet is lost.
+    """
+    __slots__ = ('stream', 'offset', 'length', 'fin')
+
+    def __init__(self, stream, offset, length, fin):
+        self.stream = stream
+        self.offset = offset
+        self.length = length
+        self.fin = fin
+
+    @property
+    def stream_id(self):
+        return self.stream.stream_id
+
+    @property
+    def frame_type(self):
+        return stream_frame_type(self.fin)
+
+    @property
+    def data(self):
+        """
+        :return: A memoryview of the frame's data in the stream's source
+        """
+        return self.stream.source.slice(self.offset, self.length)
+
+    def encode(self, version):
+        """
+        :return: The frame, encoded in the given wire format version
+        """
+        return api.encode_quic_frame(self.frame_type, self.stream_id, self.offset, self.data, version)
+
+
+class SendStream:
+    """
+    The sending side of a stream, reading its data from a file.
+    """
+
+    def __init__(self, stream_id, file_path, priority=0, offset=0, length=None):
+        """
+        :param stream_id: The stream ID
+        :param file_path: The file sent on this stream
+        :param priority: Lower values are sent first by the priority scheduler
+        :param offset: Where the stream starts in the file; stream offsets are counted from here
+        :param length: How much of the file the stream sends (default: up to the end of the file)
+        """
+        self.stream_id = stream_id
+        self.file_path = file_path
+        self.priority = priority
+        self.source = FileSource(file_path, offset, length)
+        self.size = self.source.size
+        self.offset = 0
+        self.fin_sent = False
+
+    @property
+    def finished(self):
+        return self.fin_sent
+
+    def read(self, max_size):
+        """
+        Takes the next chunk of the stream.
+
+        :param max_size: The most bytes in the chunk
+        :return: A StreamFrame for the chunk
+        """
+        offset = self.offset
+        self.offset = min(self.offset + max_size, self.size)
+        self.fin_sent = self.offset >= self.size
+        return StreamFrame(self, offset, self.offset - offset, self.fin_sent)
+
+    def close(self):
+        self.source.close()
+
+
+class StreamScheduler:
+    """
+    Picks the stream each new packet is sent on. The round-robin scheduler takes turns between all the open streams;
+    the priority scheduler sends the streams with the lowest priority value first, taking turns between equals.
+    Streams leave the schedule once their last chunk was taken, but their files stay open for retransmissions until
+    the scheduler is closed. With flow control, streams that reached their limit are skipped, and chunks are cut to
+    the stream's and the connection's credit.
+    """
+
+    def __init__(self, policy=ROUND_ROBIN, flow=None):
+        """
+        :param policy: ROUND_ROBIN or PRIORITY
+        :param flow: A QUIC_flow.SendFlowControl, or None to send without limits
+        """
+        if policy not in SCHEDULERS:
+            raise ValueError(f"Unknown scheduler: {policy}")
+        self.policy = policy
+        self.flow = flow
+        self.streams = []
+        self.opened = []
+        self.next_stream_id = 0
+        self.turn = 0
+
+    def open_stream(self, file_path, priority=0, offset=0, length=None):
+        """
+        Opens a stream for a file, or for a range of it, with the next client-initiated stream ID.
+
+        :return: The new SendStream
+        """
+        stream = SendStream(self.next_stream_id, file_path, priority, offset, length)
+        self.next_stream_id += STREAM_ID_INCREMENT
+        self.streams.append(stream)
+        self.opened.append(stream)
+        return stream
+
+    def close(self):
+        """
+        Closes the files of all the streams.
+        """
+        for stream in self.opened:
+            stream.close()
+        self.streams = []
+        self.opened = []
+
+    @property
+    def size(self):
+        return sum(stream.size for stream in self.opened)
+
+    @property
+    def finished(self):
+        return not self.streams
+
+    def sendable(self, stream):
+        """
+        :return: True if flow control lets the stream send its next chunk. A FIN without data needs no credit.
+        """
+        return self.flow is None or stream.offset == stream.size or self.flow.credit(stream.stream_id) > 0
+
+    @property
+    def can_send(self):
+        return any(self.sendable(stream) for stream in self.streams)
+
+    def blocked_frames(self, resend=False):
+        """
+        :return: The DATA_BLOCKED and STREAM_DATA_BLOCKED frames to send, as in QUIC_flow.SendFlowControl.blocked_frames
+        """
+        if self.flow is None:
+            return []
+        return self.flow.blocked_frames([stream.stream_id for stream in self.streams], resend)
+
+    def next_stream(self):
+        """
+        :return: The stream the next packet should be sent on, or None if every stream was sent or is blocked
+        """
+        candidates = self.streams
+        if self.flow is not None:
+            candidates = [stream for stream in self.streams if self.sendable(stream)]
+        if not candidates:
+            return None
+        if self.policy == PRIORITY:
+            best = min(stream.priority for stream in candidates)
+            candidates = [stream for stream in candidates if stream.priority == best]
+        index = self.turn % len(candidates)
+        self.turn = index + 1
+        return candidates[index]
+
+    def read(self, max_size):
+        """
+        Takes the next chunk from the scheduled stream, and removes the stream from the schedule after its last chunk.
+
+        :param max_size: The most bytes in the chunk
+        :return: A StreamFrame for the chunk
+        """
+        stream = self.next_stream()
+        if self.flow is not None:
+            max_size = min(max_size, self.flow.credit(stream.stream_id))
+        frame = stream.read(max_size)
+        if self.flow is not None:
+            self.flow.on_sent(stream.stream_id, frame.length)
+        if frame.fin:
+            self.streams.remove(stream)
+            # The next stream moved into the finished stream's place
+            self.turn -= 1
+        return frame
+
+
+class ReceiveStream:
+    """
+    The receiving side of a stream: the received ranges, written to a file if the stream has one, and the stream's
+    final size once the FIN arrived.
+    """
+
+    def __init__(self, stream_id, output_path=None, base_offset=0, file_size=None):
+        """
+        :param stream_id: The stream ID
+        :param output_path: The file the stream is reassembled into, or None to discard the data
+        :param base_offset: Where the stream starts in the file, for a shard of a larger file
+        :param file_size: The size of the whole file, for a shard
+        """
+        self.stream_id = stream_id
+        self.reassembler = QUIC_reassembly.FileReassembler(output_path, base_offset=base_offset, file_size=file_size)
+        self.frames = 0
+
+    def on_frame(self, offset, data, fin):
+        """
+        Records a received STREAM frame. Only the bytes that weren't received yet are written.
+        """
+        first_fin = fin and self.final_size is None
+        if fin:
+            self.reassembler.set_final_size(offset + len(data))
+        if self.reassembler.write(offset, data) or first_fin:
+            self.frames += 1
+
+    @property
+    def final_size(self):
+        return self.reassembler.final_size
+
+    @property
+    def bytes_received(self):
+        return self.reassembler.bytes_written
+
+    @property
+    def received_end(self):
+        """
+        :return: The end of the furthest byte range received, so data before it arrived out of order or again
+        """
+        ends = self.reassembler.ranges.ends
+        return ends[-1] if ends else 0
+
+    @property
+    def consumed(self):
+        """
+        :return: How many bytes from the start of the stream were delivered in order, for flow control
+        """
+        return self.reassembler.contiguous_bytes
+
+    @property
+    def complete(self):
+        return self.reassembler.complete
+
+    def missing_ranges(self):
+        return self.reassembler.missing_ranges()
+
+    def close(self):
+        self.reassembler.close()
@@ -0,0 +1,273 @@
+"""
+Connection event tracing in the qlog format (draft-ietf-quic-qlog-main-schema, NDJSON serialization), from the client's
+point of view: every packet sent, received and declared lost (with the recovery algorithm that declared it), every ACK,
+and the RTT and congestion window after each change.
+
+Recording an event only appends a tuple of the values at hand to a ring buffer: nothing is formatted or written until
+the trace is flushed, and a full buffer overwrites its oldest events, so the trace holds the last part of a connection
+at a fixed memory cost. With sampling, only the packets whose packet number is a multiple of the sampling interval are
+recorded (and the ACKs and metrics by the ACK's packet number), so a sampled packet can still be followed from sent to
+ACKed. Losses are always recorded.
+
+Usage:
+    python QUIC_Client.py --trace client.qlog [--trace-sample 10] [--trace-size 100000]
+    python QUIC_trace.py client.qlog
+"""
+import argparse
+import collections
+import json
+
+import QUIC_api as api
+
+QLOG_VERSION = '0.3'
+QLOG_FORMAT = 'NDJSON'
+CAPACITY = 100000  # events
+
+# Event kinds, the second item of every recorded tuple
+PACKET_SENT = 0
+PACKET_RECEIVED = 1
+ACK_RECEIVED = 2
+PACKET_LOST = 3
+METRICS_UPDATED = 4
+
+EVENT_NAMES = {
+    PACKET_SENT: 'transport:packet_sent',
+    PACKET_RECEIVED: 'transport:packet_received',
+    ACK_RECEIVED: 'transport:packet_received',
+    PACKET_LOST: 'recovery:packet_lost',
+    METRICS_UPDATED: 'recovery:metrics_updated',
+}
+
+FRAME_NAMES = {
+    api.MAX_DATA_FRAME: 'max_data',
+    api.MAX_STREAM_DATA_FRAME: 'max_stream_data',
+    api.DATA_BLOCKED_FRAME: 'data_blocked',
+    api.STREAM_DATA_BLOCKED_FRAME: 'stream_data_blocked',
+    api.CONNECTION_CLOSE_FRAME: 'connection_close',
+}
+
+# The metrics recorded by metrics_updated, in the order of the tuple, and the times among them (in ms in the trace)
+METRICS = ('smoothed_rtt', 'latest_rtt', 'min_rtt', 'rtt_variance', 'congestion_window', 'bytes_in_flight', 'ssthresh')
+RTT_METRICS = ('smoothed_rtt', 'latest_rtt', 'min_rtt', 'rtt_variance')
+
+
+class Tracer:
+    """
+    Records the events of one connection into a ring buffer, and writes them to a qlog file when flushed. All times
+    are in seconds, on the clock of the connection.
+    """
+    __slots__ = ('path', 'sample', 'vantage_point', 'title', 'events', 'recorded', 'flushed', 'reference_time',
+                 'metrics')
+
+    def __init__(self, path=None, capacity=CAPACITY, sample=1, vantage_point='client', title=None):
+        """
+        :param path: The qlog file the events are flushed to
+        :param capacity: The most events kept until a flush; older ones are overwritten
+        :param sample: Record the packets whose packet number is a multiple of this (1 records them all)
+        :param vantage_point: 'client' or 'server'
+        :param title: The title of the trace
+        """
+        self.path = path
+        self.sample = sample
+        self.vantage_point = vantage_point
+        self.title = title
+        self.events = collections.deque(maxlen=capacity)
+        self.recorded = 0
+        self.flushed = 0
+        self.reference_time = None
+        # The last metrics written, so every metrics_updated event only has the ones that changed
+        self.metrics = (None,) * len(METRICS)
+
+    def __len__(self):
+        return len(self.events)
+
+    @property
+    def dropped(self):
+        """
+        :return: The number of events overwritten before they were flushed
+        """
+        return self.recorded - self.flushed - len(self.events)
+
+    def packet_sent(self, time, packet_number, size, frame):
+        """
+        :param frame: The QUIC_streams.StreamFrame of the packet, only read here
+        """
+        if packet_number % self.sample:
+            return
+        self.events.append((time, PACKET_SENT, packet_number, size, frame.stream_id, frame.offset, frame.length))
+        self.recorded += 1
+
+    def packet_received(self, time, packet_number, size, frame):
+        """
+        :param frame: The parsed frame of a short header packet
+        """
+        if packet_number % self.sample:
+            return
+        self.events.append((time, PACKET_RECEIVED, packet_number, size, frame['frame_type'], frame['stream_id'],
+                            frame['offset']))
+        self.recorded += 1
+
+    def ack_received(self, time, packet_number, ack_delay, ack_ranges):
+        """
+        :param ack_delay: The ACK delay of the ACK packet, in ms
+        :param ack_ranges: The ACK ranges of the ACK packet, kept as they are
+        """
+        if packet_number % self.sample:
+            return
+        self.events.append((time, ACK_RECEIVED, packet_number, ack_delay, ack_ranges))
+        self.recorded += 1
+
+    def packet_lost(self, time, packet_number, size, trigger):
+        """
+        :param trigger: The recovery algorithm that declared the packet lost: api.TIME_THRESHOLD_TRIGGER,
+        api.PACKET_THRESHOLD_TRIGGER or api.PTO_TRIGGER
+        """
+        self.events.append((time, PACKET_LOST, packet_number, size, trigger))
+        self.recorded += 1
+
+    def metrics_updated(self, time, packet_number, rtt=None, congestion=None):
+        """
+        Records the RTT estimate and the congestion controller's state after they changed.
+
+        :param packet_number: The packet that changed them, to sample by
+        :param rtt: The RttEstimator, or None if it didn't change
+        :param congestion: The congestion controller, or None if it didn't change
+        """
+        if packet_number % self.sample:
+            return
+        if rtt is None:
+            rtt_metrics = (None, None, None, None)
+        else:
+            rtt_metrics = (rtt.smoothed_rtt, rtt.latest_rtt, rtt.min_rtt, rtt.rttvar)
+        if congestion is None:
+            congestion_metrics = (None, None, None)
+        else:
+            congestion_metrics = (congestion.congestion_window, congestion.bytes_in_flight, congestion.ssthresh)
+        self.events.append((time, METRICS_UPDATED) + rtt_metrics + congestion_metrics)
+        self.recorded += 1
+
+    def header(self):
+        """
+        :return: The first record of the qlog file
+        """
+        return {
+            'qlog_version': QLOG_VERSION,
+            'qlog_format': QLOG_FORMAT,
+            'title': self.title,
+            'trace': {
+                'vantage_point': {'type': self.vantage_point},
+                'common_fields': {'time_format': 'relative', 'reference_time': self.reference_time * 1000},
+            },
+        }
+
+    def format_event(self, event):
+        """
+        :return: The qlog record of a recorded event, or None for metrics that didn't change
+        """
+        time, kind = event[0], event[1]
+        if kind == PACKET_SENT:
+            _, _, packet_number, size, stream_id, offset, length = event
+            data = {'header': {'packet_type': '1RTT', 'packet_number': packet_number}, 'raw': {'length': size},
+                    'frames': [{'frame_type': 'stream', 'stream_id': stream_id, 'offset': offset, 'length': length}]}
+        elif kind == PACKET_RECEIVED:
+            _, _, packet_number, size, frame_type, stream_id, limit = event
+            frame = {'frame_type': FRAME_NAMES.get(frame_type, 'unknown')}
+            if frame_type in (api.MAX_STREAM_DATA_FRAME, api.STREAM_DATA_BLOCKED_FRAME):
+                frame['stream_id'] = stream_id
+            if frame_type in (api.MAX_DATA_FRAME, api.MAX_STREAM_DATA_FRAME):
+                frame['maximum'] = limit
+            elif frame_type in (api.DATA_BLOCKED_FRAME, api.STREAM_DATA_BLOCKED_FRAME):
+                frame['limit'] = limit
+            elif frame_type not in FRAME_NAMES:
+                frame['raw_frame_type'] = frame_type
+            data = {'header': {'packet_type': '1RTT', 'packet_number': packet_number}, 'raw': {'length': size},
+                    'frames': [frame]}
+        elif kind == ACK_RECEIVED:
+            _, _, packet_number, ack_delay, ack_ranges = event
+            # qlog lists the ranges from the smallest packet number up
+            data = {'header': {'packet_type': '1RTT', 'packet_number': packet_number},
+                    'frames': [{'frame_type': 'ack', 'ack_delay': ack_delay,
+                                'acked_ranges': sorted([first, last] for first, last in ack_ranges)}]}
+        elif kind == PACKET_LOST:
+            _, _, packet_number, size, trigger = event
+            data = {'header': {'packet_type': '1RTT', 'packet_number': packet_number}, 'raw': {'length': size},
+                    'trigger': trigger}
+        else:
+            metrics = tuple(previous if value is None else value for value, previous in zip(event[2:], self.metrics))
+            data = {}
+            for name, value, previous in zip(METRICS, metrics, self.metrics):
+                if value == previous or value is None or value == float('inf'):
+                    continue
+                data[name] = value * 1000 if name in RTT_METRICS else value
+            self.metrics = metrics
+            if not data:
+                return None
+        return {'time': (time - self.reference_time) * 1000, 'name': EVENT_NAMES[kind], 'data': data}
+
+    def flush(self):
+        """
+        Formats the recorded events and appends them to the qlog file, starting it with the header on the first flush.
+
+        :return: The number of events written
+        """
+        if not self.events:
+            return 0
+        first_flush = self.reference_time is None
+        if first_flush:
+            self.reference_time = self.events[0][0]
+        events = list(self.events)
+        self.events.clear()
+        with open(self.path, 'w' if first_flush else 'a') as file:
+            if first_flush:
+                file.write(json.dumps(self.header()) + '\n')
+            for event in events:
+                record = self.format_event(event)
+                if record is not None:
+                    file.write(json.dumps(record) + '\n')
+        self.flushed += len(events)
+        return len(events)
+
+
+def read_trace(path):
+    """
+    :return: (the header, a list of the events) of a qlog file written by a Tracer
+    """
+    with open(path) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    return records[0], records[1:]
+
+
+def summarize(events):
+    """
+    :return: A dictionary with the number of events of every name, the number of losses by trigger, and the last value
+    of every metric
+    """
+    counts = collections.Counter(event['name'] for event in events)
+    losses = collections.Counter(event['data']['trigger'] for event in events
+                                 if event['name'] == 'recovery:packet_lost')
+    metrics = {}
+    for event in events:
+        if event['name'] == 'recovery:metrics_updated':
+            metrics.update(event['data'])
+    return {'events': dict(counts), 'losses': dict(losses), 'metrics': metrics}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a qlog trace written by QUIC_Client.py --trace")
+    parser.add_argument("path", help="The qlog file")
+    args = parser.parse_args()
+
+    header, events = read_trace(args.path)
+    summary = summarize(events)
+    print(f"{header['trace']['vantage_point']['type']} trace, {len(events)} events"
+          + (f", {events[-1]['time'] / 1000:.3f} seconds" if events else ''))
+    for name, count in sorted(summary['events'].items()):
+        print(f"  {name}: {count}")
+    for trigger, count in sorted(summary['losses'].items()):
+        print(f"  lost by {trigger}: {count}")
+    for name, value in summary['metrics'].items():
+        print(f"  final {name}: {value:.3f} ms" if name in RTT_METRICS else f"  final {name}: {value:.0f} bytes")
+
+
+if __name__ == '__main__':
+    main()
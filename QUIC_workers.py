@@ -0,0 +1,187 @@
+"""
+Multi-process server: a launcher that forks worker processes, each running the asyncio server on its own socket bound
+to the same port with SO_REUSEPORT.
+
+The kernel hashes every flow (source and destination address and port) to one of the sockets, so all the packets of a
+connection reach the same worker, and the connections spread over the cores instead of sharing one GIL. Workers give out
+interleaved CIDs (worker i of n: 2 + i, 2 + i + n, ...), so CIDs and output file names never clash. Every worker sends
+the statistics of its closed connections to the launcher over a pipe.
+
+SIGTERM (or Ctrl-C) on the launcher is passed on to the workers, which close their open connections, report them and
+exit.
+
+Usage:
+    python QUIC_workers.py [-w WORKERS] [-m MAX_CONNECTIONS] [-d ACK_DELAY] [-a ACK_THRESHOLD] [-o OUTPUT_DIR]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+
+import QUIC_asyncio
+import QUIC_connection
+import QUIC_flow
+
+STATISTICS = ('frames', 'bytes', 'streams', 'complete_streams', 'ack_packets', 'immediate_acks',
+              'window_updates', 'blocked_frames')
+
+
+async def run_worker(index, workers, pipe, host, port, **options):
+    """
+    Runs one worker's server until it is stopped with SIGTERM.
+
+    :param index: The worker's index, which picks its CIDs
+    :param workers: The number of workers
+    :param pipe: The write end of the pipe to the launcher
+    :param options: Keyword arguments for QuicServerProtocol
+    """
+    loop = asyncio.get_running_loop()
+
+    def connection_closed(connection):
+        pipe.send(('connection', index, connection.statistics()))
+
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: QUIC_asyncio.QuicServerProtocol(first_cid=QUIC_connection.SERVER_CID + index, cid_step=workers,
+                                                on_close=connection_closed, **options),
+        local_addr=(host, port), reuse_port=True)
+    loop.add_signal_handler(signal.SIGTERM, protocol.shutdown)
+    pipe.send(('ready', index, os.getpid()))
+    try:
+        await protocol.done
+    finally:
+        transport.close()
+    pipe.send(('done', index, protocol.closed_connections))
+
+
+def worker_main(index, workers, pipe, host, port, options):
+    # Ctrl-C reaches the whole process group; only the launcher handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(run_worker(index, workers, pipe, host, port, **options))
+    finally:
+        pipe.close()
+
+
+class StatisticsAggregator:
+    """
+    Sums the statistics the workers send about their closed connections.
+    """
+
+    def __init__(self, workers):
+        self.connections = 0
+        self.totals = dict.fromkeys(STATISTICS, 0)
+        self.worker_connections = [0] * workers
+
+    def add(self, index, statistics):
+        self.connections += 1
+        self.worker_connections[index] += 1
+        for key in STATISTICS:
+            self.totals[key] += statistics[key]
+
+    def summary(self):
+        return dict(self.totals, connections=self.connections, worker_connections=list(self.worker_connections))
+
+
+def run_workers(workers, host=QUIC_asyncio.SERVER_IP, port=QUIC_asyncio.SERVER_PORT, max_connections=0, **options):
+    """
+    Starts the workers and collects their statistics until they exit. SIGTERM and SIGINT stop the workers gracefully,
+    and so does reaching max_connections closed connections over all the workers. Must run in the main thread.
+
+    :param workers: The number of worker processes
+    :param max_connections: Stop after this many connections were closed (0: serve until SIGTERM)
+    :param options: Keyword arguments for QuicServerProtocol
+    :return: A dictionary with the totals of all the closed connections
+    """
+    processes = []
+    readers = []
+    for index in range(workers):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=worker_main, args=(index, workers, writer, host, port, options),
+                                          daemon=True)
+        process.start()
+        # The worker holds the only write end, so the pipe reports EOF when the worker exits
+        writer.close()
+        processes.append(process)
+        readers.append(reader)
+
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    previous_handlers = {signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+    statistics = StatisticsAggregator(workers)
+    try:
+        while readers:
+            for reader in multiprocessing.connection.wait(readers):
+                try:
+                    kind, index, payload = reader.recv()
+                except EOFError:
+                    readers.remove(reader)
+                    continue
+                if kind == 'ready':
+                    print(f"Worker {index} (pid {payload}) listening on {host}:{port}")
+                elif kind == 'connection':
+                    statistics.add(index, payload)
+                    print(f"Worker {index}: connection {payload['cid']} from CID {payload['client_cid']} closed, "
+                          f"received {payload['bytes']} bytes in {payload['frames']} frames")
+                    if max_connections and statistics.connections >= max_connections:
+                        stop()
+                elif kind == 'done':
+                    print(f"Worker {index} stopped after {payload} connections")
+    finally:
+        stop()
+        for process in processes:
+            process.join()
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+    return statistics.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process QUIC server")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes (default: the number of CPUs)")
+    parser.add_argument("-m", "--max-connections", type=int, default=0,
+                        help="Exit after this many connections were closed over all workers (default: 0, serve until "
+                             "SIGTERM)")
+    parser.add_argument("-d", "--delay", type=int, default=QUIC_connection.MAX_ACK_DELAY,
+                        help="The maximum time a receiver might delay sending an ACK")
+    parser.add_argument("-a", "--ack-threshold", type=int, default=QUIC_connection.ACK_ELICITING_THRESHOLD,
+                        help="Send an ACK every this many ack-eliciting packets (default: 2)")
+    parser.add_argument("-i", "--idle-timeout", type=float, default=QUIC_connection.IDLE_TIMEOUT,
+                        help="Close a connection that received nothing for this many seconds (default: 10)")
+    parser.add_argument("-o", "--output-dir", default=None,
+                        help="Write every received stream to a file in this directory")
+    parser.add_argument("--max-data", type=int, default=QUIC_flow.INITIAL_MAX_DATA,
+                        help="Connection flow control window in bytes")
+    parser.add_argument("--max-stream-data", type=int, default=QUIC_flow.INITIAL_MAX_STREAM_DATA,
+                        help="Stream flow control window in bytes")
+    parser.add_argument("--port", type=int, default=QUIC_asyncio.SERVER_PORT)
+    args = parser.parse_args()
+
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit("SO_REUSEPORT is not supported on this platform")
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    summary = run_workers(args.workers, port=args.port, max_connections=args.max_connections, ack_delay=args.delay,
+                          idle_timeout=args.idle_timeout, output_dir=args.output_dir, max_data=args.max_data,
+                          max_stream_data=args.max_stream_data, ack_threshold=args.ack_threshold)
+    print(f"Served {summary['connections']} connections "
+          f"({', '.join(str(count) for count in summary['worker_connections'])} per worker), "
+          f"received {summary['bytes']} bytes in {summary['frames']} frames, "
+          f"sent {summary['ack_packets']} ack packets and {summary['window_updates']} window updates")
+
+
+if __name__ == '__main__':
+    main()
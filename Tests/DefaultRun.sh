@@ -4,6 +4,6 @@ python3 ../QUIC_Server.py > /dev/null &
 
 sleep 0.01
 
-python3 ../QUIC_Client.py > client_output.txt &
+python3 ../QUIC_Client.py --port ${CLIENT_PORT:-9997} > client_output.txt &
 
 wait
\ No newline at end of file
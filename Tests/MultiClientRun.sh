@@ -0,0 +1,11 @@
+#!/bin/bash
+
+python3 ../QUIC_Server.py -m $1 > /dev/null &
+
+sleep 0.01
+
+for i in $(seq 1 $1); do
+    python3 ../QUIC_Client.py --port ${CLIENT_PORT:-9997} --cid $i > client_output_$i.txt &
+done
+
+wait
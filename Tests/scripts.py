@@ -1,6 +1,29 @@
 import time
 import os
 import signal
+import contextlib
+import sys
+sys.path.append("..")
+import QUIC_netem
+
+
+@contextlib.contextmanager
+def netem(seed=0, **impairments):
+    """
+    Runs the scripts' clients through a QUIC_netem relay instead of straight to the server, in place of
+    `tc qdisc ... netem` on the loopback interface.
+
+    :param seed: The seed of the impairments, so a run is repeatable
+    :param impairments: Keyword arguments for the QUIC_netem.LinkModel of each direction, e.g. loss=0.05
+    :return: The relay, for its statistics
+    """
+    relay = QUIC_netem.symmetric_relay(seed=seed, **impairments)
+    with QUIC_netem.BackgroundRelay(relay, port=QUIC_netem.RELAY_PORT):
+        os.environ['CLIENT_PORT'] = str(QUIC_netem.RELAY_PORT)
+        try:
+            yield relay
+        finally:
+            del os.environ['CLIENT_PORT']
 
 
 def run_default_script():
@@ -16,6 +39,10 @@ def run_test_script(ack_delay):
     os.system(f"./TestRun.sh {ack_delay}")
     time.sleep(0.001)
 
+def run_multi_client_script(clients):
+    os.system(f"./MultiClientRun.sh {clients}")
+    time.sleep(0.001)
+
 
 def parse_speed():
     with open('client_output.txt', 'r') as file:
@@ -24,17 +51,63 @@ def parse_speed():
                 return float(line.split(" ")[1].strip())
 
 
-def single_default_run(timeout):
+def parse_transfer(output_file):
+    """
+    :return: (file size in bytes, total time in seconds) of a client run
+    """
+    file_size = total_time = None
+    with open(output_file, 'r') as file:
+        for line in file:
+            if line.startswith("File Size:"):
+                file_size = int(line.split(" ")[2])
+            elif line.startswith("Total time is:"):
+                total_time = float(line.split(" ")[3])
+    return file_size, total_time
+
+
+def raise_timeout(signum, frame):
+    raise TimeoutError
+
+
+@contextlib.contextmanager
+def alarm(timeout):
+    """
+    Raises TimeoutError if the block runs longer than timeout seconds, and cancels the alarm when it ends, so it can't
+    go off in a later test (SIGALRM's default action kills the test runner).
+    """
+    previous = signal.signal(signal.SIGALRM, raise_timeout)
     signal.alarm(timeout)
-    run_default_script()
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def single_default_run(timeout):
+    with alarm(timeout):
+        run_default_script()
     return parse_speed()
 
 def single_parameters_run(timeout, time_threshold, packet_threshold):
-    signal.alarm(timeout)
-    run_parameters_script(time_threshold, packet_threshold)
+    with alarm(timeout):
+        run_parameters_script(time_threshold, packet_threshold)
     return parse_speed()
 
 def single_test_run(timeout, ack_delay):
-    signal.alarm(timeout)
-    run_test_script(ack_delay)
+    with alarm(timeout):
+        run_test_script(ack_delay)
     return parse_speed()
+
+def multi_client_run(timeout, clients):
+    """
+    Runs the given number of clients against one server at the same time.
+
+    :return: The aggregate throughput of all the clients in MB/s
+    """
+    with alarm(timeout):
+        run_multi_client_script(clients)
+    transfers = [parse_transfer(f'client_output_{i}.txt') for i in range(1, clients + 1)]
+    for i in range(1, clients + 1):
+        os.remove(f'client_output_{i}.txt')
+    return sum(file_size for file_size, _ in transfers) / max(total_time for _, total_time in transfers) / 1024 / 1024
@@ -1,4 +1,5 @@
 import unittest
+import asyncio
 import time
 import os
 import random
@@ -7,9 +8,31 @@ import string
 import sys
 sys.path.append("..")
 import QUIC_api as api
+import QUIC_congestion as congestion_control
+import QUIC_io
+import QUIC_asyncio
+import QUIC_connection
+import QUIC_flow
+import QUIC_workers
+import QUIC_parallel
+import QUIC_streams
+import QUIC_reassembly
+import QUIC_netem
+import QUIC_sim
+import QUIC_benchmark
+import QUIC_microbench
+import QUIC_trace
+import tempfile
+import io
+import contextlib
+import threading
+import socket
 sys.path.append("/Tests")
 
 TIMEOUT = 20
+# At 30% loss the congestion window stays at its minimum, and about a third of the flights get no ACK back and wait out
+# a PTO, which includes the server's ACK delay and doubles when the probes are lost too
+LOSSY_TIMEOUT = 180
 
 class TestQUIC(unittest.TestCase):
     """
@@ -20,6 +43,7 @@ class TestQUIC(unittest.TestCase):
         os.system('chmod +rwx DefaultRun.sh')
         os.system('chmod +rwx ParametersRun.sh')
         os.system('chmod +rwx TestRun.sh')
+        os.system('chmod +rwx MultiClientRun.sh')
 
     """
        Test function for the frame API to validate reading and writing operations of the server.
@@ -106,9 +130,1287 @@ class TestQUIC(unittest.TestCase):
             self.assertEqual(parsed_packet["packet_number"], packet_number)
             self.assertEqual(parsed_packet["ack_delay"], ack_delay)
             self.assertEqual(parsed_packet["blocks_count"], len(ack_ranges))
-            self.assertListEqual(parsed_packet["ack_ranges"], ack_ranges)
+            self.assertEqual(parsed_packet["largest_acknowledged"], 310)
+            # The newest range is sent first
+            self.assertListEqual(parsed_packet["ack_ranges"], ack_ranges[::-1])
         print('passed ACK packet test')
 
+    """
+       Test the binary wire codec: frames, short headers, long headers and ACK packets must survive a round trip
+       through the pack/unpack functions, and the packet overhead must stay far below the bit-string format.
+    """
+    def test_binary_codec_api(self):
+        for iter in range(10):
+            frame_type = random.randint(0, 120)
+            stream_id = random.randint(0, 50000)
+            offset = random.randint(0, 2**40)
+            data = os.urandom(random.randint(0, 2000))
+            frame = api.pack_quic_frame(frame_type, stream_id, offset, data)
+            parsed_frame = api.unpack_quic_frame(frame)
+            self.assertEqual(parsed_frame["frame_type"], frame_type)
+            self.assertEqual(parsed_frame["stream_id"], stream_id)
+            self.assertEqual(parsed_frame["offset"], offset)
+            self.assertEqual(parsed_frame["data_length"], len(data))
+            self.assertEqual(parsed_frame["data"], data)
+
+            dcid = random.randint(0, 5000)
+            packet_number = random.randint(0, 999999)
+            packet = api.pack_quic_short_header(dcid, packet_number, frame)
+            self.assertTrue(api.is_short_header(packet))
+            parsed_packet = api.unpack_quic_short_header(packet)
+            self.assertEqual(parsed_packet["header_form"], 0)
+            self.assertEqual(parsed_packet["dcid"], dcid)
+            self.assertEqual(parsed_packet["packet_number"], packet_number)
+            self.assertEqual(parsed_packet["payload"], frame)
+
+            packet_type = random.randint(0, 3)
+            packet = api.pack_quic_long_header(packet_type, api.QUIC_VERSION_BINARY, dcid, dcid + 1, frame)
+            self.assertFalse(api.is_short_header(packet))
+            parsed_packet = api.unpack_quic_long_header(packet)
+            self.assertEqual(parsed_packet['packet_type'], packet_type)
+            self.assertEqual(parsed_packet['type_specific_bits'], 3)
+            self.assertEqual(parsed_packet['version'], api.QUIC_VERSION_BINARY)
+            self.assertEqual(parsed_packet['dcid'], dcid)
+            self.assertEqual(parsed_packet['scid'], dcid + 1)
+            self.assertEqual(parsed_packet['payload'], frame)
+
+            ack_ranges = [(1, 50), (55, 80), (300, 310)]
+            ack_packet = api.pack_quic_ack_packet(dcid, packet_number, 20, ack_ranges)
+            self.assertFalse(api.is_short_header(ack_packet))
+            parsed_packet = api.unpack_quic_ack_packet(ack_packet)
+            self.assertEqual(parsed_packet["header_form"], 1)
+            self.assertEqual(parsed_packet["dcid"], dcid)
+            self.assertEqual(parsed_packet["packet_number"], packet_number)
+            self.assertEqual(parsed_packet["ack_delay"], 20)
+            self.assertEqual(parsed_packet["blocks_count"], len(ack_ranges))
+            self.assertEqual(parsed_packet["largest_acknowledged"], 310)
+            # The newest range is sent first
+            self.assertListEqual(parsed_packet["ack_ranges"], ack_ranges[::-1])
+
+        # Even with the longest variable-length fields the overhead stays far below the bit-string format, and a
+        # data packet of a 10 MB file spends a few bytes on its headers
+        self.assertLessEqual(api.PACKET_OVERHEAD[api.QUIC_VERSION_BINARY], 32)
+        self.assertLess(api.PACKET_OVERHEAD[api.QUIC_VERSION_BINARY], api.PACKET_OVERHEAD[api.QUIC_VERSION_BITSTRING])
+        self.assertLessEqual(api.packet_overhead(api.QUIC_VERSION_BINARY, 2, 12, 10 * 1024 * 1024), 15)
+        packet = api.pack_quic_short_header(2, 5000, api.pack_quic_frame(8, 0, 9 * 1024 * 1024, b'x'), 4990)
+        self.assertEqual(len(packet) - 1, 1 + 1 + 1 + 1 + 1 + 4 + 1)
+        print('passed binary codec test')
+
+    """
+       Test the variable-length integers and the ACK range encoding: gaps and lengths instead of absolute packet
+       numbers, ACK packets capped to one datagram with the newest ranges kept, and ACKs applied in one merge pass.
+    """
+    def test_ack_range_encoding(self):
+        for value, length in ((0, 1), (63, 1), (64, 2), (16383, 2), (16384, 4), (2**30 - 1, 4), (2**30, 8),
+                              (api.VARINT_MAX, 8)):
+            encoded = api.encode_varint(value)
+            self.assertEqual(len(encoded), length)
+            self.assertEqual(api.varint_size(value), length)
+            self.assertEqual(api.decode_varint(b'x' + encoded, 1), (value, length + 1))
+            self.assertEqual(api.parse_varint_bits(api.varint_bits(value)), (value, 8 * length))
+        with self.assertRaises(ValueError):
+            api.encode_varint(api.VARINT_MAX + 1)
+
+        # 1000 ranges of single lost packets, far from packet number 0
+        ack_ranges = [(10**6 + 3 * i, 10**6 + 3 * i + 1) for i in range(1000)]
+        for version in api.SUPPORTED_VERSIONS:
+            ack_packet = api.encode_quic_ack_packet(7, 1, 5, ack_ranges, version)
+            self.assertLessEqual(len(ack_packet), api.MAX_ACK_SIZE)
+            parsed_packet = api.decode_quic_ack_packet(ack_packet, version)
+            sent_ranges = list(parsed_packet["ack_ranges"])
+            self.assertEqual(parsed_packet["blocks_count"], len(sent_ranges))
+            self.assertLess(len(sent_ranges), len(ack_ranges))
+            self.assertListEqual(sent_ranges, ack_ranges[::-1][:len(sent_ranges)])
+            self.assertEqual(parsed_packet["ack_delay"], 5)
+        # First byte, DCID, packet number, largest acknowledged, ACK delay, range count, first range, then two bytes
+        # per range in the binary format
+        self.assertEqual(len(api.pack_quic_ack_packet(7, 1, 5, ack_ranges[:100])), 1 + 1 + 1 + 4 + 1 + 2 + 1 + 2 * 99)
+
+        packet_queue = api.SentPacketMap()
+        for packet_number in range(20):
+            packet_queue.add(packet_number, packet_number, b'x' * 10, None)
+        acked = packet_queue.on_ack_ranges([(15, 16), (2, 4), (8, 8), (30, 40)])
+        self.assertListEqual([record.packet_number for record in acked], [2, 3, 4, 8, 15, 16])
+        self.assertEqual(packet_queue.largest_acked, 40)
+        self.assertListEqual(packet_queue.on_ack_ranges([(0, 19)]) and
+                             [record.packet_number for record in packet_queue], [])
+        print('passed ACK range encoding test')
+
+    """
+       Test the truncated packet numbers: only the bytes the receiver needs are sent, and the full packet number is
+       recovered from the largest one received, in both wire formats.
+    """
+    def test_packet_number_encoding(self):
+        self.assertEqual(api.packet_number_length(10, 5), 1)
+        self.assertEqual(api.packet_number_length(10**6, 10**6 - 100), 1)
+        self.assertEqual(api.packet_number_length(10**6, 10**6 - 200), 2)
+        self.assertEqual(api.packet_number_length(10**6), 3)
+        self.assertEqual(api.packet_number_length(2**30), 4)
+        # RFC 9000, appendix A.3
+        self.assertEqual(api.decode_packet_number(0x9b32, 2, 0xa82f30ea), 0xa82f9b32)
+
+        for version in api.SUPPORTED_VERSIONS:
+            for largest_acked, largest_received, packet_number in ((-1, -1, 70000), (99990, 100000, 100010),
+                                                                   (250, 255, 260), (2**20, 2**20 + 60, 2**20 + 1),
+                                                                   (2**24 - 10, 2**24 - 2, 2**24 + 3)):
+                frame = api.encode_quic_frame(8, 4, 0, 'data', version)
+                packet = api.encode_quic_short_packet(300, packet_number, frame, version, largest_acked)
+                self.assertEqual(api.short_header_dcid(packet), 300)
+                parsed_packet = api.decode_quic_short_packet(packet, version, largest_received)
+                self.assertEqual(parsed_packet["dcid"], 300)
+                self.assertEqual(parsed_packet["packet_number"], packet_number)
+                self.assertEqual(api.decode_quic_frame(parsed_packet["payload"], version)["data_length"], 4)
+        print('passed packet number encoding test')
+
+    """
+       Test the memoryview-backed views: they must read the same fields as the unpack functions, straight from the
+       receive buffer and without copying the frame data.
+    """
+    def test_packet_views(self):
+        for iter in range(10):
+            data = os.urandom(random.randint(1, 2000))
+            offset = random.randint(0, 2**40)
+            packet_number = random.randint(0, 999999)
+            buffer = bytearray(api.pack_quic_short_header(7, packet_number, api.pack_quic_frame(8, 3, offset, data)))
+
+            packet_view = api.QuicShortPacketView(buffer)
+            self.assertEqual(packet_view.header_form, 0)
+            self.assertEqual(packet_view["dcid"], 7)
+            self.assertEqual(packet_view["packet_number"], packet_number)
+            frame_view = packet_view.frame()
+            self.assertEqual(frame_view["frame_type"], 8)
+            self.assertEqual(frame_view["stream_id"], 3)
+            self.assertEqual(frame_view["offset"], offset)
+            self.assertEqual(frame_view["data_length"], len(data))
+            self.assertIsInstance(frame_view.data, memoryview)
+            self.assertEqual(frame_view.data, data)
+            self.assertFalse(hasattr(frame_view, '__dict__'))
+
+            # The view reads through to the receive buffer
+            buffer[-1] ^= 0xff
+            self.assertEqual(frame_view.data[-1], data[-1] ^ 0xff)
+
+        ack_ranges = [(1, 50), (55, 80), (300, 310)]
+        ack_view = api.QuicAckPacketView(api.pack_quic_ack_packet(1, 9, 20, ack_ranges))
+        self.assertEqual(ack_view["packet_number"], 9)
+        self.assertEqual(ack_view["ack_delay"], 20)
+        self.assertListEqual(list(ack_view.iter_ack_ranges()), ack_ranges[::-1])
+        self.assertListEqual(ack_view["ack_ranges"], ack_ranges[::-1])
+        print('passed packet views test')
+
+    """
+       Test the packet encoder: its packets must match the ones built by encode_quic_short_packet in both versions,
+       for encoded frames and frame references, with only the packet number patched between packets.
+    """
+    def test_packet_encoder(self):
+        class FrameReference:
+            def __init__(self, frame_type, stream_id, offset, data):
+                self.frame_type = frame_type
+                self.stream_id = stream_id
+                self.offset = offset
+                self.data = data
+
+        for version in (api.QUIC_VERSION_BITSTRING, api.QUIC_VERSION_BINARY):
+            encoder = api.PacketEncoder(5, version, buffer_count=3)
+            packets = []
+            for packet_number in range(10):
+                data = os.urandom(random.randint(0, 1000))
+                frame = api.encode_quic_frame(8, 4, packet_number * 1000, data, version)
+                expected = api.encode_quic_short_packet(5, packet_number, frame, version)
+                if packet_number % 2:
+                    packet = encoder.encode(packet_number, FrameReference(8, 4, packet_number * 1000, memoryview(data)))
+                else:
+                    packet = encoder.encode(packet_number, frame)
+                self.assertEqual(bytes(packet), expected)
+                packets.append((packet, expected))
+
+            if version == api.QUIC_VERSION_BINARY:
+                # The buffers are reused in turn: the last packets are still intact
+                self.assertIsInstance(packets[-1][0], memoryview)
+                for packet, expected in packets[-3:]:
+                    self.assertEqual(bytes(packet), expected)
+
+            # A full packet of binary data fits in one datagram, and every byte value comes back as it was sent
+            data = bytes(range(256)) * 8
+            data = data[:2048 - api.packet_overhead(version, 5, 4, 10 * 1024 * 1024)]
+            packet = encoder.encode(1000, FrameReference(8, 4, 10 * 1024 * 1024, memoryview(data)))
+            self.assertLessEqual(len(packet), 2048)
+            frame = api.decode_quic_frame(api.decode_quic_short_packet(bytes(packet), version)['payload'], version)
+            received = frame['data']
+            if version == api.QUIC_VERSION_BITSTRING:
+                received = received.encode('latin-1')
+            self.assertEqual(bytes(received), data)
+        print('passed packet encoder test')
+
+    """
+       Test the sent-packet map used by the client: ACKing single packets and ranges, send order, and that the
+       recovery functions move lost packets to the end under new packet numbers.
+    """
+    def test_sent_packet_map(self):
+        class RecordingSocket:
+            def __init__(self):
+                self.sent = []
+
+            def sendto(self, data, address):
+                # The retransmissions are built in a reused buffer
+                self.sent.append(bytes(data))
+
+        version = api.QUIC_VERSION_BINARY
+        packet_queue = api.SentPacketMap(2)
+        for packet_number in range(100):
+            frame = api.encode_quic_frame(8, 0, packet_number * 10, 'x' * 10, version)
+            packet_queue.add(packet_number, packet_number, api.encode_quic_short_packet(2, packet_number, frame, version),
+                             frame)
+
+        self.assertEqual(packet_queue.on_ack(5).packet_number, 5)
+        self.assertIsNone(packet_queue.on_ack(5))
+        self.assertEqual([record.packet_number for record in packet_queue.on_ack_range(3, 10)], [3, 4, 6, 7, 8, 9, 10])
+        self.assertEqual(len(packet_queue.on_ack_range(0, 10**9)), 92)
+        self.assertEqual(len(packet_queue), 0)
+        self.assertEqual(packet_queue.largest_acked, 10**9)
+
+        packet_queue = api.SentPacketMap(2)
+        for packet_number in range(20):
+            frame = api.encode_quic_frame(8, 0, packet_number * 10, 'x' * 10, version)
+            packet_queue.add(packet_number, packet_number, api.encode_quic_short_packet(2, packet_number, frame, version),
+                             frame)
+        packet_queue.on_ack_range(15, 15)
+
+        sock = RecordingSocket()
+        count, current_packet_number = api.packet_number_based_recovery(sock, None, packet_queue, 20, 7, version)
+        self.assertEqual(count, 8)
+        self.assertEqual(current_packet_number, 28)
+        self.assertEqual([api.unpack_quic_short_header(packet)['packet_number'] for packet in sock.sent],
+                         list(range(20, 28)))
+        self.assertEqual(api.unpack_quic_frame(api.unpack_quic_short_header(sock.sent[0])['payload'])['offset'], 0)
+        self.assertTrue(all(api.unpack_quic_short_header(packet)['dcid'] == 2 for packet in sock.sent))
+        self.assertEqual(packet_queue.first().packet_number, 8)
+        self.assertEqual([record.packet_number for record in packet_queue][-8:], list(range(20, 28)))
+        print('passed sent packet map test')
+
+    """
+       Test the RTT estimator: the first sample seeds the estimates, later samples are smoothed with the ACK delay
+       subtracted, and the loss thresholds follow the measured RTT.
+    """
+    def test_rtt_estimator(self):
+        rtt = api.RttEstimator()
+        self.assertEqual(rtt.smoothed_rtt, api.INITIAL_RTT)
+
+        rtt.update(0.1)
+        self.assertAlmostEqual(rtt.smoothed_rtt, 0.1)
+        self.assertAlmostEqual(rtt.rttvar, 0.05)
+        self.assertAlmostEqual(rtt.min_rtt, 0.1)
+
+        # 0.02 of the 0.14 sample is the receiver's ACK delay
+        rtt.update(0.14, 0.02)
+        self.assertAlmostEqual(rtt.smoothed_rtt, 7 / 8 * 0.1 + 1 / 8 * 0.12)
+        self.assertAlmostEqual(rtt.rttvar, 3 / 4 * 0.05 + 1 / 4 * 0.02)
+        self.assertAlmostEqual(rtt.min_rtt, 0.1)
+        self.assertAlmostEqual(rtt.time_threshold(), 9 / 8 * 0.14)
+        self.assertAlmostEqual(rtt.pto(), rtt.smoothed_rtt + 4 * rtt.rttvar + 0.02)
+
+        # The ACK delay is not subtracted when it would push the sample below the minimum RTT
+        rtt.update(0.105, 0.02)
+        self.assertAlmostEqual(rtt.smoothed_rtt, 7 / 8 * (7 / 8 * 0.1 + 1 / 8 * 0.12) + 1 / 8 * 0.105)
+        print('passed RTT estimator test')
+
+    """
+       Test the congestion controllers: slow start growth, a single window reduction per recovery period, no reduction
+       for a PTO, and the window gating can_send.
+    """
+    def test_congestion_control(self):
+        rtt = api.RttEstimator()
+        rtt.update(0.01)
+        for name in ('newreno', 'cubic'):
+            congestion = congestion_control.create_congestion_controller(name, rtt, 1000)
+            self.assertEqual(congestion.congestion_window, 10000)
+
+            for packet in range(10):
+                self.assertTrue(congestion.can_send(1000))
+                congestion.on_packet_sent(1000, 0)
+            self.assertFalse(congestion.can_send(1000))
+
+            # Slow start: every ACKed byte grows the window by one byte
+            for packet in range(5):
+                congestion.on_ack(1000, 0, 0.01)
+            self.assertEqual(congestion.congestion_window, 15000)
+            self.assertEqual(congestion.bytes_in_flight, 5000)
+
+            # A PTO is not a loss signal: the probed packet leaves the flight, the window stays
+            congestion.on_pto(1000, 0.02)
+            self.assertEqual(congestion.bytes_in_flight, 4000)
+            self.assertEqual(congestion.congestion_window, 15000)
+            self.assertEqual(congestion.congestion_events, 0)
+            congestion.on_packet_sent(1000, 0.02)
+
+            # Two losses from the same flight are a single congestion event
+            congestion.on_loss(1000, 0, 0.02)
+            congestion.on_loss(1000, 0, 0.02)
+            self.assertEqual(congestion.congestion_events, 1)
+            beta = congestion_control.LOSS_REDUCTION_FACTOR if name == 'newreno' else congestion_control.CUBIC_BETA
+            self.assertAlmostEqual(congestion.congestion_window, 15000 * beta)
+            self.assertFalse(congestion.in_slow_start())
+
+            # ACKs for packets sent before the loss don't grow the window, later ones do
+            window = congestion.congestion_window
+            congestion.on_ack(1000, 0, 0.03)
+            self.assertEqual(congestion.congestion_window, window)
+            for packet in range(100):
+                congestion.on_packet_sent(1000, 0.03)
+                congestion.on_ack(1000, 0.03, 0.04 + packet * 0.01)
+            self.assertGreater(congestion.congestion_window, window)
+
+        self.assertTrue(congestion_control.create_congestion_controller('none', rtt).can_send(10**9))
+
+        # A controller without its window updates can't be created
+        class Incomplete(congestion_control.CongestionController):
+            def on_congestion_event(self, now):
+                pass
+        with self.assertRaises(TypeError):
+            Incomplete(rtt)
+        print('passed congestion control test')
+
+    """
+       Test the pacer: a burst of packets may go out at once, after which packets are spaced at the pacing rate.
+    """
+    def test_pacer(self):
+        rtt = api.RttEstimator()
+        rtt.update(0.01)
+        congestion = congestion_control.create_congestion_controller('newreno', rtt, 1000)
+
+        # Derived rate: 1.25 * 10 packets per 10 ms
+        pacer = congestion_control.Pacer(congestion)
+        self.assertAlmostEqual(pacer.pacing_rate(), 1.25 * 10000 / 0.01)
+
+        pacer = congestion_control.Pacer(congestion, rate=100000, burst_packets=2)
+        now = 1.0
+        for packet in range(2):
+            self.assertEqual(pacer.next_send_time(now), now)
+            pacer.on_packet_sent(1000, now)
+        self.assertAlmostEqual(pacer.next_send_time(now), now + 0.01)
+
+        now = pacer.next_send_time(now)
+        self.assertEqual(pacer.next_send_time(now), now)
+        pacer.on_packet_sent(1000, now)
+        self.assertAlmostEqual(pacer.next_send_time(now), now + 0.01)
+        self.assertEqual(pacer.average_pacing_rate(), 100000)
+        print('passed pacer test')
+
+    """
+       Test the batched socket I/O over loopback, with sendmmsg/recvmmsg where available and with the fallback, and the
+       fallback waiting out a full socket buffer.
+    """
+    def test_batch_io(self):
+        for use_mmsg in (True, False):
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.bind(('127.0.0.1', 0))
+            receiver.bind(('127.0.0.1', 0))
+            sender.setblocking(False)
+            receiver.setblocking(False)
+            sender_io = QUIC_io.BatchSocketIO(sender, batch_size=8, use_mmsg=use_mmsg)
+            receiver_io = QUIC_io.BatchSocketIO(receiver, batch_size=8, use_mmsg=use_mmsg)
+
+            datagrams = [os.urandom(random.randint(1, 2000)) for _ in range(20)]
+            # Writable buffers are sent in place, other buffers are copied
+            to_send = [datagram if i % 3 == 0 else memoryview(bytearray(datagram)) if i % 3 == 1
+                       else memoryview(datagram) for i, datagram in enumerate(datagrams)]
+            self.assertEqual(sender_io.send(to_send, receiver.getsockname()), len(datagrams))
+
+            received = []
+            deadline = time.time() + 1
+            while len(received) < len(datagrams) and time.time() < deadline:
+                for datagram, address in receiver_io.receive():
+                    self.assertEqual(address, sender.getsockname())
+                    received.append(bytes(datagram))
+            self.assertListEqual(received, datagrams)
+            self.assertListEqual(receiver_io.receive(), [])
+            if sender_io.use_mmsg:
+                self.assertLess(sender_io.send_calls, len(datagrams))
+
+            sender.close()
+            receiver.close()
+
+        # The fallback waits for a full socket buffer to drain instead of failing
+        class FullSocket:
+            def __init__(self, sock):
+                self.sock = sock
+                self.sent = []
+                self.full = True
+
+            def fileno(self):
+                return self.sock.fileno()
+
+            def sendto(self, datagram, address):
+                self.full = not self.full
+                if not self.full:
+                    raise BlockingIOError
+                self.sent.append(bytes(datagram))
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            full_socket = FullSocket(sock)
+            sender_io = QUIC_io.BatchSocketIO(full_socket, use_mmsg=False)
+            self.assertEqual(sender_io.send(datagrams, ('127.0.0.1', 9)), len(datagrams))
+            self.assertListEqual(full_socket.sent, datagrams)
+            self.assertEqual(sender_io.send_calls, 2 * len(datagrams))
+        print('passed batch I/O test')
+
+    """
+       Test the version negotiation and the version dispatching helpers used by the client and the server, and that a
+       late ServerHello isn't read as an ACK.
+    """
+    def test_version_negotiation(self):
+        self.assertEqual(api.negotiate_version(api.QUIC_VERSION_BINARY), api.QUIC_VERSION_BINARY)
+        self.assertEqual(api.negotiate_version(api.QUIC_VERSION_BITSTRING), api.QUIC_VERSION_BITSTRING)
+        self.assertEqual(api.negotiate_version(max(api.SUPPORTED_VERSIONS) + 1), max(api.SUPPORTED_VERSIONS))
+
+        for version in api.SUPPORTED_VERSIONS:
+            frame = api.encode_quic_frame(8, 0, 1827, 'data', version)
+            packet = api.encode_quic_short_packet(2, 17, frame, version)
+            self.assertIsInstance(packet, bytes)
+            self.assertTrue(api.is_short_header(packet))
+            parsed_packet = api.decode_quic_short_packet(packet, version)
+            self.assertEqual(parsed_packet["packet_number"], 17)
+            parsed_frame = api.decode_quic_frame(parsed_packet["payload"], version)
+            self.assertEqual(parsed_frame["offset"], 1827)
+
+            ack_packet = api.encode_quic_ack_packet(1, 3, 20, [(0, 5)], version)
+            self.assertFalse(api.is_short_header(ack_packet))
+            self.assertListEqual(api.decode_quic_ack_packet(ack_packet, version)["ack_ranges"], [(0, 5)])
+
+            # Hellos are long headers, ACKs and short headers aren't
+            hello_packet = api.construct_quic_long_header(0, version, 1, 2, api.construct_quic_frame(
+                6, 0, 0, api.hello_data('Server', max_ack_delay=5))).encode()
+            self.assertTrue(api.is_long_header(hello_packet))
+            self.assertFalse(api.is_long_header(ack_packet))
+            self.assertFalse(api.is_long_header(packet))
+
+            # A late ServerHello among the ACKs is dropped, instead of being read as an ACK
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            receiver.bind(('127.0.0.1', 0))
+            receiver.setblocking(False)
+            packet_queue = api.SentPacketMap(2)
+            for packet_number in range(60):
+                packet_queue.add(packet_number, 0.0, b'x' * 40, frame)
+            sender.sendto(hello_packet, receiver.getsockname())
+            sender.sendto(ack_packet, receiver.getsockname())
+            time.sleep(0.01)
+            api.receive_ACKs(receiver, None, packet_queue, False, 60, 0, 0, None, version,
+                             io=QUIC_io.BatchSocketIO(receiver))
+            self.assertEqual(len(packet_queue), 54)
+            sender.close()
+            receiver.close()
+        print('passed version negotiation test')
+
+    """
+       Test the asyncio client and server: a few concurrent transfers of a small file over loopback in one process, with
+       the server writing every stream to disk, and the client's PTO covering the ACK delay the server advertised.
+    """
+    def test_asyncio_transfer(self):
+        file_path = 'asyncio_test_file.txt'
+        with open(file_path, 'w') as file:
+            file.write(''.join(random.choices(string.ascii_letters + string.digits, k=100000)))
+
+        async def transfer(version, output_dir):
+            loop = asyncio.get_running_loop()
+            transport, server = await loop.create_datagram_endpoint(
+                lambda: QUIC_asyncio.QuicServerProtocol(ack_delay=5, max_connections=3, output_dir=output_dir),
+                local_addr=('127.0.0.1', 0))
+            port = transport.get_extra_info('sockname')[1]
+            try:
+                results = await asyncio.wait_for(
+                    QUIC_asyncio.run_clients(3, [file_path], port=port, quic_version=version), TIMEOUT)
+                closed = await asyncio.wait_for(server.done, TIMEOUT)
+            finally:
+                transport.close()
+            return results, closed
+
+        try:
+            with open(file_path, 'rb') as file:
+                content = file.read()
+            for version in api.SUPPORTED_VERSIONS:
+                with tempfile.TemporaryDirectory() as output_dir:
+                    results, closed = asyncio.run(transfer(version, output_dir))
+                    output_files = sorted(os.listdir(output_dir))
+                    self.assertEqual(len(output_files), 3)
+                    for output_file in output_files:
+                        with open(os.path.join(output_dir, output_file), 'rb') as file:
+                            self.assertEqual(file.read(), content)
+                self.assertEqual(closed, 3)
+                self.assertListEqual(sorted(result['client_cid'] for result in results), [1, 2, 3])
+                for result in results:
+                    self.assertEqual(result['file_size'], 100000)
+                    self.assertGreaterEqual(result['unique_packets'], 100000 // 2048)
+                    # Loopback loses nothing: the PTO waits for the server's delayed ACKs instead of resending
+                    self.assertLess(result['retransmissions'], result['unique_packets'])
+        finally:
+            os.remove(file_path)
+        print('passed asyncio transfer test')
+
+    """
+       Test the network emulator's link models: the loss rates, the bursts of Gilbert-Elliott loss, duplication,
+       reordering, jitter and the rate limiter's spacing and queue, and that the same seed gives the same impairments.
+    """
+    def test_netem_link_model(self):
+        link = QUIC_netem.LinkModel(loss=0.1, seed=1)
+        fates = [link.deliveries(1000, 0) for _ in range(10000)]
+        self.assertAlmostEqual(link.lost / 10000, 0.1, delta=0.02)
+        self.assertEqual(link.lost, fates.count([]))
+        again = QUIC_netem.LinkModel(loss=0.1, seed=1)
+        self.assertListEqual([again.deliveries(1000, 0) for _ in range(10000)], fates)
+
+        # Bursty loss: the same average loss as independent loss, in much longer runs
+        model = QUIC_netem.GilbertElliott.from_loss(0.05, 4)
+        self.assertAlmostEqual(model.average_loss, 0.05)
+        link = QUIC_netem.LinkModel(gilbert_elliott=model, seed=2)
+        lost = [not link.deliveries(1000, 0) for _ in range(40000)]
+        self.assertAlmostEqual(sum(lost) / len(lost), 0.05, delta=0.015)
+        bursts = sum(1 for i in range(len(lost)) if lost[i] and (i == 0 or not lost[i - 1]))
+        self.assertGreater(sum(lost) / bursts, 3)
+
+        link = QUIC_netem.LinkModel(delay=0.01, jitter=0.005, duplicate=0.2, reorder=0.1, seed=3)
+        fates = [link.deliveries(1000, 1.0) for _ in range(10000)]
+        self.assertAlmostEqual(link.duplicated / 10000, 0.2, delta=0.02)
+        self.assertEqual(sum(len(times) for times in fates), 10000 + link.duplicated)
+        self.assertAlmostEqual(link.reordered / (10000 + link.duplicated), 0.1, delta=0.02)
+        arrivals = [arrival for times in fates for arrival in times]
+        self.assertEqual(arrivals.count(1.0), link.reordered)
+        self.assertTrue(all(arrival == 1.0 or 1.005 <= arrival <= 1.015 for arrival in arrivals))
+
+        # 1000 bytes per second: 100 byte datagrams leave 0.1 seconds apart, and the fourth waiting one is dropped
+        link = QUIC_netem.LinkModel(rate=1000, queue_limit=3)
+        fates = [link.deliveries(100, 0) for _ in range(4)]
+        self.assertListEqual([len(times) for times in fates], [1, 1, 1, 0])
+        for times, arrival in zip(fates, [0.1, 0.2, 0.3]):
+            self.assertAlmostEqual(times[0], arrival)
+        self.assertEqual(link.queue_drops, 1)
+        self.assertAlmostEqual(link.deliveries(100, 1.0)[0], 1.1)
+        print('passed netem link model test')
+
+    """
+       Test the network emulator relay: concurrent asyncio transfers through a relay that loses, duplicates, reorders
+       and delays datagrams both ways still deliver every file intact.
+    """
+    def test_netem_relay(self):
+        file_path = 'netem_test_file.txt'
+        with open(file_path, 'w') as file:
+            file.write(''.join(random.choices(string.ascii_letters + string.digits, k=100000)))
+
+        async def transfer(output_dir):
+            loop = asyncio.get_running_loop()
+            transport, server = await loop.create_datagram_endpoint(
+                lambda: QUIC_asyncio.QuicServerProtocol(ack_delay=5, max_connections=2, output_dir=output_dir),
+                local_addr=('127.0.0.1', 0))
+            relay = QUIC_netem.symmetric_relay(('127.0.0.1', transport.get_extra_info('sockname')[1]), seed=4,
+                                               loss=0.05, delay=0.002, jitter=0.001, reorder=0.05, duplicate=0.05)
+            await relay.start(port=0)
+            try:
+                results = await asyncio.wait_for(
+                    QUIC_asyncio.run_clients(2, [file_path], port=relay.address[1]), TIMEOUT)
+                closed = await asyncio.wait_for(server.done, TIMEOUT)
+            finally:
+                relay.close()
+                transport.close()
+            return results, closed, relay.statistics()
+
+        try:
+            with open(file_path, 'rb') as file:
+                content = file.read()
+            with tempfile.TemporaryDirectory() as output_dir:
+                results, closed, statistics = asyncio.run(transfer(output_dir))
+                output_files = sorted(os.listdir(output_dir))
+                self.assertEqual(len(output_files), 2)
+                for output_file in output_files:
+                    with open(os.path.join(output_dir, output_file), 'rb') as file:
+                        self.assertEqual(file.read(), content)
+            self.assertEqual(closed, 2)
+            self.assertEqual(len(results), 2)
+            self.assertGreater(statistics['uplink']['lost'], 0)
+            self.assertGreater(statistics['uplink']['duplicated'], 0)
+        finally:
+            os.remove(file_path)
+        print('passed netem relay test')
+
+    """
+       Test the discrete-event simulation: the recovery functions run on the injected clock, with the PTO backoff and
+       its probes, a simulated transfer delivers the whole file over a lossy link with every recovery algorithm, and
+       the same seed gives the same run.
+    """
+    def test_simulation(self):
+        # A packet sent at 0 is lost once the injected clock passes the PTO, whatever the wall clock says
+        clock = QUIC_sim.SimulatedClock()
+        client = QUIC_sim.SimulatedSocket(QUIC_sim.CLIENT_ADDRESS)
+        server = QUIC_sim.SimulatedSocket(QUIC_sim.SERVER_ADDRESS)
+        client.link = QUIC_sim.SimulatedLink(clock, QUIC_netem.LinkModel(delay=0.1), server)
+        packet_queue = api.SentPacketMap(2)
+        frame = api.encode_quic_frame(0x08, 0, 0, b'data', api.QUIC_VERSION_BINARY)
+        packet_queue.add(0, 0.0, b'x' * 40, frame)
+        clock.run_until(0.5)
+        self.assertEqual(api.PTO_recovery(client, None, packet_queue, 1, 1.0, api.QUIC_VERSION_BINARY,
+                                          clock=clock), (0, 1))
+        clock.run_until(1.5)
+        rtt = api.RttEstimator()
+        congestion = congestion_control.create_congestion_controller('newreno', rtt)
+        congestion.on_packet_sent(40, 0.0)
+        window = congestion.congestion_window
+        self.assertEqual(api.PTO_recovery(client, None, packet_queue, 1, 1.0, api.QUIC_VERSION_BINARY,
+                                          congestion=congestion, clock=clock), (1, 2))
+        self.assertEqual(next(iter(packet_queue)).send_time, 1.5)
+        # The probe replaces the packet in flight, and doesn't shrink the window
+        self.assertEqual(congestion.bytes_in_flight, next(iter(packet_queue)).size)
+        self.assertEqual(congestion.congestion_window, window)
+        self.assertEqual(congestion.congestion_events, 0)
+        self.assertListEqual(server.receive(), [])
+        clock.run_until(1.6)
+        self.assertEqual(len(server.receive()), 1)
+
+        # The next expiry waits twice as long, and only the oldest MAX_PROBE_PACKETS packets are sent again
+        for packet_number in range(2, 5):
+            packet_queue.add(packet_number, 1.6, b'x' * 40, frame)
+        clock.run_until(3.5)
+        self.assertEqual(api.PTO_recovery(client, None, packet_queue, 5, 1.0, api.QUIC_VERSION_BINARY,
+                                          clock=clock), (0, 5))
+        clock.run_until(3.6)
+        self.assertEqual(api.PTO_recovery(client, None, packet_queue, 5, 1.0, api.QUIC_VERSION_BINARY,
+                                          clock=clock), (api.MAX_PROBE_PACKETS, 5 + api.MAX_PROBE_PACKETS))
+        self.assertEqual(len(packet_queue), 4)
+        self.assertEqual(api.probe_timeout(packet_queue, PTO_TIMEOUT=1.0), 4.0)
+        # An ACK that ACKs something ends the backoff
+        api.on_ACK_received({'ack_ranges': [(5, 5)], 'largest_acknowledged': 5, 'ack_delay': 0, 'packet_number': 0},
+                            packet_queue, 3.7)
+        self.assertEqual(api.probe_timeout(packet_queue, PTO_TIMEOUT=1.0), 1.0)
+
+        # The loss timer waits for the PTO of the oldest packet, or for its time threshold once a later one is ACKed
+        packet_queue = api.SentPacketMap(2)
+        self.assertEqual(api.loss_timeout(packet_queue, 0.25, 1.0, clock=lambda: 4.0), 1.0)
+        packet_queue.add(0, 4.0, b'x' * 40, frame)
+        packet_queue.add(1, 4.0, b'x' * 40, frame)
+        self.assertEqual(api.loss_timeout(packet_queue, 0.25, 1.0, clock=lambda: 4.5), 0.5)
+        api.on_ACK_received({'ack_ranges': [(1, 1)], 'largest_acknowledged': 1, 'ack_delay': 0, 'packet_number': 1},
+                            packet_queue, 4.125)
+        self.assertEqual(api.loss_timeout(packet_queue, 0.25, 1.0, clock=lambda: 4.125), 0.125)
+        self.assertEqual(api.loss_timeout(packet_queue, 0, 1.0, clock=lambda: 4.125), 0.875)
+        self.assertEqual(api.loss_timeout(packet_queue, 0.25, 1.0, clock=lambda: 6.0), 0)
+
+        size = 1024 * 1024
+        for options in ({}, {'time_threshold': 0}, {'packet_threshold': 0}, {'congestion': 'cubic'}):
+            runs = []
+            for _ in range(2):
+                uplink, downlink = QUIC_sim.link_models(0.05, seed=3)
+                runs.append(QUIC_sim.simulate_transfer(size=size, uplink=uplink, downlink=downlink, **options))
+            result = runs[0]
+            self.assertEqual(result, runs[1])
+            self.assertEqual(result['server']['bytes'], size)
+            self.assertEqual(result['server']['complete_streams'], 1)
+            self.assertGreater(result['retransmissions'], 0)
+            self.assertGreater(result['uplink']['lost'], 0)
+            if options.get('time_threshold') == 0:
+                self.assertEqual(result['time_retransmissions'], 0)
+            if options.get('packet_threshold') == 0:
+                self.assertEqual(result['packet_number_retransmissions'], 0)
+
+        # Without loss nothing is sent twice, and the transfer takes a few RTTs of the simulated link
+        result = QUIC_sim.simulate_transfer(size=size)
+        self.assertEqual(result['retransmissions'], 0)
+        self.assertGreater(result['total_time'], 2 * QUIC_sim.LINK_DELAY)
+        print('passed simulation test')
+
+    """
+       Test the benchmark runner: the configuration matrix, repeated runs in simulation and in process, the JSON and
+       CSV output, the parsing of QUIC_Client.py's output, and the comparison to a baseline.
+    """
+    def test_benchmark(self):
+        configs = QUIC_benchmark.configurations([256 * 1024], [0, 5], [20], [None, 0], [7, 0])
+        self.assertEqual(len(configs), 6)
+        self.assertFalse(any(config['time_threshold'] == 0 and config['packet_threshold'] == 0 for config in configs))
+
+        configs = QUIC_benchmark.configurations([256 * 1024], [0, 5], [20], [None], [7])
+        with tempfile.TemporaryDirectory() as directory:
+            results = QUIC_benchmark.run_benchmark(configs, 'sim', repeats=2, warmup=0, directory=directory,
+                                                   log=None)
+            self.assertListEqual([result['summary']['runs'] for result in results], [2, 2])
+            self.assertLess(results[0]['summary']['retransmissions'], results[1]['summary']['retransmissions'])
+            self.assertGreater(results[0]['summary']['goodput'], results[1]['summary']['goodput'])
+            self.assertIsNotNone(results[1]['summary']['ack_latency_p99'])
+
+            json_path = os.path.join(directory, 'results.json')
+            csv_path = os.path.join(directory, 'results.csv')
+            QUIC_benchmark.write_json(json_path, 'sim', results, 2)
+            QUIC_benchmark.write_csv(csv_path, results)
+            with open(csv_path) as file:
+                self.assertEqual(len(file.readlines()), 3)
+            baseline = QUIC_benchmark.load_baseline(json_path)
+            comparisons = QUIC_benchmark.compare_to_baseline(results, baseline)
+            self.assertEqual(len(comparisons), 6)
+            self.assertFalse(any(comparison['regression'] for comparison in comparisons))
+            baseline[results[1]['key']]['goodput'] *= 1.5
+            regressions = [comparison for comparison in QUIC_benchmark.compare_to_baseline(results, baseline)
+                           if comparison['regression']]
+            self.assertEqual(len(regressions), 1)
+            self.assertEqual(regressions[0]['metric'], 'goodput')
+
+            run = QUIC_benchmark.run_once('asyncio', QUIC_benchmark.benchmark_file(256 * 1024, directory), configs[0],
+                                          0, TIMEOUT)
+            self.assertGreater(run['goodput'], 0)
+            self.assertGreater(run['ack_latency_p99'], 0)
+
+        output = ("Total time is: 2.000000 seconds\nFile Size: 4194304 bytes\nBandwidth: 2.000 MB/s\n\n"
+                  "Unique packets: 2056\nRe-transmitted packets: 12\nACK latency: p50 0.500 ms, p99 4.000 ms\n")
+        self.assertDictEqual(QUIC_benchmark.parse_client_output(output),
+                             {'total_time': 2.0, 'file_size': 4194304, 'unique_packets': 2056, 'retransmissions': 12,
+                              'ack_latency_p50': 0.0005, 'ack_latency_p99': 0.004})
+        # A transfer that got no ACK has no ACK latency
+        result = QUIC_benchmark.parse_client_output(output.replace("p50 0.500 ms, p99 4.000 ms",
+                                                                   "p50 n/a ms, p99 n/a ms"))
+        self.assertIsNone(result['ack_latency_p50'])
+        self.assertIsNone(QUIC_benchmark.run_result(result, 0.1)['ack_latency_p99'])
+        print('passed benchmark test')
+
+    """
+       Test the codec microbenchmarks: every case runs in both wire formats, reports its time and memory, and a codec
+       missing a function gets an error for its cases instead of stopping the run. A codec from before the wire format
+       versions falls back on its construct_*/parse_* functions, and the errors of both codecs are printed.
+    """
+    def test_microbench(self):
+        results = QUIC_microbench.run_cases(api, memory=True, min_time=0.001, repeats=1)
+        expected = sum(len(parameters) for _, parameters in QUIC_microbench.CASES.values()) * 2
+        self.assertEqual(len(results), expected)
+        for result in results.values():
+            self.assertGreater(result['ns'], 0)
+            self.assertGreaterEqual(result['peak_bytes'], result['kept_bytes'])
+        # A bigger payload keeps more memory, and the bit string format is the bigger one
+        frame_encode = {(version, size): results[('frame encode', version, size)]['kept_bytes']
+                        for version in api.SUPPORTED_VERSIONS for size in QUIC_microbench.PAYLOAD_SIZES}
+        self.assertGreater(frame_encode[(2, 2000)], frame_encode[(2, 16)])
+        self.assertGreater(frame_encode[(1, 2000)], frame_encode[(2, 2000)])
+
+        codec = QUIC_microbench.load_codec(api.__file__)
+        self.assertIsNot(codec, api)
+        del codec.PacketEncoder
+        other = QUIC_microbench.run_cases(codec, ['packet encoder', 'ack decode'], [2], min_time=0.001, repeats=1)
+        self.assertIn('ns', other[('packet encoder', 2, 16)])
+        self.assertIn('ns', other[('ack decode', 2, 64)])
+
+        # A codec from before the wire format versions runs the version 1 cases on its construct_*/parse_* functions
+        for name in ('encode_quic_frame', 'decode_quic_frame', 'encode_flow_control_frame', 'encode_quic_short_packet',
+                     'decode_quic_short_packet', 'encode_quic_ack_packet', 'decode_quic_ack_packet', 'hello_data'):
+            delattr(codec, name)
+        other = QUIC_microbench.run_cases(codec, min_time=0.001, repeats=1)
+        self.assertEqual(other.keys(), results.keys())
+        for (name, version, parameter), result in other.items():
+            if name == 'flow control frame encode' or (version == 2 and not name.startswith('long header')):
+                self.assertIn('error', result)
+            else:
+                self.assertIn('ns', result)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            QUIC_microbench.print_results(results, other)
+        self.assertIn('other: frame encode v2 16 B: ValueError', output.getvalue())
+        print('passed microbench test')
+
+    """
+       Test the connection trace of a simulated transfer over a lossy link: every sent, lost and ACKed packet is in the
+       qlog file with the recovery algorithm that declared it lost, sampling keeps the losses, and a full ring buffer
+       keeps the newest events.
+    """
+    def test_trace(self):
+        uplink, downlink = QUIC_sim.link_models(loss=0.05)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'client.qlog')
+            trace = QUIC_trace.Tracer(path)
+            result = QUIC_sim.simulate_transfer(size=256 * 1024, uplink=uplink, downlink=downlink, trace=trace)
+            self.assertEqual(trace.flush(), trace.recorded)
+            self.assertEqual(trace.dropped, 0)
+
+            header, events = QUIC_trace.read_trace(path)
+            self.assertEqual(header['qlog_format'], 'NDJSON')
+            self.assertEqual(header['trace']['vantage_point']['type'], 'client')
+            summary = QUIC_trace.summarize(events)
+            self.assertEqual(summary['events']['transport:packet_sent'],
+                             result['unique_packets'] + result['retransmissions'])
+            self.assertEqual(sum(summary['losses'].values()), result['retransmissions'])
+            self.assertEqual(summary['losses'].get(api.PACKET_THRESHOLD_TRIGGER, 0),
+                             result['packet_number_retransmissions'])
+            self.assertGreater(summary['events']['transport:packet_received'], 0)
+            self.assertIn('congestion_window', summary['metrics'])
+            self.assertAlmostEqual(summary['metrics']['smoothed_rtt'], result['smoothed_rtt'] * 1000)
+            times = [event['time'] for event in events]
+            self.assertListEqual(times, sorted(times))
+            acks = [event['data']['frames'][0] for event in events if event['name'] == 'transport:packet_received'
+                    and event['data']['frames'][0]['frame_type'] == 'ack']
+            self.assertTrue(acks)
+            self.assertTrue(all(first <= last for frame in acks for first, last in frame['acked_ranges']))
+
+            # One in 8 packets, by packet number, and every loss
+            trace = QUIC_trace.Tracer(path, sample=8)
+            result = QUIC_sim.simulate_transfer(size=256 * 1024, uplink=uplink, downlink=downlink, trace=trace)
+            trace.flush()
+            _, events = QUIC_trace.read_trace(path)
+            sent = [event for event in events if event['name'] == 'transport:packet_sent']
+            self.assertTrue(sent)
+            self.assertTrue(all(event['data']['header']['packet_number'] % 8 == 0 for event in sent))
+            self.assertEqual(sum(QUIC_trace.summarize(events)['losses'].values()), result['retransmissions'])
+
+            # A small ring buffer keeps the last events
+            trace = QUIC_trace.Tracer(path, capacity=100)
+            QUIC_sim.simulate_transfer(size=256 * 1024, trace=trace)
+            self.assertEqual(len(trace), 100)
+            self.assertEqual(trace.dropped, trace.recorded - 100)
+            self.assertEqual(trace.flush(), 100)
+            self.assertEqual(trace.flush(), 0)
+        print('passed trace test')
+
+    """
+       Test the multi-process server: transfers spread over SO_REUSEPORT workers, the launcher sums the statistics the
+       workers send over their pipes, and stops the workers once enough connections were closed.
+    """
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "SO_REUSEPORT is not supported")
+    def test_workers(self):
+        file_path = 'workers_test_file.txt'
+        with open(file_path, 'w') as file:
+            file.write(''.join(random.choices(string.ascii_letters + string.digits, k=50000)))
+
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        results = []
+
+        def run_clients():
+            # Give the workers time to bind
+            time.sleep(0.5)
+            results.extend(asyncio.run(asyncio.wait_for(QUIC_asyncio.run_clients(6, [file_path], port=port), TIMEOUT)))
+
+        clients = threading.Thread(target=run_clients)
+        try:
+            with tempfile.TemporaryDirectory() as output_dir:
+                clients.start()
+                summary = QUIC_workers.run_workers(3, port=port, max_connections=6, ack_delay=5, output_dir=output_dir)
+                clients.join()
+
+                self.assertEqual(len(results), 6)
+                self.assertEqual(summary['connections'], 6)
+                self.assertEqual(sum(summary['worker_connections']), 6)
+                self.assertEqual(summary['bytes'], 6 * 50000)
+                self.assertEqual(summary['complete_streams'], 6)
+                # Every worker gives out its own CIDs, so no two connections write the same file
+                self.assertEqual(len(os.listdir(output_dir)), 6)
+        finally:
+            os.remove(file_path)
+        print('passed workers test')
+
+    """
+       Test the parallel client: a file split into shards, each sent over its own connection from a process pool, and
+       written by the server at the shards' offsets into a single output file.
+    """
+    def test_parallel_client(self):
+        self.assertListEqual(QUIC_parallel.shard_ranges(10, 3), [(0, 4), (4, 3), (7, 3)])
+        self.assertEqual(api.parse_hello_data(api.hello_data('Client', (7, 100, 50, 300))),
+                         ('ClientHello', (7, 100, 50, 300), None))
+        self.assertEqual(api.parse_hello_data(b'ServerHello'), ('ServerHello', None, None))
+        self.assertEqual(api.parse_hello_data(api.hello_data('Server', max_ack_delay=25)), ('ServerHello', None, 25))
+
+        file_path = 'parallel_test_file.txt'
+        with open(file_path, 'w') as file:
+            file.write(''.join(random.choices(string.ascii_letters + string.digits, k=200001)))
+
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        try:
+            with tempfile.TemporaryDirectory() as output_dir:
+                server = threading.Thread(target=asyncio.run, args=(
+                    QUIC_asyncio.run_server(port=port, ack_delay=5, max_connections=4, output_dir=output_dir),))
+                server.start()
+                merged = QUIC_parallel.run_parallel(file_path, 4, port=port)
+                server.join(TIMEOUT)
+                self.assertFalse(server.is_alive())
+
+                self.assertEqual(merged['connections'], 4)
+                self.assertEqual(merged['file_size'], 200001)
+                self.assertListEqual(sorted(result['client_cid'] for result in merged['per_connection']), [1, 2, 3, 4])
+                self.assertListEqual(os.listdir(output_dir), [f"transfer_{merged['transfer_id']}"])
+                with open(os.path.join(output_dir, f"transfer_{merged['transfer_id']}"), 'rb') as output, \
+                        open(file_path, 'rb') as file:
+                    self.assertEqual(output.read(), file.read())
+        finally:
+            os.remove(file_path)
+        print('passed parallel client test')
+
+    """
+       Test the connection table: ClientHello retransmissions, CID demultiplexing, ACK deadlines and idle eviction.
+    """
+    def test_connection_table(self):
+        connections = QUIC_connection.ConnectionTable(first_cid=10, idle_timeout=5)
+        first, new = connections.accept(1, api.QUIC_VERSION_BINARY, ('127.0.0.1', 5000), 0)
+        self.assertTrue(new)
+        self.assertEqual(first.cid, 10)
+        again, new = connections.accept(1, api.QUIC_VERSION_BINARY, ('127.0.0.1', 5000), 0.1)
+        self.assertFalse(new)
+        self.assertIs(again, first)
+        second, new = connections.accept(1, api.QUIC_VERSION_BITSTRING, ('127.0.0.1', 5001), 1)
+        self.assertTrue(new)
+        self.assertEqual(second.cid, 11)
+        self.assertEqual(len(connections), 2)
+
+        for version, connection in ((api.QUIC_VERSION_BINARY, first), (api.QUIC_VERSION_BITSTRING, second)):
+            packet = api.encode_quic_short_packet(connection.cid, 0, api.encode_quic_frame(8, 0, 0, 'data', version),
+                                                  version)
+            self.assertIs(connections.get(api.short_header_dcid(packet)), connection)
+        self.assertIsNone(connections.get(12))
+
+        for packet_number, arrival in ((0, 2), (1, 2.001), (3, 2.005), (2, 2.1)):
+            frame = {'frame_type': 8, 'stream_id': 0, 'offset': packet_number * 100, 'data': b'x' * 100}
+            first.on_packet(packet_number, frame, arrival)
+            if packet_number == 1:
+                # Two packets in order reach the threshold
+                self.assertListEqual(connections.due_acks(2.001), [first])
+                ack_packet = api.decode_quic_ack_packet(first.build_ack(2.004), api.QUIC_VERSION_BINARY)
+                self.assertListEqual(ack_packet["ack_ranges"], [(0, 1)])
+                self.assertEqual(ack_packet["ack_delay"], 3)
+            elif packet_number == 3:
+                # A gap is ACKed right away, with the largest packet's real delay, and the packets ACKed before
+                self.assertAlmostEqual(connections.next_deadline(), 2.005)
+                ack_packet = api.decode_quic_ack_packet(first.build_ack(2.005), api.QUIC_VERSION_BINARY)
+                self.assertListEqual(ack_packet["ack_ranges"], [(3, 3), (0, 1)])
+                self.assertEqual(ack_packet["ack_delay"], 0)
+        self.assertEqual(first.frames_received, 4)
+        self.assertListEqual(connections.due_acks(2.1), [first])
+        self.assertIsNotNone(first.build_ack(2.1))
+        self.assertIsNone(first.build_ack(2.2))
+        self.assertEqual(first.acks_sent, 3)
+
+        self.assertListEqual(connections.evict_idle(6.5), [second])
+        self.assertListEqual(list(connections), [first])
+        self.assertListEqual(connections.evict_idle(7.5), [first])
+        self.assertIsNone(connections.next_deadline())
+        print('passed connection table test')
+
+    """
+       Test the ACK policy: an ACK every few ack-eliciting packets or after the maximum ACK delay, right away on gaps
+       and reordering, and the measured ACK delay.
+    """
+    def test_ack_scheduler(self):
+        ack = QUIC_connection.AckScheduler(max_ack_delay=25, threshold=3)
+        self.assertFalse(ack.on_packet(0, 1))
+        self.assertAlmostEqual(ack.deadline, 1.025)
+        self.assertFalse(ack.on_packet(1, 1.01))
+        self.assertAlmostEqual(ack.deadline, 1.025)
+        self.assertTrue(ack.on_packet(2, 1.02))
+        self.assertEqual(ack.build(1.022), ([(0, 2)], 2))
+        self.assertIsNone(ack.deadline)
+        self.assertIsNone(ack.build(1.03))
+
+        # Packets that aren't ack-eliciting wait for the next ACK
+        self.assertFalse(ack.on_packet(3, 2, ack_eliciting=False))
+        self.assertIsNone(ack.deadline)
+        self.assertFalse(ack.on_packet(4, 2.01))
+        # Every ACK repeats the packets ACKed before, in case an earlier ACK was lost
+        self.assertEqual(ack.build(ack.deadline), ([(0, 4)], 25))
+
+        # A gap, a reordered packet and a duplicate are all ACKed right away. The delay is counted from the arrival of
+        # the largest packet.
+        self.assertTrue(ack.on_packet(6, 3))
+        self.assertEqual(ack.build(3), ([(0, 4), (6, 6)], 0))
+        self.assertTrue(ack.on_packet(5, 3.002))
+        self.assertEqual(ack.build(3.004), ([(0, 6)], 4))
+        self.assertTrue(ack.on_packet(6, 3.1))
+        self.assertEqual(ack.build(3.1), ([(0, 6)], 100))
+        self.assertFalse(ack.on_packet(7, 3.2))
+        self.assertTrue(ack.on_packet(8, 3.2, immediate=True))
+        self.assertEqual(ack.immediate_acks, 5)
+
+        # An ACK frame has at least one range
+        for version in api.SUPPORTED_VERSIONS:
+            with self.assertRaises(ValueError):
+                api.encode_quic_ack_packet(1, 3, 0, [], version)
+
+        # The delay field is a variable-length integer, so a long delay isn't capped
+        self.assertEqual(ack.build(200), ([(0, 8)], 196800))
+        for version in api.SUPPORTED_VERSIONS:
+            ack_packet = api.encode_quic_ack_packet(1, 3, 196800, [(0, 8)], version)
+            self.assertEqual(api.decode_quic_ack_packet(ack_packet, version)['ack_delay'], 196800)
+
+        # Only the newest ranges are kept, and an ACK packet holds as many of them as fit, newest first
+        ack = QUIC_connection.AckScheduler(max_ranges=3)
+        for packet_number in range(0, 10, 2):
+            ack.on_packet(packet_number, 1)
+        self.assertEqual(ack.build(1), ([(4, 4), (6, 6), (8, 8)], 0))
+        ack = QUIC_connection.AckScheduler(max_ranges=1000)
+        for packet_number in range(0, 2000, 2):
+            ack.on_packet(packet_number, 1)
+        ack_ranges, ack_delay = ack.build(1)
+        self.assertEqual(len(ack_ranges), 1000)
+        for version in api.SUPPORTED_VERSIONS:
+            packet = api.encode_quic_ack_packet(1, 1, ack_delay, ack_ranges, version)
+            self.assertLessEqual(len(packet), api.MAX_ACK_SIZE)
+            sent_ranges = api.decode_quic_ack_packet(packet, version)['ack_ranges']
+            self.assertLess(len(sent_ranges), len(ack_ranges))
+            self.assertEqual(sent_ranges[0], ack_ranges[-1])
+
+        # A connection ACKs right away the data sent again into a gap of its stream, and the end of the stream
+        connection = QUIC_connection.ServerConnection(2, 1, api.QUIC_VERSION_BINARY, None, 0, ack_threshold=3)
+        self.assertTrue(connection.on_packet(0, {'frame_type': 8, 'stream_id': 0, 'offset': 0, 'data': b'a'}, 1))
+        self.assertTrue(connection.on_packet(1, {'frame_type': 8, 'stream_id': 0, 'offset': 2, 'data': b'c'}, 1))
+        self.assertEqual(connection.ack_deadline, 1 + QUIC_connection.MAX_ACK_DELAY / 1000)
+        self.assertTrue(connection.on_packet(2, {'frame_type': 8, 'stream_id': 0, 'offset': 1, 'data': b'b'}, 1.001))
+        self.assertEqual(connection.ack_deadline, 1.001)
+        connection.build_ack(1.001)
+        self.assertTrue(connection.on_packet(3, {'frame_type': 9, 'stream_id': 0, 'offset': 3, 'data': b'd'}, 1.002))
+        self.assertEqual(connection.ack_deadline, 1.002)
+        print('passed ack scheduler test')
+
+    """
+       Test the stream scheduler and the receive side of streams: round-robin and priority order, FIN frames and
+       final sizes, and retransmissions rebuilt from the memory mapped files.
+    """
+    def test_streams(self):
+        class RecordingSocket:
+            def __init__(self):
+                self.sent = []
+
+            def sendto(self, data, address):
+                # The retransmissions are built in a reused buffer
+                self.sent.append(bytes(data))
+
+        version = api.QUIC_VERSION_BINARY
+        sizes = [5000, 2000, 0]
+        contents = []
+        file_paths = []
+        for i, size in enumerate(sizes):
+            contents.append(''.join(random.choices(string.ascii_letters, k=size)).encode())
+            file_paths.append(f'stream_test_file_{i}.txt')
+            with open(file_paths[-1], 'wb') as file:
+                file.write(contents[-1])
+
+        try:
+            for policy in QUIC_streams.SCHEDULERS:
+                streams = QUIC_streams.StreamScheduler(policy)
+                for priority, file_path in enumerate(file_paths):
+                    streams.open_stream(file_path, priority)
+                self.assertListEqual([stream.stream_id for stream in streams.streams], [0, 4, 8])
+                self.assertEqual(streams.size, sum(sizes))
+
+                stream_frames = []
+                while not streams.finished:
+                    stream_frames.append(streams.read(1000))
+                stream_order = [stream_frame.stream_id for stream_frame in stream_frames]
+                if policy == QUIC_streams.ROUND_ROBIN:
+                    self.assertListEqual(stream_order, [0, 4, 8, 0, 4, 0, 0, 0])
+                else:
+                    self.assertListEqual(stream_order, [0] * 5 + [4] * 2 + [8])
+
+                # Send every frame, keeping only the frame references
+                packet_queue = api.SentPacketMap(dcid=7)
+                encoder = api.PacketEncoder(7, version, buffer_count=4)
+                packets = []
+                for packet_number, stream_frame in enumerate(stream_frames):
+                    packet = encoder.encode(packet_number, stream_frame)
+                    self.assertEqual(bytes(packet), api.encode_quic_short_packet(7, packet_number,
+                                                                                 stream_frame.encode(version), version))
+                    packets.append(bytes(packet))
+                    packet_queue.add(packet_number, packet_number, packet, stream_frame)
+                self.assertTrue(all(record.frame is stream_frame
+                                    for record, stream_frame in zip(packet_queue, stream_frames)))
+
+                # The first packets are lost and rebuilt from the mapped files
+                packet_queue.on_ack_range(4, len(packets) - 1)
+                sock = RecordingSocket()
+                count, _ = api.packet_number_based_recovery(sock, None, packet_queue, len(packets), 0, version)
+                self.assertEqual(count, 4)
+                for lost, resent in zip(packets, sock.sent):
+                    self.assertEqual(api.unpack_quic_short_header(resent)['dcid'], 7)
+                    self.assertEqual(api.unpack_quic_short_header(resent)['payload'],
+                                     api.unpack_quic_short_header(lost)['payload'])
+
+                received = {}
+                for packet in packets + sock.sent:
+                    frame = api.decode_quic_frame(api.decode_quic_short_packet(packet, version)['payload'], version)
+                    self.assertTrue(QUIC_streams.is_stream_frame(frame['frame_type']))
+                    stream = received.setdefault(frame['stream_id'], QUIC_streams.ReceiveStream(frame['stream_id']))
+                    stream.on_frame(frame['offset'], frame['data'], frame['frame_type'] & QUIC_streams.STREAM_FIN_BIT)
+                for stream_id, size in zip((0, 4, 8), sizes):
+                    self.assertEqual(received[stream_id].final_size, size)
+                    self.assertEqual(received[stream_id].bytes_received, size)
+                    self.assertTrue(received[stream_id].complete)
+                streams.close()
+        finally:
+            for file_path in file_paths:
+                os.remove(file_path)
+        self.assertFalse(QUIC_streams.is_stream_frame(0x1c))
+        print('passed streams test')
+
+    """
+       Test the range set used for received offsets and packet numbers: merging of overlapping and adjacent ranges,
+       membership, gaps, and ACK ranges from packet numbers received out of order.
+    """
+    def test_range_set(self):
+        ranges = api.RangeSet()
+        self.assertListEqual(ranges.add(10, 20), [(10, 20)])
+        self.assertListEqual(ranges.add(30, 40), [(30, 40)])
+        self.assertListEqual(ranges.add(15, 35), [(20, 30)])
+        self.assertListEqual(list(ranges), [(10, 40)])
+        self.assertListEqual(ranges.add(12, 18), [])
+        self.assertListEqual(ranges.add(40, 50), [(40, 50)])
+        self.assertListEqual(list(ranges), [(10, 50)])
+        self.assertListEqual(ranges.missing(60), [(0, 10), (50, 60)])
+        self.assertEqual(ranges.total, 40)
+        self.assertTrue(ranges.covers(10, 50))
+        self.assertFalse(ranges.covers(5, 15))
+        self.assertIn(10, ranges)
+        self.assertNotIn(50, ranges)
+
+        packet_numbers = list(range(1000))
+        random.shuffle(packet_numbers)
+        lost = set(random.sample(packet_numbers, 50))
+        ranges = api.RangeSet()
+        for packet_number in packet_numbers + packet_numbers[:100]:
+            if packet_number not in lost:
+                ranges.add(packet_number)
+        self.assertEqual(ranges.total, 1000 - len(lost))
+        ack_ranges = ranges.ack_ranges()
+        self.assertListEqual(ack_ranges, sorted(ack_ranges))
+        acked = set()
+        for first, last in ack_ranges:
+            acked.update(range(first, last + 1))
+        self.assertSetEqual(acked, set(range(1000)) - lost)
+        for (_, last), (first, _) in zip(ack_ranges, ack_ranges[1:]):
+            self.assertGreater(first, last + 1)
+
+        ranges.clear()
+        self.assertEqual(len(ranges), 0)
+        self.assertListEqual(ranges.ack_ranges(), [])
+        print('passed range set test')
+
+    """
+       Test the reassembly of a file from frames that arrive out of order, duplicated and overlapping: every byte is
+       written once, and the missing ranges and the completion are reported correctly.
+    """
+    def test_reassembly(self):
+        content = os.urandom(100000)
+        chunks = [(offset, content[offset:offset + 1000]) for offset in range(0, len(content), 1000)]
+        missing = chunks.pop(60)
+        random.shuffle(chunks)
+        # Duplicates, and overlapping frames that don't line up with the others
+        chunks += chunks[:20] + [(offset, content[offset:offset + 3000]) for offset in (500, 41234, 97000)]
+
+        output_path = 'reassembly_test_file'
+        reassembler = QUIC_reassembly.FileReassembler(output_path)
+        try:
+            written = 0
+            for offset, data in chunks:
+                written += reassembler.write(offset, memoryview(data))
+            reassembler.set_final_size(len(content))
+            self.assertFalse(reassembler.complete)
+            self.assertEqual(written, len(content) - len(missing[1]))
+            self.assertListEqual(reassembler.missing_ranges(), [(missing[0], missing[0] + len(missing[1]))])
+
+            self.assertEqual(reassembler.write(*missing), len(missing[1]))
+            self.assertTrue(reassembler.complete)
+            self.assertListEqual(reassembler.missing_ranges(), [])
+            self.assertEqual(reassembler.duplicate_bytes, sum(len(data) for _, data in chunks) + len(missing[1])
+                             - len(content))
+            reassembler.close()
+            with open(output_path, 'rb') as file:
+                self.assertEqual(file.read(), content)
+        finally:
+            reassembler.close()
+            os.remove(output_path)
+        print('passed reassembly test')
+
+    """
+       Test flow control: the sender stops at the connection and stream limits and reports each limit once, the
+       receiver moves its limits forward as the streams are consumed, and data past a limit is caught.
+    """
+    def test_flow_control(self):
+        for version in api.SUPPORTED_VERSIONS:
+            frame = api.decode_quic_frame(api.encode_flow_control_frame(api.MAX_STREAM_DATA_FRAME, 5000, 4, version),
+                                          version)
+            self.assertEqual((frame['frame_type'], frame['stream_id'], frame['offset'], frame['data_length']),
+                             (api.MAX_STREAM_DATA_FRAME, 4, 5000, 0))
+
+        file_paths = []
+        for i, size in enumerate((5000, 3000)):
+            file_paths.append(f'flow_test_file_{i}.txt')
+            with open(file_paths[-1], 'wb') as file:
+                file.write(os.urandom(size))
+
+        try:
+            flow = QUIC_flow.SendFlowControl(max_data=4000, max_stream_data=2500)
+            receiver = QUIC_flow.ReceiveFlowControl(4000, 2500, initial_max_data=4000, initial_max_stream_data=2500)
+            streams = QUIC_streams.StreamScheduler(QUIC_streams.ROUND_ROBIN, flow)
+            for file_path in file_paths:
+                streams.open_stream(file_path)
+
+            def send():
+                frames = []
+                while streams.can_send:
+                    frames.append(streams.read(1000))
+                for stream_frame in frames:
+                    self.assertTrue(receiver.on_stream_frame(stream_frame.stream_id,
+                                                             stream_frame.offset + stream_frame.length,
+                                                             stream_frame.fin))
+                return frames
+
+            # The connection limit stops both streams
+            frames = send()
+            self.assertListEqual([(frame.stream_id, frame.offset, frame.length) for frame in frames],
+                                 [(0, 0, 1000), (4, 0, 1000), (0, 1000, 1000), (4, 1000, 1000)])
+            self.assertListEqual(streams.blocked_frames(), [(api.DATA_BLOCKED_FRAME, 0, 4000)])
+            self.assertListEqual(streams.blocked_frames(), [])
+            self.assertListEqual(streams.blocked_frames(resend=True), [(api.DATA_BLOCKED_FRAME, 0, 4000)])
+
+            # Nothing was consumed yet, so the limits stay
+            self.assertListEqual(receiver.updates(), [])
+            receiver.on_consumed(0, 2000)
+            receiver.on_consumed(4, 2000)
+            updates = receiver.updates()
+            self.assertListEqual(updates, [(api.MAX_DATA_FRAME, 0, 8000), (api.MAX_STREAM_DATA_FRAME, 0, 4500),
+                                           (api.MAX_STREAM_DATA_FRAME, 4, 4500)])
+            self.assertListEqual(receiver.updates(), [])
+            for frame_type, stream_id, limit in updates:
+                frame = api.encode_flow_control_frame(frame_type, limit, stream_id, api.QUIC_VERSION_BINARY)
+                self.assertTrue(flow.on_frame(api.decode_quic_frame(frame, api.QUIC_VERSION_BINARY)))
+            self.assertFalse(flow.on_frame({'frame_type': api.MAX_DATA_FRAME, 'stream_id': 0, 'offset': 6000}))
+
+            # Stream 4 finishes, stream 0 stops at its own limit
+            frames = send()
+            self.assertEqual(sum(frame.length for frame in frames), 3500)
+            self.assertListEqual([stream.stream_id for stream in streams.streams], [0])
+            self.assertEqual(flow.credit(0), 0)
+            self.assertListEqual(streams.blocked_frames(), [(api.STREAM_DATA_BLOCKED_FRAME, 0, 4500)])
+            self.assertEqual(flow.blocked_count, 3)
+
+            # A blocked frame makes the receiver repeat its limit, but finished streams get no more updates
+            receiver.on_consumed(4, 3000)
+            receiver.on_blocked({'frame_type': api.STREAM_DATA_BLOCKED_FRAME, 'stream_id': 0})
+            self.assertListEqual(receiver.updates(), [(api.MAX_STREAM_DATA_FRAME, 0, 4500)])
+
+            # Retransmissions don't count twice, data past a limit does
+            self.assertTrue(receiver.on_stream_frame(0, 1000))
+            self.assertFalse(receiver.on_stream_frame(0, 4501))
+            self.assertFalse(receiver.on_stream_frame(8, 600))
+            self.assertEqual(receiver.connection.received, 7500)
+            streams.close()
+        finally:
+            for file_path in file_paths:
+                os.remove(file_path)
+
+        connection = QUIC_connection.ServerConnection(2, 1, api.QUIC_VERSION_BINARY, None, 0)
+        frame = {'frame_type': 8, 'stream_id': 0, 'offset': 0, 'data': bytes(600000)}
+        self.assertTrue(connection.on_packet(1, frame, 0))
+        update = api.decode_quic_short_packet(connection.build_window_updates()[0], api.QUIC_VERSION_BINARY)
+        update = api.decode_quic_frame(update['payload'], api.QUIC_VERSION_BINARY)
+        self.assertEqual((update['frame_type'], update['offset']),
+                         (api.MAX_STREAM_DATA_FRAME, 600000 + QUIC_flow.INITIAL_MAX_STREAM_DATA))
+        frame = {'frame_type': 8, 'stream_id': 4, 'offset': QUIC_flow.INITIAL_MAX_STREAM_DATA, 'data': b'x'}
+        self.assertFalse(connection.on_packet(2, frame, 0))
+        print('passed flow control test')
+
     """
        This function runs a single default test using the `single_default_run` function from the 'scripts' module.
        It sets a timeout for the test execution and verifies that the test completes within the specified time limit.
@@ -123,73 +1425,95 @@ class TestQUIC(unittest.TestCase):
 
     """
        This function conducts multiple test runs with different levels of packet loss using the 'scripts' module.
-       It iterates over a list of packet loss percentages, applies each packet loss configuration to the loopback interface,
+       It iterates over a list of packet loss percentages, runs the client through a QUIC_netem relay with each packet loss,
        runs a default test with the specified packet loss, and prints the resulting speed.
        If any test execution exceeds the timeout, it fails the test with a timeout error.
        """
 
     def test_multiple_runs_packet_loss(self):
         packet_losses = [0,0.1,1,5,10,30]
-        os.system("sudo tc qdisc add dev lo root netem loss 0%")
 
         for packet_loss in packet_losses:
-            os.system(f'sudo tc qdisc change dev lo root netem loss {packet_loss}%')
-            time.sleep(0.01)
-            try:
-                speed = scripts.single_default_run(TIMEOUT)
-                print(f'packet loss {packet_loss}: {speed} MB/s')
-            except TimeoutError:
-                self.fail(f"Test execution timed out for packet loss {packet_loss}")
-
-        os.system("sudo tc qdisc del dev lo root netem")
+            timeout = TIMEOUT if packet_loss < 30 else LOSSY_TIMEOUT
+            with scripts.netem(loss=packet_loss / 100):
+                try:
+                    speed = scripts.single_default_run(timeout)
+                    print(f'packet loss {packet_loss}: {speed} MB/s')
+                except TimeoutError:
+                    self.fail(f"Test execution timed out for packet loss {packet_loss}")
 
 
     """
        This function conducts single recovery tests with different levels of packet loss using the 'scripts' module.
-       It iterates over a list of packet loss percentages, applies each packet loss configuration to the loopback interface,
+       It iterates over a list of packet loss percentages, runs the client through a QUIC_netem relay with each packet loss,
        runs a recovery test with the specified packet loss (one with time only and one with packet only),
        and prints the resulting speeds.
        If any test execution exceeds the timeout, it fails the test with a timeout error.
        """
     def test_single_recovery(self):
         packet_losses = [0,0.1,1,5,10,30]
-        os.system("sudo tc qdisc add dev lo root netem loss 0%")
 
         for packet_loss in packet_losses:
-            os.system(f'sudo tc qdisc change dev lo root netem loss {packet_loss}%')
-            time.sleep(0.01)
-            try:
-                speed = scripts.single_parameters_run(TIMEOUT, 0.1, 0)
-                print(f'packet loss {packet_loss} with time only: {speed} MB/s')
-            except TimeoutError:
-                self.fail(f"Test execution timed out for packet loss {packet_loss} with time only")
-            try:
-                speed = scripts.single_parameters_run(TIMEOUT, 0, 7)
-                print(f'packet loss {packet_loss} with packet only: {speed} MB/s')
-            except TimeoutError:
-                self.fail(f"Test execution timed out for packet loss {packet_loss} with packet only")
-
-        os.system("sudo tc qdisc del dev lo root netem")
+            timeout = TIMEOUT if packet_loss < 30 else LOSSY_TIMEOUT
+            with scripts.netem(loss=packet_loss / 100):
+                try:
+                    speed = scripts.single_parameters_run(timeout, 0.1, 0)
+                    print(f'packet loss {packet_loss} with time only: {speed} MB/s')
+                except TimeoutError:
+                    self.fail(f"Test execution timed out for packet loss {packet_loss} with time only")
+            with scripts.netem(loss=packet_loss / 100):
+                try:
+                    speed = scripts.single_parameters_run(timeout, 0, 7)
+                    print(f'packet loss {packet_loss} with packet only: {speed} MB/s')
+                except TimeoutError:
+                    self.fail(f"Test execution timed out for packet loss {packet_loss} with packet only")
 
 
     """
        This function conducts tests with different acknowledgment delay values using the 'scripts' module.
-       It iterates over a list of acknowledgment delay values, applies a fixed packet loss configuration to the
-       loopback interface, runs a test with the specified acknowledgment delay, and prints the resulting speeds.
+       It iterates over a list of acknowledgment delay values, runs the client through a QUIC_netem relay with a fixed
+       packet loss, runs a test with the specified acknowledgment delay, and prints the resulting speeds.
        If any test execution exceeds the timeout, it fails the test with a timeout error.
        """
     def test_ack_delays(self):
         ack_delays = [0,5,20,50,100,200]
-        os.system("sudo tc qdisc add dev lo root netem loss 5%")
 
         for ack_delay in ack_delays:
+            # The same seed every time, so every ACK delay sees the same losses
+            with scripts.netem(loss=0.05):
+                try:
+                    speed = scripts.single_test_run(TIMEOUT, ack_delay)
+                    print(f'ack delay {ack_delay}: {speed} MB/s')
+                except TimeoutError:
+                    self.fail(f"Test execution timed out for ack delay {ack_delay}")
+
+    """
+       This function tests the scripts' timeout: a run that takes too long raises TimeoutError, and the alarm is
+       cancelled when the run ends, so it can't go off in a later test.
+       """
+    def test_script_alarm(self):
+        with self.assertRaises(TimeoutError):
+            with scripts.alarm(1):
+                time.sleep(2)
+        with scripts.alarm(1):
+            pass
+        # Nothing pending, and the default handler is back
+        self.assertEqual(scripts.signal.alarm(0), 0)
+        self.assertEqual(scripts.signal.getsignal(scripts.signal.SIGALRM), scripts.signal.SIG_DFL)
+        print('passed script alarm test')
+
+    """
+       This function benchmarks a single server serving several clients at the same time, using the 'scripts' module.
+       It prints the aggregate throughput of all the clients for every number of clients.
+       If any test execution exceeds the timeout, it fails the test with a timeout error.
+       """
+    def test_multiple_clients(self):
+        for clients in [1, 2, 4, 8]:
             try:
-                speed = scripts.single_test_run(TIMEOUT, ack_delay)
-                print(f'ack delay {ack_delay}: {speed} MB/s')
+                speed = scripts.multi_client_run(TIMEOUT * 2, clients)
+                print(f'{clients} clients: {speed:.3f} MB/s aggregate')
             except TimeoutError:
-                self.fail(f"Test execution timed out for ack delay {ack_delay}")
-        
-        os.system("sudo tc qdisc del dev lo root netem")
+                self.fail(f"Test execution timed out for {clients} clients")
         
 
 if __name__ == '__main__':
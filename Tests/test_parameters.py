@@ -1,7 +1,9 @@
 import unittest
-import time
 import os
 import scripts
+import sys
+sys.path.append("..")
+import QUIC_sim
 
 
 TIMEOUT = 20
@@ -17,53 +19,81 @@ class TestQUIC(unittest.TestCase):
         time_based_ranges = [0.01,0.1]
         packet_losses = [0,0.1,1,5]
 
-        os.system("sudo tc qdisc add dev lo root netem loss 0%")
         for packet_loss in packet_losses:
-            os.system(f'sudo tc qdisc change dev lo root netem loss {packet_loss}%')
-            time.sleep(0.01)
             print(f'running packet loss: {packet_loss}')
+            with scripts.netem(loss=packet_loss / 100):
+                packet_thresholds_speeds = {}
+                for packet_threshold in packet_based_ranges:
+                    try:
+                        speed = scripts.single_parameters_run(timeout=TIMEOUT, time_threshold=0,
+                                                              packet_threshold=packet_threshold)
+                        packet_thresholds_speeds[packet_threshold] = speed
+                    except TimeoutError:
+                        self.fail(
+                            f"Test execution timed out for packet loss {packet_loss} with only packet based: {packet_threshold}")
+                packet_thresholds_speeds = sorted(packet_thresholds_speeds.items(), key=lambda x: x[1])
 
-            packet_thresholds_speeds = {}
-            for packet_threshold in packet_based_ranges:
-                try:
-                    speed = scripts.single_parameters_run(timeout=TIMEOUT, time_threshold=0,
-                                                          packet_threshold=packet_threshold)
-                    packet_thresholds_speeds[packet_threshold] = speed
-                except TimeoutError:
-                    self.fail(
-                        f"Test execution timed out for packet loss {packet_loss} with only packet based: {packet_threshold}")
-            packet_thresholds_speeds = sorted(packet_thresholds_speeds.items(), key=lambda x: x[1])
-
-            time_thresholds_speeds = {}
-            for time_threshold in time_based_ranges:
-                try:
-                    speed = scripts.single_parameters_run(timeout=TIMEOUT, time_threshold=time_threshold, packet_threshold=0)
-                    time_thresholds_speeds[time_threshold] = speed
-                except TimeoutError:
-                    self.fail(
-                        f"Test execution timed out for packet loss {packet_loss} with only time based: {time_threshold}")
-            time_thresholds_speeds = sorted(time_thresholds_speeds.items(), key=lambda x: x[1])
-
-            both_thresholds_speeds = {}
-            for packet_threshold in packet_based_ranges:
+                time_thresholds_speeds = {}
                 for time_threshold in time_based_ranges:
                     try:
-                        speed = scripts.single_parameters_run(timeout=TIMEOUT, time_threshold=time_threshold,
-                                                              packet_threshold=packet_threshold)
-                        both_thresholds_speeds[(packet_threshold, time_threshold)] = speed
+                        speed = scripts.single_parameters_run(timeout=TIMEOUT, time_threshold=time_threshold, packet_threshold=0)
+                        time_thresholds_speeds[time_threshold] = speed
                     except TimeoutError:
                         self.fail(
-                            f"Test execution timed out for packet loss {packet_loss} with time based: {time_threshold} and packet based: {packet_threshold}")
-            both_thresholds_speeds = sorted(both_thresholds_speeds.items(), key=lambda x: x[1])
+                            f"Test execution timed out for packet loss {packet_loss} with only time based: {time_threshold}")
+                time_thresholds_speeds = sorted(time_thresholds_speeds.items(), key=lambda x: x[1])
+
+                both_thresholds_speeds = {}
+                for packet_threshold in packet_based_ranges:
+                    for time_threshold in time_based_ranges:
+                        try:
+                            speed = scripts.single_parameters_run(timeout=TIMEOUT, time_threshold=time_threshold,
+                                                                  packet_threshold=packet_threshold)
+                            both_thresholds_speeds[(packet_threshold, time_threshold)] = speed
+                        except TimeoutError:
+                            self.fail(
+                                f"Test execution timed out for packet loss {packet_loss} with time based: {time_threshold} and packet based: {packet_threshold}")
+                both_thresholds_speeds = sorted(both_thresholds_speeds.items(), key=lambda x: x[1])
 
+                print('Time:')
+                print(time_thresholds_speeds[:])
+                print('Number:')
+                print(packet_thresholds_speeds[:])
+                print('Both:')
+                print(both_thresholds_speeds[:])
+
+    def test_simulated_ranges(self):
+        """
+        The same grid on QUIC_sim's simulated clock and link: every run is repeatable, and takes a fraction of a second.
+        """
+        packet_based_ranges = [7,10,12]
+        time_based_ranges = [0.01,0.1]
+        packet_losses = [0,0.1,1,5]
+        size = 10 * 1024 * 1024
+
+        def simulate(packet_loss, packet_threshold, time_threshold):
+            uplink, downlink = QUIC_sim.link_models(packet_loss / 100)
+            result = QUIC_sim.simulate_transfer(size=size, uplink=uplink, downlink=downlink,
+                                                packet_threshold=packet_threshold, time_threshold=time_threshold)
+            self.assertEqual(result['server']['bytes'], size)
+            return round(result['bandwidth'], 3)
+
+        for packet_loss in packet_losses:
+            print(f'simulating packet loss: {packet_loss}')
+            time_thresholds_speeds = sorted(((time_threshold, simulate(packet_loss, 0, time_threshold))
+                                             for time_threshold in time_based_ranges), key=lambda x: x[1])
+            packet_thresholds_speeds = sorted(((packet_threshold, simulate(packet_loss, packet_threshold, 0))
+                                               for packet_threshold in packet_based_ranges), key=lambda x: x[1])
+            both_thresholds_speeds = sorted((((packet_threshold, time_threshold),
+                                              simulate(packet_loss, packet_threshold, time_threshold))
+                                             for packet_threshold in packet_based_ranges
+                                             for time_threshold in time_based_ranges), key=lambda x: x[1])
             print('Time:')
-            print(time_thresholds_speeds[:])
+            print(time_thresholds_speeds)
             print('Number:')
-            print(packet_thresholds_speeds[:])
+            print(packet_thresholds_speeds)
             print('Both:')
-            print(both_thresholds_speeds[:])
-
-        os.system('sudo tc qdisc del dev lo root netem')
+            print(both_thresholds_speeds)
 
 
 if __name__ == '__main__':